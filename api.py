@@ -1,82 +1,413 @@
-from flask import Flask, request
+from flask import Flask, request, g
+import time
 import os
-import ast
-import pandas as pd
 import math
+import atexit
 import logging
+from storage import get_storage, start_compactor
+from cache import PoolCache, CachedStorage, QueryCounter, SummaryCache
+from locks import ShardLocks, LOCK_DIR
+from sketch import SketchStore, POOL_MODES
+from sharding import get_sharding
+from codec import get_json_codec, CodecJSONProvider, parse_binary_pool, BINARY_MIMETYPE
+from logs import configure_logging, set_request_id, get_request_id, PayloadSummary, REQUEST_ID_HEADER
+from profiling import get_profiler, install_flask_profiler
+from quantiles import calculate_quantile, calculate_quantiles, build_summary, calculate_summary_quantile, select_quantile
+from maintenance import Resorter
+from windows import WindowStore, WINDOW_MODE, calculate_window_quantile, calculate_window_quantiles, start_expirer
+from workers import WorkerPool, WorkerPoolBusy, init_worker, query_quantile
+from metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, CallbackMetric, timed
+import metrics
+from storage import get_path_by_id, load_data, save_data, insert_pool, append_pool_values, sort_pool_values # CSV helpers, kept importable from api
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+POOL_STORAGE = os.environ.get('POOL_STORAGE', 'csv') # 'csv' or 'binary'
+POOL_DATA_DIR = os.environ.get('POOL_DATA_DIR', 'data') # root directory of the shards
+POOL_SHARDING = os.environ.get('POOL_SHARDING', 'legacy') # 'legacy', 'range', 'hash' or 'size'
+POOL_SHARD_RANGE = int(os.environ.get('POOL_SHARD_RANGE', '1000')) # poolIds per shard of the 'range' sharding
+POOL_HASH_SHARDS = int(os.environ.get('POOL_HASH_SHARDS', '256')) # number of shards of the 'hash' sharding
+POOL_WRITE_MODE = os.environ.get('POOL_WRITE_MODE', 'rewrite') # 'log' appends updates to a per-shard log, CSV storage only
+POOL_COMPACT_INTERVAL = float(os.environ.get('POOL_COMPACT_INTERVAL', '5')) # seconds between background log merges
+POOL_LOG_SYNC = os.environ.get('POOL_LOG_SYNC', 'group') # 'group' fsyncs log appends in batches before acknowledging them, 'none' leaves it to the OS
+POOL_GROUP_COMMIT_DELAY = float(os.environ.get('POOL_GROUP_COMMIT_DELAY', '0.001')) # seconds a group commit waits for more appends
+POOL_CACHE_MAX_BYTES = int(os.environ.get('POOL_CACHE_MAX_BYTES', '0')) # memory limit of the pool cache, 0 disables it
+POOL_CACHE_WRITE_BACK = os.environ.get('POOL_CACHE_WRITE_BACK', '0') == '1' # delay saving sorted pools until evicted
+POOL_BULK_CHUNK_SIZE = int(os.environ.get('POOL_BULK_CHUNK_SIZE', '10000')) # NDJSON records applied together by /update/bulk
+POOL_SELECTION = os.environ.get('POOL_SELECTION', '1') == '1' # answer queries on rarely queried unsorted pools without sorting them
+POOL_SORT_MIN_QUERIES = float(os.environ.get('POOL_SORT_MIN_QUERIES', '2')) # recent queries before an unsorted pool is sorted and saved
+POOL_QUERY_HALF_LIFE = float(os.environ.get('POOL_QUERY_HALF_LIFE', '60')) # seconds for the recent query count of a pool to halve
+POOL_LOCK_DIR = os.environ.get('POOL_LOCK_DIR', LOCK_DIR) # shard lock files, shared by every worker process on the host
+POOL_SKETCH_ACCURACY = float(os.environ.get('POOL_SKETCH_ACCURACY', '0.01')) # default relative error of the quantile sketches
+POOL_SUMMARY_GRID = [float(percentile) for percentile in os.environ.get('POOL_SUMMARY_GRID', '').split(',') if percentile.strip()] # percentiles precomputed for hot pools, empty disables summaries
+POOL_SUMMARY_MIN_QUERIES = float(os.environ.get('POOL_SUMMARY_MIN_QUERIES', '3')) # recent queries before a pool gets a summary
+POOL_SUMMARY_MAX_POOLS = int(os.environ.get('POOL_SUMMARY_MAX_POOLS', '10000')) # summaries kept in memory
+POOL_JSON_CODEC = os.environ.get('POOL_JSON_CODEC', 'json') # 'json', 'orjson' or 'auto' (orjson when installed)
+POOL_LOG_MAX_VALUES = int(os.environ.get('POOL_LOG_MAX_VALUES', '10')) # longer lists are logged as their count, min and max
+POOL_LOG_LEVEL = os.environ.get('POOL_LOG_LEVEL', 'INFO') # WARNING in production skips every per-request record
+POOL_LOG_FORMAT = os.environ.get('POOL_LOG_FORMAT', 'text') # 'text' or 'json', one object per record
+POOL_LOG_SAMPLE_RATE = int(os.environ.get('POOL_LOG_SAMPLE_RATE', '1')) # keep 1 of every n INFO records of each message
+POOL_PROFILE_DIR = os.environ.get('POOL_PROFILE_DIR', '') # directory of the request profiles, empty disables profiling
+POOL_PROFILE_MODE = os.environ.get('POOL_PROFILE_MODE', 'cprofile') # 'cprofile' or 'sample' (stacks sampled every millisecond)
+POOL_PROFILE_SAMPLE_RATE = int(os.environ.get('POOL_PROFILE_SAMPLE_RATE', '0')) # also profile 1 of every n requests, 0 only profiles the requests asking for it
+POOL_PROFILE_MAX_FILES = int(os.environ.get('POOL_PROFILE_MAX_FILES', '1000')) # profiles are dropped once the directory holds this many files
+POOL_MMAP_MIN_LENGTH = int(os.environ.get('POOL_MMAP_MIN_LENGTH', '10000')) # sorted CSV pools this long are queried from a memory-mapped copy, 0 disables it
+POOL_WORKER_PROCESSES = int(os.environ.get('POOL_WORKER_PROCESSES', '0')) # processes sorting the large unsorted pools queried, 0 keeps every query on the request thread
+POOL_WORKER_MIN_VALUES = int(os.environ.get('POOL_WORKER_MIN_VALUES', '100000')) # unsorted values of a pool before its queries go to a worker process
+POOL_WORKER_MAX_PENDING = int(os.environ.get('POOL_WORKER_MAX_PENDING', '32')) # queries waiting or running in the worker processes, more are answered 503
+POOL_RESORT_INTERVAL = float(os.environ.get('POOL_RESORT_INTERVAL', '0')) # seconds between background re-sorts of the unsorted pools, 0 disables them
+POOL_RESORT_IDLE = float(os.environ.get('POOL_RESORT_IDLE', '1')) # seconds without a new request before the re-sort works
+POOL_RESORT_MAX_VALUES_PER_SECOND = int(os.environ.get('POOL_RESORT_MAX_VALUES_PER_SECOND', '1000000')) # values the re-sort sorts per second at most, 0 is no limit
+POOL_RESORT_CPU_BUDGET = float(os.environ.get('POOL_RESORT_CPU_BUDGET', '0.25')) # share of a core the re-sort uses at most
+POOL_WINDOW_BUCKET_SECONDS = int(os.environ.get('POOL_WINDOW_BUCKET_SECONDS', '60')) # default time bucket of the 'window' pools, one sorted segment each
+POOL_WINDOW_RETENTION_SECONDS = float(os.environ.get('POOL_WINDOW_RETENTION_SECONDS', '86400')) # default age at which values of the 'window' pools expire, 0 keeps them
+POOL_WINDOW_RETENTION_VALUES = int(os.environ.get('POOL_WINDOW_RETENTION_VALUES', '0')) # default number of newest values kept by the 'window' pools, 0 is no limit
+POOL_WINDOW_ARCHIVE_DIR = os.environ.get('POOL_WINDOW_ARCHIVE_DIR', '') # expired segments are moved there, empty deletes them
+POOL_WINDOW_EXPIRE_INTERVAL = float(os.environ.get('POOL_WINDOW_EXPIRE_INTERVAL', '60')) # seconds between expiries of the 'window' pools not updated, 0 disables them
+POOL_VALUE_TYPES = frozenset((int, float)) # bool is a subclass of int, its type is not in the set
+
+configure_logging(POOL_LOG_LEVEL, POOL_LOG_SAMPLE_RATE, POOL_LOG_FORMAT)
+json_codec = get_json_codec(POOL_JSON_CODEC)
 app = Flask(__name__)
+app.json = CodecJSONProvider(app, json_codec) # request.get_json() and the JSON responses
+shard_locks = ShardLocks(POOL_LOCK_DIR)
+sharding_options = dict(name=POOL_SHARDING, root=POOL_DATA_DIR, range_size=POOL_SHARD_RANGE, total_shards=POOL_HASH_SHARDS)
+sharding = get_sharding(**sharding_options)
+if POOL_STORAGE == 'csv':
+    storage_options = dict(write_mode=POOL_WRITE_MODE, root=POOL_DATA_DIR, mmap_min_length=POOL_MMAP_MIN_LENGTH or None, log_sync=POOL_LOG_SYNC, commit_delay=POOL_GROUP_COMMIT_DELAY)
+    storage = get_storage(POOL_STORAGE, locks=shard_locks, sharding=sharding, **storage_options)
+    if storage.write_mode == 'log':
+        storage.recover() # updates acknowledged before a crash
+        start_compactor(storage, POOL_COMPACT_INTERVAL)
+else:
+    storage_options = dict(root=POOL_DATA_DIR)
+    storage = get_storage(POOL_STORAGE, locks=shard_locks, sharding=sharding, **storage_options) # binary pool files are already append-only
+
+pool_cache = None
+if POOL_CACHE_MAX_BYTES > 0:
+    pool_cache = PoolCache(POOL_CACHE_MAX_BYTES, write_back=POOL_CACHE_WRITE_BACK)
+    storage = CachedStorage(storage, pool_cache)
+    atexit.register(pool_cache.flush)
+
+query_counter = QueryCounter(half_life=POOL_QUERY_HALF_LIFE)
+summary_cache = SummaryCache(POOL_SUMMARY_MAX_POOLS) if POOL_SUMMARY_GRID else None
+sketch_store = SketchStore(POOL_DATA_DIR, locks=shard_locks, relative_accuracy=POOL_SKETCH_ACCURACY)
+sketch_store.split_shard_files() # sketches saved one file per shard by earlier versions
+window_store = WindowStore(POOL_DATA_DIR, locks=shard_locks, bucket_seconds=POOL_WINDOW_BUCKET_SECONDS, retention_seconds=POOL_WINDOW_RETENTION_SECONDS,
+                           retention_values=POOL_WINDOW_RETENTION_VALUES, archive_dir=POOL_WINDOW_ARCHIVE_DIR)
+if POOL_WINDOW_EXPIRE_INTERVAL > 0:
+    start_expirer(window_store, POOL_WINDOW_EXPIRE_INTERVAL)
+profiler = get_profiler(POOL_PROFILE_DIR, POOL_PROFILE_MODE, POOL_PROFILE_SAMPLE_RATE, POOL_PROFILE_MAX_FILES)
+
+resorter = None
+if POOL_RESORT_INTERVAL > 0:
+    resorter = Resorter(storage, POOL_RESORT_INTERVAL, POOL_RESORT_IDLE, POOL_RESORT_MAX_VALUES_PER_SECOND, POOL_RESORT_CPU_BUDGET)
+    resorter.start()
+
+worker_pool = None
+if POOL_WORKER_PROCESSES > 0:
+    worker_pool = WorkerPool(POOL_WORKER_PROCESSES, POOL_WORKER_MAX_PENDING, initializer=init_worker, initargs=(POOL_STORAGE, storage_options, sharding_options, POOL_LOCK_DIR))
+    atexit.register(worker_pool.shutdown)
+
+def get_cache_lookups():
+    lookups = {}
+    if pool_cache is not None:
+        pool_cache_stats = pool_cache.stats()
+        lookups.update({('pool', 'hit'): pool_cache_stats["hits"], ('pool', 'miss'): pool_cache_stats["misses"]})
+    if summary_cache is not None:
+        summary_stats = summary_cache.stats()
+        lookups.update({('summary', 'hit'): summary_stats["hits"], ('summary', 'miss'): summary_stats["misses"], ('summary', 'off_grid'): summary_stats["off_grid"]})
+    return lookups
+
+def get_cache_hit_rates():
+    hit_rates = {}
+    if pool_cache is not None:
+        hit_rates[('pool',)] = pool_cache.stats()["hit_rate"]
+    if summary_cache is not None:
+        hit_rates[('summary',)] = summary_cache.stats()["hit_rate"]
+    return hit_rates
+
+def get_worker_queue_depth():
+    return {(): worker_pool.pending if worker_pool is not None else 0}
+
+REGISTRY.unregister('pool_cache_lookups_total') # replaced if api is reloaded
+REGISTRY.unregister('pool_cache_hit_rate')
+REGISTRY.unregister('pool_worker_queue_depth')
+REGISTRY.register(CallbackMetric('pool_cache_lookups_total', "Lookups of the pool cache and of the summary cache by result", ['cache', 'result'], get_cache_lookups, kind='counter'))
+REGISTRY.register(CallbackMetric('pool_cache_hit_rate', "Hits over lookups of the pool cache and of the summary cache", ['cache'], get_cache_hit_rates))
+REGISTRY.register(CallbackMetric('pool_worker_queue_depth', "Queries waiting or running in the worker processes", [], get_worker_queue_depth))
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    set_request_id(request.headers.get(REQUEST_ID_HEADER)) # correlation ID of every record logged for this request
+    if resorter is not None:
+        resorter.touch() # the background re-sort waits for idle time
+
+@app.after_request
+def end_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown' # unknown paths share one label
+    REQUESTS.labels(endpoint, response.status_code).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    response.headers[REQUEST_ID_HEADER] = get_request_id()
+    return response
 
+if profiler is not None:
+    install_flask_profiler(app, profiler, get_request_id) # after start_request, so the profile is named after the request ID
 
 @app.route("/update", methods=['POST'])
 def update():
     logger.info("ENDPOINT /update")
+    if request.mimetype == BINARY_MIMETYPE:
+        # raw float64 poolValues, the poolId in the query string
+        logger.info("BINARY POOL DATA: poolId %s, %d bytes", request.args.get('poolId'), request.content_length or 0)
+        return update_binary_response(request.args.get('poolId'), request.get_data())
     data = request.get_json()
-    logger.info(f"POOL DATA: {str(data)}")
-    
-    is_pool_valid, message = validate_pool(data)
-    if not is_pool_valid:
-        logger.info('RETURN ERROR 400, INVALID POOL')
-        return {"error": message}, 400
+    logger.info("POOL DATA: %s", PayloadSummary(data, POOL_LOG_MAX_VALUES))
+    return update_response(data)
+
+@app.route("/update/bulk", methods=['POST'])
+def update_bulk():
+    logger.info("ENDPOINT /update/bulk")
     
-    file_path = get_path_by_id(data['poolId'])
-    if not does_path_exist(file_path):
-        new_df = insert_pool(data)
-        save_data(file_path, new_df)
-        logger.info('Successfully inserted new pool')
-        return {"status": "inserted"}
+    if request.mimetype == 'application/x-ndjson':
+        # one pool per line, applied chunk by chunk so the whole body is never held in memory
+        results = []
+        chunk = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            chunk.append(line)
+            if len(chunk) >= POOL_BULK_CHUNK_SIZE:
+                results += update_pools_chunk([parse_ndjson_record(line) for line in chunk])
+                chunk = []
+        results += update_pools_chunk([parse_ndjson_record(line) for line in chunk])
+        logger.info('Updated %d pools', len(results))
+        return {"results": results}
     
-    else:
-        df_file_path = load_data(file_path)
-        df_index_values = df_file_path.index.values
-        
-        if does_pool_exist(data["poolId"], df_index_values): #append
-            new_df = append_pool_values(data, df_file_path)
-            save_data(file_path, new_df)
-            logger.info('Successfully appended pool')
-            return {"status": "appended"}
-        else: 
-            new_df = insert_pool(data, df_file_path) #insert
-            save_data(file_path, new_df)
-            logger.info('Successfully inserted new pool')
-            return {"status": "inserted"} 
+    return update_bulk_response(request.get_json())
 
 @app.route("/query", methods=['POST'])
 def query():
     logger.info("ENDPOINT /query")
     data = request.get_json()
-    logger.info(f"QUERY DATA: {str(data)}")
+    logger.info("QUERY DATA: %s", PayloadSummary(data, POOL_LOG_MAX_VALUES))
+    return query_response(data, exact=request.args.get('exact') == '1')
+
+@app.route("/query/batch", methods=['POST'])
+def query_batch():
+    logger.info("ENDPOINT /query/batch")
+    data = request.get_json()
+    logger.info("BATCH QUERY DATA: %s", PayloadSummary(data, POOL_LOG_MAX_VALUES))
+    return query_batch_response(data, exact=request.args.get('exact') == '1')
+
+@app.route("/pool/mode", methods=['POST'])
+def pool_mode():
+    logger.info("ENDPOINT /pool/mode")
+    data = request.get_json()
+    logger.info("POOL MODE DATA: %s", PayloadSummary(data, POOL_LOG_MAX_VALUES))
+    return pool_mode_response(data)
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    logger.info("ENDPOINT /stats")
+    return stats_response()
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+# Endpoint logic shared by the Flask app and the ASGI app in asgi_api.py,
+# each function takes the decoded JSON body and returns (JSON response, status code)
+
+def update_response(data):
+    is_pool_valid, message = validate_pool(data)
+    if not is_pool_valid:
+        logger.info('RETURN ERROR 400, INVALID POOL')
+        return {"error": message}, 400
+    return update_valid_pool_response(data)
+
+def update_binary_response(id_arg, body):
+    is_pool_valid, message, pool = parse_binary_pool(id_arg, body)
+    if not is_pool_valid:
+        logger.info('RETURN ERROR 400, INVALID POOL')
+        return {"error": message}, 400
+    if storage.name == 'csv':
+        pool["poolValues"] = pool["poolValues"].tolist() # CSV cells hold the Python list, binary pool files take the array as is
+    return update_valid_pool_response(pool)
+
+def update_valid_pool_response(data):
+    mode = get_pool_mode(data["poolId"])
+    if mode == WINDOW_MODE:
+        status = window_store.add_pools([data])[0]
+    elif mode == 'exact':
+        status = storage.update_pool(data) # "inserted" or "appended"
+    elif mode == 'sketch':
+        status = sketch_store.add_pools([data])[0]
+    else:
+        sketch_store.add_pools([data]) # before update_pool, which stringifies poolValues
+        status = storage.update_pool(data)
+    return {"status": status}, 200
+
+def update_bulk_response(data):
+    if type(data) is not list:
+        logger.info('RETURN ERROR 400, INVALID BULK UPDATE')
+        return {"error": "Bulk update must be a list of pools"}, 400
+    results = update_pools_chunk(data)
     
+    logger.info('Updated %d pools', len(results))
+    return {"results": results}, 200
+
+def query_response(data, exact=False):
     is_query_valid, message = validate_query(data)
     if not is_query_valid:
         logger.info('RETURN ERROR 400, INVALID QUERY')
         return {"error": message}, 400
     
-    file_path = get_path_by_id(data['poolId'])
-    if not does_path_exist(file_path):
-        logger.info('RETURN ERROR 400, poolId does not exist')
-        return {"error": "poolId does not exist"}, 400
+    mode = get_pool_mode(data["poolId"])
+    if mode == WINDOW_MODE:
+        return query_window_response(data["poolId"], data["percentile"], data.get("window", {}))
+    if "window" in data:
+        logger.info('RETURN ERROR 400, POOL IS NOT WINDOWED')
+        return {"error": "'window' is only supported by pools in 'window' mode"}, 400
+    if mode == 'sketch' or (mode == 'both' and not exact):
+        return query_sketch_response(data["poolId"], data["percentile"])
     
-    df_file_path = load_data(file_path)
-    df_index_values = df_file_path.index.values
+    recent_queries = query_counter.record(data["poolId"])
+    stamp = None
+    if summary_cache is not None:
+        stamp = storage.get_file_stamp(data["poolId"]) # read before the values, a later append makes the summary stale
+        quantile, total_elements = query_summary_quantile(data["poolId"], data["percentile"], stamp)
+        if quantile is not None:
+            resp = {"calculated_quantile": quantile, "total_count_of_elements": total_elements, "approximate": False}
+            logger.info('%s', resp)
+            return resp, 200
     
-    if does_pool_exist(data["poolId"], df_index_values):
-        sorted_pool_values_list, new_df, df_has_changed = sort_pool_values(data, df_file_path) # try sorting poolValues list
-        
-        if df_has_changed is True:
-            save_data(file_path, new_df)
-            
-        quantile, total_elements = calculate_quantile(sorted_pool_values_list, data["percentile"])       
-        resp = {"calculated_quantile": quantile, "total_count_of_elements": total_elements}
-        logger.info(f'{resp}')
-        return resp
+    total_elements, sorted_length = storage.get_pool_counts(data["poolId"]) if worker_pool is not None else (None, None)
+    if total_elements is not None and total_elements - sorted_length >= POOL_WORKER_MIN_VALUES:
+        try:
+            quantile, total_elements = query_worker_quantile(data["poolId"], data["percentile"], recent_queries, total_elements, stamp)
+        except WorkerPoolBusy:
+            logger.info('RETURN ERROR 503, WORKER POOL IS FULL')
+            return {"error": "Too many queries of large unsorted pools, retry later"}, 503
+    elif POOL_SELECTION:
+        quantile, total_elements = query_pool_quantile(data["poolId"], data["percentile"], recent_queries, stamp)
     else:
+        quantile, total_elements = query_sorted_pool_quantile(data["poolId"], data["percentile"], recent_queries, stamp)
+    if total_elements is None: # poolId does not exist
+        logger.info('RETURN ERROR 400, poolId does not exist')
+        return {"error": "poolId does not exist"}, 400
+        
+    resp = {"calculated_quantile": quantile, "total_count_of_elements": total_elements, "approximate": False}
+    logger.info('%s', resp)
+    return resp, 200
+
+def query_sketch_response(id, percentile):
+    logger.info("Answer the query from the pool sketch")
+    sketch = sketch_store.get_sketch(id)
+    if sketch is None or sketch.count == 0:
         logger.info('RETURN ERROR 400, poolId does not exist')
         return {"error": "poolId does not exist"}, 400
+    
+    resp = {"calculated_quantile": sketch.quantile(percentile), "total_count_of_elements": sketch.count,
+            "approximate": True, "relative_accuracy": sketch.relative_accuracy}
+    logger.info('%s', resp)
+    return resp, 200
 
+def query_window_response(id, percentile, window):
+    logger.info("Answer the query from the segments of the pool window")
+    runs = window_store.get_window_values(id, window.get("seconds"), window.get("values"))
+    if not runs:
+        logger.info('RETURN ERROR 400, NO VALUES IN THE WINDOW')
+        return {"error": "poolId has no values in this window"}, 400
+    
+    quantile, total_elements = calculate_window_quantile(runs, percentile)
+    resp = {"calculated_quantile": quantile, "total_count_of_elements": total_elements, "approximate": False}
+    logger.info('%s', resp)
+    return resp, 200
+
+def pool_mode_response(data):
+    is_pool_mode_valid, message = validate_pool_mode(data)
+    if not is_pool_mode_valid:
+        logger.info('RETURN ERROR 400, INVALID POOL MODE')
+        return {"error": message}, 400
+    
+    id, mode = data["poolId"], data["mode"]
+    current_mode = get_pool_mode(id)
+    if mode == WINDOW_MODE:
+        if current_mode != WINDOW_MODE and (current_mode != 'exact' or storage.get_pool_values(id)[0] is not None):
+            logger.info('RETURN ERROR 400, POOL HAS VALUES')
+            return {"error": "Pool already has values, only a new pool can be set to 'window' mode"}, 400
+        window_store.set_config(id, data.get("bucket_seconds"), data.get("retention_seconds"), data.get("retention_values")) # or changes its policy
+    elif current_mode == WINDOW_MODE:
+        logger.info('RETURN ERROR 400, WINDOW POOL CAN NOT CHANGE MODE')
+        return {"error": "A pool in 'window' mode can not change mode"}, 400
+    elif mode != current_mode:
+        if current_mode == 'sketch':
+            logger.info('RETURN ERROR 400, SKETCH POOL CAN NOT CHANGE MODE')
+            return {"error": "A pool in 'sketch' mode has no raw values and can not change mode"}, 400
+        pool_values_list = storage.get_pool_values(id)[0] if current_mode == 'exact' else None
+        if mode == 'sketch' and (current_mode == 'both' or pool_values_list is not None):
+            logger.info('RETURN ERROR 400, POOL HAS RAW VALUES')
+            return {"error": "Pool already has raw values, use 'both' mode to answer it from a sketch"}, 400
+        sketch_store.set_mode(id, mode, pool_values_list, data.get("relative_accuracy"))
+    return {"poolId": id, "mode": mode}, 200
+
+def query_batch_response(data, exact=False):
+    is_batch_valid, message = validate_batch_query(data)
+    if not is_batch_valid:
+        logger.info('RETURN ERROR 400, INVALID BATCH QUERY')
+        return {"error": message}, 400
+    
+    # every poolId and every percentile is checked with the rules of validate_query
+    pool_errors = [get_query_error({"poolId": id, "percentile": 0}) for id in data["poolIds"]]
+    percentile_errors = [get_query_error({"poolId": 0, "percentile": percentile}) for percentile in data["percentiles"]]
+    valid_ids = [id for id, error in zip(data["poolIds"], pool_errors) if error is None]
+    valid_percentiles = [percentile for percentile, error in zip(data["percentiles"], percentile_errors) if error is None]
+    
+    modes = get_pool_modes(valid_ids)
+    sketch_ids = set(id for id in valid_ids if modes[id] == 'sketch' or (modes[id] == 'both' and not exact))
+    window_ids = set(id for id in valid_ids if modes[id] == WINDOW_MODE)
+    sorted_pools_values = storage.get_sorted_pools_values([id for id in valid_ids if id not in sketch_ids and id not in window_ids]) # each shard is loaded once
+    quantiles_by_id = {}
+    for id, sorted_pool_values_list in sorted_pools_values.items():
+        quantiles_by_id[id] = calculate_quantiles(sorted_pool_values_list, valid_percentiles) if valid_percentiles else ([], len(sorted_pool_values_list))
+    for id in sketch_ids:
+        sketch = sketch_store.get_sketch(id)
+        if sketch is not None and sketch.count:
+            quantiles_by_id[id] = [sketch.quantile(percentile) for percentile in valid_percentiles], sketch.count
+    for id in window_ids:
+        runs = window_store.get_window_values(id) # every value kept by the retention policy
+        if runs:
+            quantiles_by_id[id] = calculate_window_quantiles(runs, valid_percentiles) if valid_percentiles else ([], sum(len(run) for run in runs))
+    
+    results = []
+    for id, pool_error in zip(data["poolIds"], pool_errors):
+        if pool_error is None and id not in quantiles_by_id:
+            pool_error = "poolId does not exist"
+        if pool_error is not None:
+            results.append({"poolId": id, "error": pool_error})
+            continue
+        
+        quantiles, total_elements = quantiles_by_id[id]
+        quantiles = iter(quantiles)
+        pool_result = []
+        for percentile, percentile_error in zip(data["percentiles"], percentile_errors):
+            if percentile_error is None:
+                pool_result.append({"percentile": percentile, "calculated_quantile": next(quantiles)})
+            else:
+                pool_result.append({"percentile": percentile, "error": percentile_error})
+        results.append({"poolId": id, "total_count_of_elements": total_elements, "approximate": id in sketch_ids, "quantiles": pool_result})
+    
+    logger.info('Answered %d pools', len(results))
+    return {"results": results}, 200
+
+def stats_response():
+    return {"cache": pool_cache.stats() if pool_cache is not None else None,
+            "summary": summary_cache.stats() if summary_cache is not None else None}, 200
+
+@timed('validate')
 def validate_pool(pool):
     logger.info("Check if pool data is valid")
     
@@ -93,23 +424,58 @@ def validate_pool(pool):
         message = "'poolValues' must be a list"
     elif len(pool['poolValues']) <1:
         message = "Number of elements in 'poolValues' must be greater than 0"
-    elif any(map(lambda x: type(x) not in (int, float), pool['poolValues'])):
+    elif not POOL_VALUE_TYPES.issuperset(map(type, pool['poolValues'])): # one pass in C, bools are rejected as their type is bool
         message = "All elements of 'poolValues' must be real number"
     else:
         is_valid = True
         message = "Valid pool"
     return is_valid, message
 
+def parse_ndjson_record(line):
+    try:
+        return json_codec.loads(line)
+    except ValueError:
+        return None # reported as an invalid pool
+
+def update_pools_chunk(pools):
+    logger.info("Validate then insert or append a chunk of pools")
+    results = [None] * len(pools)
+    valid_indexes = []
+    for i, pool in enumerate(pools):
+        is_pool_valid, message = validate_pool(pool) if type(pool) is dict else (False, "Pool must contain both 'poolId' and 'poolValues' and only contain this values")
+        if is_pool_valid:
+            valid_indexes.append(i)
+        else:
+            results[i] = {"error": message}
+    
+    modes = get_pool_modes(set(pools[i]["poolId"] for i in valid_indexes))
+    window_indexes = [i for i in valid_indexes if modes[pools[i]["poolId"]] == WINDOW_MODE]
+    sketch_indexes = [i for i in valid_indexes if modes[pools[i]["poolId"]] in ('sketch', 'both')]
+    stored_indexes = [i for i in valid_indexes if modes[pools[i]["poolId"]] in ('exact', 'both')]
+    window_statuses = window_store.add_pools([pools[i] for i in window_indexes]) if window_indexes else []
+    for i, status in zip(window_indexes, window_statuses):
+        results[i] = {"status": status}
+    sketch_statuses = sketch_store.add_pools([pools[i] for i in sketch_indexes]) if sketch_indexes else [] # before update_pools, which stringifies poolValues
+    for i, status in zip(sketch_indexes, sketch_statuses):
+        results[i] = {"status": status}
+    statuses = storage.update_pools([pools[i] for i in stored_indexes]) if stored_indexes else []
+    for i, status in zip(stored_indexes, statuses):
+        results[i] = {"status": status} # 'both' pools report the status of their raw values
+    return results
+
+@timed('validate')
 def validate_query(query):
     logger.info("Check if query data is valid")
     
-    length_of_query = len(query)
-    query_keys_set = set(query.keys())
+    length_of_query = len(query) - ('window' in query) # the optional window of the 'window' pools
+    query_keys_set = set(query.keys()) - set(['window'])
     expected_set = set(['percentile', 'poolId'])
     
     is_valid = False
     if (length_of_query != 2) or (query_keys_set!=expected_set):
         message = "Query must contain both 'poolId' and 'percentile' and only contain this values"
+    elif 'window' in query and not is_window_valid(query['window']):
+        message = "'window' must contain either 'seconds', a positive real number, or 'values', a positive integer"
     elif type(query['poolId']) is not int:
         message = "'poolId' must be an integer"
     elif type(query['percentile']) not in (int,float):
@@ -121,99 +487,132 @@ def validate_query(query):
         message = "Valid query"
     return is_valid, message
 
-def does_path_exist(path):
-    logger.info("Check if given path exists")
-    path_exists = os.path.exists(path)
-    return path_exists
+def is_window_valid(window):
+    if type(window) is not dict or len(window) != 1:
+        return False
+    if 'seconds' in window:
+        return type(window['seconds']) in (int, float) and window['seconds'] > 0
+    return 'values' in window and type(window['values']) is int and window['values'] > 0
+
+def validate_batch_query(batch):
+    logger.info("Check if batch query data is valid")
+    
+    is_valid = False
+    if type(batch) is not dict or set(batch.keys()) != set(['poolIds', 'percentiles']):
+        message = "Batch query must contain both 'poolIds' and 'percentiles' and only contain this values"
+    elif type(batch['poolIds']) is not list:
+        message = "'poolIds' must be a list"
+    elif type(batch['percentiles']) is not list:
+        message = "'percentiles' must be a list"
+    elif len(batch['poolIds']) < 1:
+        message = "Number of elements in 'poolIds' must be greater than 0"
+    elif len(batch['percentiles']) < 1:
+        message = "Number of elements in 'percentiles' must be greater than 0"
+    else:
+        is_valid = True
+        message = "Valid batch query"
+    return is_valid, message
+
+def validate_pool_mode(pool_mode):
+    logger.info("Check if pool mode data is valid")
+    
+    is_valid = False
+    window_keys = set(['bucket_seconds', 'retention_seconds', 'retention_values'])
+    if type(pool_mode) is not dict or not set(['poolId', 'mode']) <= set(pool_mode.keys()) <= set(['poolId', 'mode', 'relative_accuracy']) | window_keys:
+        message = "Pool mode must contain both 'poolId' and 'mode', and may only contain 'relative_accuracy' or the 'window' policy besides them"
+    elif type(pool_mode['poolId']) is not int:
+        message = "'poolId' must be an integer"
+    elif pool_mode['mode'] not in POOL_MODES + (WINDOW_MODE,):
+        message = "'mode' must be 'exact', 'sketch', 'both' or 'window'"
+    elif 'relative_accuracy' in pool_mode and (type(pool_mode['relative_accuracy']) not in (int, float) or not 0 < pool_mode['relative_accuracy'] < 1):
+        message = "'relative_accuracy' must be a real number in the range (0, 1)"
+    elif window_keys & set(pool_mode.keys()) and pool_mode['mode'] != WINDOW_MODE:
+        message = "'bucket_seconds', 'retention_seconds' and 'retention_values' are only allowed with the 'window' mode"
+    elif 'bucket_seconds' in pool_mode and (type(pool_mode['bucket_seconds']) is not int or pool_mode['bucket_seconds'] < 1):
+        message = "'bucket_seconds' must be a positive integer"
+    elif 'retention_seconds' in pool_mode and (type(pool_mode['retention_seconds']) not in (int, float) or pool_mode['retention_seconds'] < 0):
+        message = "'retention_seconds' must be a non-negative real number, 0 keeps the values"
+    elif 'retention_values' in pool_mode and (type(pool_mode['retention_values']) is not int or pool_mode['retention_values'] < 0):
+        message = "'retention_values' must be a non-negative integer, 0 is no limit"
+    else:
+        is_valid = True
+        message = "Valid pool mode"
+    return is_valid, message
 
-def does_pool_exist(id, list_id):
-    logger.info("Check if poolId exists in the id list")
-    pool_exists = (id in list_id)
-    return pool_exists
+def get_pool_mode(id):
+    # a 'window' pool has no sketch entry, only the pools with a window.json are windowed
+    return WINDOW_MODE if window_store.get_config(id) is not None else sketch_store.get_mode(id)
 
-def get_path_by_id(id):
-    logger.info("Get file path by poolId")
-    file_path = 'data/' + str(abs(id)//1000) + '.csv'
-    return file_path
+def get_pool_modes(ids):
+    window_ids = window_store.get_windowed(ids)
+    modes = sketch_store.get_modes([id for id in ids if id not in window_ids])
+    modes.update((id, WINDOW_MODE) for id in window_ids)
+    return modes
 
-def load_data(path):
-    logger.info("Load file into Dataframe")
-    df = pd.read_csv(path, index_col= "poolId")
-    return df
+def get_query_error(query):
+    is_query_valid, message = validate_query(query)
+    return None if is_query_valid else message
 
-def save_data(path, df):
-    logger.info("Write Dataframe to path")
-    df.to_csv(path, index=True)
+def query_sorted_pool_quantile(id, percentile, recent_queries=0, stamp=None):
+    logger.info("Sort the pool if needed then compute the quantile")
+    sorted_pool_values_list = storage.get_sorted_pool_values(id)
+    if sorted_pool_values_list is None:
+        return None, None
+    refresh_summary(id, sorted_pool_values_list, recent_queries, stamp)
+    return calculate_quantile(sorted_pool_values_list, percentile)
 
-def calculate_quantile(sorted_list, percentile):
-    logger.info("Compute the percentile quantile of the sorted list")
+def query_pool_quantile(id, percentile, recent_queries, stamp=None):
+    logger.info("Choose between sorting the pool and selecting the quantile")
+    pool_values_list, sorted_length = storage.get_pool_values(id)
+    if pool_values_list is None:
+        return None, None
     
-    total_elements = len(sorted_list)
+    total_elements = len(pool_values_list)
+    if sorted_length >= total_elements:
+        refresh_summary(id, pool_values_list, recent_queries, stamp)
+        return calculate_quantile(pool_values_list, percentile)
     
-    logger.info("Check for special cases to limit computation")
+    if should_sort_pool(recent_queries, total_elements):
+        logger.info("Pool is queried often, sort and save it")
+        sorted_pool_values_list = storage.get_sorted_pool_values(id)
+        refresh_summary(id, sorted_pool_values_list, recent_queries, stamp)
+        return calculate_quantile(sorted_pool_values_list, percentile)
     
-    if (total_elements == 1) or (sorted_list[0] == sorted_list[-1]) or (percentile == 0):
-        logger.info("Special case")
-        quantile = sorted_list[0]
-    elif percentile == 100:
-        logger.info("Special case")
-        quantile = sorted_list[-1]
-    else:
-        rank = (total_elements - 1) * percentile/ 100
-        left_index = max(0, math.floor(rank))
-        right_index = min(total_elements-1, left_index+1)
-        weight = rank - math.floor(rank)
-        quantile = sorted_list[left_index] * (1-weight) + sorted_list[right_index] * weight
-        
+    logger.info("Pool is rarely queried, select the quantile without sorting")
+    return select_quantile(pool_values_list, percentile)
+
+def query_worker_quantile(id, percentile, recent_queries, total_elements, stamp=None):
+    logger.info("Sort the large pool or select the quantile in a worker process")
+    sort = not POOL_SELECTION or should_sort_pool(recent_queries, total_elements) # same choice as query_pool_quantile
+    summary_grid = POOL_SUMMARY_GRID if sort and should_refresh_summary(recent_queries, stamp) else None
+    quantile, total_elements, summary = worker_pool.run(query_quantile, id, percentile, sort, summary_grid)
+    if summary is not None:
+        logger.info("Pool is queried often, refresh its summary")
+        summary_cache.put(id, summary, stamp)
     return quantile, total_elements
 
-def insert_pool(pool, current_df=None):
-    logger.info("Write new pool data to Dataframe")
-    
-    total_elements = len(pool["poolValues"])
-    pool["poolValues"] = str(pool["poolValues"])
-    pool_df = pd.DataFrame([pool]).set_index('poolId')
-    if total_elements == 1:
-        pool_df['sorted'] = int(1) # no need to be sorted before calculating quantile
-    else:
-        pool_df['sorted'] = int(0) # need to be sorted before calculating quantile
-    
-    if current_df is None:
-        new_df = pool_df
-    else:
-        new_df = pd.concat([current_df, pool_df])
-    return new_df
-    
-def append_pool_values(pool, df):
-    logger.info("In Dataframe, append poolValues to current poolValues corresponding to given poolId, update 'sorted' label to 0")
-    
-    current_pool = df.loc[pool["poolId"]]  
-    current_pool_values_list = ast.literal_eval(current_pool["poolValues"]) # safely convert string to list
+def query_summary_quantile(id, percentile, stamp):
+    logger.info("Try answering the query from the pool summary")
+    summary = summary_cache.get(id, stamp)
+    if summary is None:
+        summary_cache.record('misses')
+        return None, None
+    quantile, total_elements = calculate_summary_quantile(summary, percentile)
+    summary_cache.record('hits' if quantile is not None else 'off_grid')
+    return quantile, total_elements
 
-    new_pool_values_list = current_pool_values_list + pool["poolValues"]
-      
-    df.loc[pool['poolId'],['poolValues', 'sorted']] = str(new_pool_values_list), 0 # update values
-    
-    return df
-    
-def sort_pool_values(query, df):
-    logger.info("Try sorting pool values for given poolId")
-    queried_pool = df.loc[query["poolId"]]   
-    
-    queried_pool_values_list = ast.literal_eval(queried_pool["poolValues"]) # safely convert string to list
-    
-    if queried_pool["sorted"] == 0:
-        logger.info(f"Sort pool values list: {queried_pool_values_list}, update 'sorted' label to 1")
-        
-        sorted_pool_values_list = sorted(queried_pool_values_list)
-        df.loc[query['poolId'],['poolValues', 'sorted']] = str(sorted_pool_values_list), 1 
-        df_has_changed = True
-        
-        return sorted_pool_values_list, df, df_has_changed # dataframe changed, need to update file
-    else:
-        logger.info("The pool values list is already sorted, no need to do anything")
-        df_has_changed = False
-        return queried_pool_values_list, df, df_has_changed # no need to update file
+def refresh_summary(id, sorted_list, recent_queries, stamp):
+    if not should_refresh_summary(recent_queries, stamp):
+        return
+    logger.info("Pool is queried often, refresh its summary")
+    summary_cache.put(id, build_summary(sorted_list, POOL_SUMMARY_GRID), stamp)
+
+def should_refresh_summary(recent_queries, stamp):
+    return summary_cache is not None and stamp is not None and recent_queries >= POOL_SUMMARY_MIN_QUERIES
+
+def should_sort_pool(recent_queries, total_elements):
+    # sorting costs about log2(n) selections, so it pays off once the pool is queried that often
+    return recent_queries >= max(POOL_SORT_MIN_QUERIES, math.log2(total_elements))
 
 if __name__ == '__main__':
     app.run(host = '127.0.0.1', port = 1234, debug = True)
\ No newline at end of file
@@ -0,0 +1,204 @@
+import os
+import time
+import asyncio
+import multiprocessing
+import logging
+import functools
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import api
+from api import update_response, update_binary_response, update_bulk_response, query_response, query_batch_response, pool_mode_response, stats_response, update_pools_chunk, parse_ndjson_record
+from codec import BINARY_MIMETYPE
+from logs import set_request_id, get_request_id, REQUEST_ID_HEADER
+from metrics import REGISTRY, REQUESTS, REQUEST_SECONDS
+from profiling import is_profile_flag, PROFILE_HEADER, PROFILE_QUERY_FLAG
+import metrics
+
+logger = logging.getLogger(__name__)
+
+POOL_ASYNC_EXECUTOR = os.environ.get('POOL_ASYNC_EXECUTOR', 'thread') # 'thread' or 'process', runs file I/O and sorting off the event loop
+POOL_ASYNC_WORKERS = int(os.environ.get('POOL_ASYNC_WORKERS', str(min(32, (os.cpu_count() or 1) + 4)))) # threads or processes of the executor
+
+# Same endpoints as the Flask app in api.py, (method, path) -> function(data, query string arguments) returning (JSON response, status code)
+ROUTES = {
+    ("POST", "/update"): lambda data, args: update_response(data),
+    ("POST", "/update/bulk"): lambda data, args: update_bulk_response(data),
+    ("POST", "/query"): lambda data, args: query_response(data, exact=args.get('exact') == ['1']),
+    ("POST", "/query/batch"): lambda data, args: query_batch_response(data, exact=args.get('exact') == ['1']),
+    ("POST", "/pool/mode"): lambda data, args: pool_mode_response(data),
+    ("GET", "/stats"): lambda data, args: stats_response(),
+}
+PATHS = set(path for method, path in ROUTES) | {"/metrics"}
+
+executor = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        logger.info(f"Start {POOL_ASYNC_WORKERS} {POOL_ASYNC_EXECUTOR} workers")
+        if POOL_ASYNC_EXECUTOR == 'process':
+            # spawned like the workers of workers.py, a forked process could inherit a lock held by a thread of the server.
+            # Every worker process has its own storage, shards are shared through file locks
+            executor = ProcessPoolExecutor(POOL_ASYNC_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executor = ThreadPoolExecutor(POOL_ASYNC_WORKERS, thread_name_prefix='pool-io')
+    return executor
+
+def shutdown_executor():
+    global executor
+    if executor is not None:
+        executor.shutdown()
+        executor = None
+    if api.pool_cache is not None:
+        api.pool_cache.flush()
+
+async def run_in_executor(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(run_with_request_id, get_request_id(), function, *args))
+
+def run_with_request_id(request_id, function, *args):
+    # executors do not carry context variables, the correlation ID is passed along
+    set_request_id(request_id)
+    return function(*args)
+
+def run_profiled(path, function, *args):
+    # the profiler of the process running the call, executor processes have their own
+    return api.profiler.run(path, get_request_id(), function, *args)
+
+def is_profile_request(scope):
+    return is_profile_flag(get_header(scope, PROFILE_HEADER.lower().encode())) or is_profile_flag(parse_qs(scope.get('query_string', b'').decode('latin-1')).get(PROFILE_QUERY_FLAG, [None])[0])
+
+def handle_request(method, path, query_string, body, mimetype=None):
+    # decoding, the endpoint itself and encoding all run in the executor
+    args = parse_qs(query_string.decode('latin-1'))
+    if path == "/update" and mimetype == BINARY_MIMETYPE:
+        resp, status = update_binary_response(args.get('poolId', [None])[0], body)
+        return encode_json(resp), status
+    if method == "POST":
+        try:
+            data = api.json_codec.loads(body)
+        except ValueError:
+            logger.info('RETURN ERROR 400, INVALID JSON')
+            return encode_json({"error": "Request body must be valid JSON"}), 400
+    else:
+        data = None
+    resp, status = ROUTES[(method, path)](data, args)
+    return encode_json(resp), status
+
+def encode_json(resp):
+    return api.json_codec.dumps(resp)
+
+def update_ndjson_chunk(lines):
+    return update_pools_chunk([parse_ndjson_record(line) for line in lines])
+
+async def read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+async def read_lines(receive):
+    # body lines as they arrive, the whole body is never held in memory
+    pending = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        pending += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+async def update_bulk_ndjson(receive):
+    logger.info("Apply NDJSON bulk update chunk by chunk")
+    results = []
+    chunk = []
+    async for line in read_lines(receive):
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) >= api.POOL_BULK_CHUNK_SIZE:
+            results += await run_in_executor(update_ndjson_chunk, chunk)
+            chunk = []
+    results += await run_in_executor(update_ndjson_chunk, chunk)
+    logger.info('Updated %d pools', len(results))
+    return encode_json({"results": results}), 200
+
+async def send_response(send, body, status, content_type=b"application/json"):
+    await send({"type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()),
+                            (REQUEST_ID_HEADER.lower().encode(), get_request_id().encode('latin-1'))]})
+    await send({"type": "http.response.body", "body": body})
+
+def get_header(scope, header_name):
+    for name, value in scope.get('headers', []):
+        if name.lower() == header_name:
+            return value.decode('latin-1')
+    return None
+
+def get_mimetype(scope):
+    content_type = get_header(scope, b'content-type')
+    return content_type.split(';')[0].strip().lower() if content_type is not None else None
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_executor()
+            await send({"type": "lifespan.startup.complete"})
+        elif message['type'] == 'lifespan.shutdown':
+            shutdown_executor()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await handle_lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    set_request_id(get_header(scope, REQUEST_ID_HEADER.lower().encode())) # every request runs in its own task, with its own context
+    logger.info("ENDPOINT %s", path)
+    start = time.perf_counter()
+    endpoint = path if path in PATHS else 'unknown' # unknown paths share one label
+    status = await handle_http(scope, receive, send, method, path)
+    REQUESTS.labels(endpoint, status).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+
+async def handle_http(scope, receive, send, method, path):
+    if (method, path) == ("GET", "/metrics"): # rendered on the event loop, the executor processes have metrics of their own
+        await send_response(send, REGISTRY.render().encode(), 200, metrics.CONTENT_TYPE.encode())
+        return 200
+    if (method, path) not in ROUTES:
+        if path in PATHS:
+            await send_response(send, encode_json({"error": "Method Not Allowed"}), 405)
+            return 405
+        await send_response(send, encode_json({"error": "Not Found"}), 404)
+        return 404
+
+    if api.resorter is not None:
+        api.resorter.touch() # the background re-sort waits for idle time
+    try:
+        mimetype = get_mimetype(scope)
+        if path == "/update/bulk" and mimetype == 'application/x-ndjson':
+            body, status = await update_bulk_ndjson(receive)
+        else:
+            body = await read_body(receive) if method == "POST" else b''
+            request_args = (method, path, scope.get('query_string', b''), body, mimetype)
+            if api.profiler is not None and api.profiler.should_profile(path, is_profile_request(scope)):
+                body, status = await run_in_executor(run_profiled, path, handle_request, *request_args) # decoding and encoding included
+            else:
+                body, status = await run_in_executor(handle_request, *request_args) # the event loop only routes and moves bytes
+    except Exception:
+        logger.exception("Request failed")
+        body, status = encode_json({"error": "Internal Server Error"}), 500
+    await send_response(send, body, status)
+    return status
@@ -0,0 +1,46 @@
+import os
+import sys
+import random
+import argparse
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import merge_sorted_prefix
+
+# Compare the former full re-sort of a pool with sorting only the tail appended after the sorted prefix
+
+
+def make_pool(total_elements, new_elements, seed=0):
+    rng = random.Random(seed)
+    sorted_prefix = sorted(rng.uniform(-1e6, 1e6) for _ in range(total_elements - new_elements))
+    tail = [rng.uniform(-1e6, 1e6) for _ in range(new_elements)]
+    return sorted_prefix + tail, len(sorted_prefix)
+
+def best_time(statement, repeat):
+    return min(timeit.repeat(statement, number=1, repeat=repeat))
+
+def run(sizes, new_elements_list, repeat):
+    print(f"{'pool size':>10} {'new values':>10} {'full sort list':>15} {'merge list':>12} {'full sort numpy':>16} {'merge numpy':>12}")
+    for total_elements in sizes:
+        for new_elements in new_elements_list:
+            if new_elements >= total_elements:
+                continue
+            values, sorted_length = make_pool(total_elements, new_elements)
+            array = np.array(values)
+
+            full_list = best_time(lambda: sorted(values), repeat)
+            merge_list = best_time(lambda: merge_sorted_prefix(values, sorted_length), repeat)
+            full_numpy = best_time(lambda: np.sort(array), repeat)
+            merge_numpy = best_time(lambda: merge_sorted_prefix(array, sorted_length), repeat)
+
+            assert merge_sorted_prefix(values, sorted_length) == sorted(values)
+            print(f"{total_elements:>10} {new_elements:>10} {full_list * 1e3:>13.3f}ms {merge_list * 1e3:>10.3f}ms {full_numpy * 1e3:>14.3f}ms {merge_numpy * 1e3:>10.3f}ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Full re-sort vs incremental merge of the sorted prefix")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5, 10**6])
+    parser.add_argument('--new-values', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.sizes, args.new_values, args.repeat)
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from report import summarize_latencies, save_report, load_report, compare_reports
+
+# Send a seeded mix of /update and /query requests from many client threads and report requests per
+# second with p50 / p99 latency, overall and per endpoint. By default the requests go to the Flask app
+# in this process through its test client, with a new data directory, so the run only depends on the
+# commit and the arguments. --url sends them to a running server instead, e.g.
+#   python api.py                                                   -> --url http://127.0.0.1:1234
+#   uvicorn asgi_api:app --host 127.0.0.1 --port 1235 --workers 4   -> --url http://127.0.0.1:1235
+# The pools are written to shards 99990 to 99999 of the server's data directory, delete them afterwards.
+# Compare two commits with --output and --baseline
+
+local = threading.local()
+
+
+class TestClientTransport(object):
+    # the Flask app of this process, one test client per thread
+    def __init__(self):
+        os.environ.setdefault("POOL_DATA_DIR", tempfile.mkdtemp())
+        os.environ.setdefault("POOL_LOG_LEVEL", "WARNING")
+        import api
+        self.app = api.app
+        self.name = f"test client, {api.POOL_STORAGE} storage"
+
+    def post(self, path, body):
+        if not hasattr(local, 'client'):
+            local.client = self.app.test_client()
+        return local.client.post(path, data=body, content_type='application/json').status_code
+
+
+class HttpTransport(object):
+    # a running server, one keep-alive session per thread
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url = url
+        self.name = url
+
+    def post(self, path, body):
+        if not hasattr(local, 'session'):
+            local.session = self.requests.Session()
+        return local.session.post(self.url + path, data=body, headers={"Content-Type": "application/json"}).status_code
+
+
+def make_requests(total_requests, pool_ids, update_ratio, pool_size, seed):
+    # the whole schedule is built before the run, from the seed only
+    rng = random.Random(seed)
+    schedule = []
+    for _ in range(total_requests):
+        id = rng.choice(pool_ids)
+        if rng.random() < update_ratio:
+            schedule.append(('/update', json.dumps({"poolId": id, "poolValues": [rng.uniform(0, 100) for _ in range(pool_size)]})))
+        else:
+            schedule.append(('/query', json.dumps({"poolId": id, "percentile": rng.uniform(0, 100)})))
+    return schedule
+
+def send_request(transport, path, body):
+    start = time.perf_counter()
+    status = transport.post(path, body)
+    return path, time.perf_counter() - start, status
+
+def run(args):
+    transport = HttpTransport(args.url) if args.url else TestClientTransport()
+    pool_ids = [99990000 + (i % 10) * 1000 + i for i in range(args.pools)]
+    rng = random.Random(args.seed)
+    for id in pool_ids: # every queried pool exists
+        transport.post('/update', json.dumps({"poolId": id, "poolValues": [rng.uniform(0, 100) for _ in range(args.initial_size)]}))
+    schedule = make_requests(args.requests, pool_ids, args.update_ratio, args.pool_size, args.seed + 1)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        responses = list(executor.map(lambda request: send_request(transport, *request), schedule))
+    elapsed = time.perf_counter() - start
+
+    results = {"all": summarize_latencies([latency for path, latency, status in responses])}
+    results["all"]["rps"] = len(responses) / elapsed
+    results["all"]["errors"] = sum(1 for path, latency, status in responses if status != 200)
+    for endpoint in ('/update', '/query'):
+        results[endpoint] = summarize_latencies([latency for path, latency, status in responses if path == endpoint])
+
+    print(f"{transport.name}: {args.requests} requests, {args.concurrency} clients, {results['all']['errors']} errors")
+    print(f"  {results['all']['rps']:.1f} requests/s")
+    for name, summary in results.items():
+        if summary["count"]:
+            print(f"  {name:<8} {summary['count']:>6} requests, p50 {summary['p50'] * 1e3:.1f}ms, p99 {summary['p99'] * 1e3:.1f}ms")
+
+    if args.output:
+        save_report(args.output, 'load', args, results)
+    if args.baseline:
+        compare_reports(load_report(args.baseline), results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput and latency of /update and /query under a mixed load")
+    parser.add_argument('--url', help="running server, the Flask app of this process by default")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--pools', type=int, default=20, help="number of pools, spread over shards 99990 to 99999")
+    parser.add_argument('--initial-size', type=int, default=10, help="values of each pool before the run")
+    parser.add_argument('--update-ratio', type=float, default=0.5)
+    parser.add_argument('--pool-size', type=int, default=10, help="values sent by each update")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="save the results as a JSON report")
+    parser.add_argument('--baseline', help="JSON report to compare with")
+    run(parser.parse_args())
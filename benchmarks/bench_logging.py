@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Time /update and /query through the Flask test client with the log records written to /dev/null,
+# so the cost of formatting them is measured and not the cost of the terminal. Every round appends
+# --values values to a pool then queries it, which sorts the new values. --logging before formats
+# the records like the server did before the payload summaries: the whole body of every request and
+# the whole pool sorted by a query, whatever the level. Compare e.g.
+#   python benchmarks/bench_logging.py --logging before --level INFO
+#   python benchmarks/bench_logging.py --level INFO
+#   python benchmarks/bench_logging.py --level INFO --sample-rate 100
+#   python benchmarks/bench_logging.py --level WARNING
+
+
+class FormattedPayload(object):
+    # the former logging: the record argument formatted whole by an f-string, before the level is checked
+    def __init__(self, data, max_values=None):
+        self.text = f'{data}'
+
+    def __str__(self):
+        return self.text
+
+def run(values, rounds, level, sample_rate, logging_mode='after'):
+    data_dir = tempfile.mkdtemp()
+    os.environ.update({"POOL_DATA_DIR": data_dir, "POOL_SELECTION": "0", "POOL_LOG_LEVEL": level, "POOL_LOG_SAMPLE_RATE": str(sample_rate)})
+    import api
+    import storage
+    if logging_mode == 'before':
+        api.PayloadSummary = FormattedPayload # "POOL DATA", "QUERY DATA", ... with every value
+        storage.ValuesSummary = FormattedPayload # "Sort pool values list" with the whole pool
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers:
+        handler.setStream(open(os.devnull, 'w'))
+
+    client = api.app.test_client()
+    rng = random.Random(0)
+    update_times, query_times = [], []
+    for _ in range(rounds):
+        body = json.dumps({"poolId": 1369, "poolValues": [rng.uniform(-1e3, 1e3) for _ in range(values)]})
+        start = time.perf_counter()
+        client.post('/update', data=body, content_type='application/json')
+        update_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        client.post('/query', json={"poolId": 1369, "percentile": 99})
+        query_times.append(time.perf_counter() - start)
+
+    print(f"logging {logging_mode}, level {level}, sample rate {sample_rate}, {values} values per update, pool of {values * rounds} values after {rounds} rounds")
+    print(f"  /update {sum(update_times) / rounds * 1e3:.1f}ms, /query {sum(query_times) / rounds * 1e3:.1f}ms on average")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cost of request logging on /update and /query")
+    parser.add_argument('--values', type=int, default=20000, help="values sent by each update")
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING'])
+    parser.add_argument('--sample-rate', type=int, default=1, help="POOL_LOG_SAMPLE_RATE, keep 1 of every n records of each hot message")
+    parser.add_argument('--logging', default='after', choices=['before', 'after'], help="'before' formats every payload and sorted pool whole, like the former request logging")
+    args = parser.parse_args()
+    run(args.values, args.rounds, args.level, args.sample_rate, args.logging)
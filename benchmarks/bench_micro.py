@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("POOL_DATA_DIR", tempfile.mkdtemp())
+os.environ.setdefault("POOL_LOG_LEVEL", "WARNING") # the per-call records would be timed too
+from storage import insert_pool, append_pool_values, sort_pool_values, load_data, save_data
+from api import calculate_quantile
+from report import summarize_latencies, save_report, load_report, compare_reports
+
+# Time the functions behind /update and /query on one pool of each size, the pool being the only one
+# of its shard. Every run gets a fresh copy of its input, built outside of the timing. Values are
+# seeded, so two commits measure the same pools. Sizes up to 10M values, e.g.
+#   python benchmarks/bench_micro.py --sizes 10 1000 100000 10000000 --repeat 3 --output micro.json
+
+OPERATIONS = ('insert_pool', 'append_pool_values', 'sort_pool_values', 'calculate_quantile', 'save_data', 'load_data')
+
+
+def make_values(size, seed):
+    return np.random.default_rng(seed).uniform(-1e6, 1e6, size).tolist()
+
+def make_df(id, values, sorted_length):
+    df = insert_pool({"poolId": id, "poolValues": values})
+    df['sorted_length'] = sorted_length
+    return df
+
+def time_runs(setup, run, repeat):
+    # setup() builds the arguments of run() for each repeat, only run() is timed.
+    # The first call warms up the caches and is not counted
+    run(*setup())
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_size(size, repeat, append_size, data_dir, seed):
+    values = make_values(size, seed)
+    new_values = make_values(append_size, seed + 1)
+    sorted_values = sorted(values)
+    unsorted_df = make_df(1369, values, 0)
+    path = os.path.join(data_dir, f"{size}.csv")
+    save_data(path, unsorted_df)
+
+    setups = {
+        'insert_pool': lambda: ({"poolId": 1370, "poolValues": list(values)}, unsorted_df),
+        'append_pool_values': lambda: ({"poolId": 1369, "poolValues": list(new_values)}, unsorted_df.copy()),
+        'sort_pool_values': lambda: ({"poolId": 1369}, unsorted_df.copy()),
+        'calculate_quantile': lambda: (sorted_values, 37.5),
+        'save_data': lambda: (path, unsorted_df),
+        'load_data': lambda: (path,),
+    }
+    functions = {'insert_pool': insert_pool, 'append_pool_values': append_pool_values, 'sort_pool_values': sort_pool_values,
+                 'calculate_quantile': calculate_quantile, 'save_data': save_data, 'load_data': load_data}
+    return {operation: time_runs(setups[operation], functions[operation], repeat) for operation in OPERATIONS}
+
+def run(args):
+    data_dir = tempfile.mkdtemp()
+    results = {}
+    print(f"{'operation':<20} " + ' '.join(f"{size:>12}" for size in args.sizes))
+    times_by_size = {size: bench_size(size, args.repeat, args.append_values, data_dir, args.seed) for size in args.sizes}
+    for operation in OPERATIONS:
+        cells = []
+        for size in args.sizes:
+            summary = summarize_latencies(times_by_size[size][operation])
+            summary["min"] = min(times_by_size[size][operation])
+            results[f"{operation}/{size}"] = summary
+            cells.append(f"{summary['p50'] * 1e3:>10.3f}ms")
+        print(f"{operation:<20} " + ' '.join(cells))
+    print(f"median of {args.repeat} runs per pool size, {args.append_values} values appended")
+
+    if args.output:
+        save_report(args.output, 'micro', args, results)
+    if args.baseline:
+        compare_reports(load_report(args.baseline), results, metrics=('p50', 'min'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the storage and quantile functions across pool sizes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000, 1000000], help="values per pool")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--append-values', type=int, default=10, help="values appended by append_pool_values")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="save the results as a JSON report")
+    parser.add_argument('--baseline', help="JSON report to compare with")
+    run(parser.parse_args())
@@ -0,0 +1,62 @@
+import sys
+import json
+import platform
+import subprocess
+import numpy as np
+
+# Reports shared by the benchmarks: results are saved as JSON with the commit and the machine they
+# were measured on, and compared with a report saved before, e.g. on the previous commit
+#   python benchmarks/bench_micro.py --output before.json
+#   git checkout <branch>
+#   python benchmarks/bench_micro.py --baseline before.json
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): # not a git checkout
+        return None
+
+def summarize_latencies(latencies):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if len(latencies) == 0:
+        return {"count": 0}
+    return {"count": len(latencies),
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())}
+
+def save_report(path, benchmark, args, results):
+    # results is {name: {metric: value}}, every metric is a time in seconds but 'rps' and 'count'
+    report = {"benchmark": benchmark,
+              "commit": get_commit(),
+              "python": sys.version.split()[0],
+              "machine": platform.platform(),
+              "args": vars(args),
+              "results": results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+def format_metric(metric, value):
+    if metric == 'rps':
+        return f"{value:.1f}/s"
+    if metric in ('count', 'errors'):
+        return str(value)
+    return f"{value * 1e3:.3f}ms"
+
+def compare_reports(baseline, results, metrics=('p50', 'p99', 'rps')):
+    # one line per result and metric found in both, with the ratio to the baseline.
+    # A ratio above 1 is slower for times and faster for 'rps'
+    print(f"compared with {baseline['commit'] or 'baseline'} ({baseline['machine']})")
+    print(f"{'result':<32} {'metric':>6} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, current in results.items():
+        before = baseline["results"].get(name, {})
+        for metric in metrics:
+            if metric in current and before.get(metric):
+                ratio = current[metric] / before[metric]
+                print(f"{name:<32} {metric:>6} {format_metric(metric, before[metric]):>12} {format_metric(metric, current[metric]):>12} {ratio:>6.2f}x")
@@ -0,0 +1,255 @@
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_size(values):
+    # rough memory footprint of a cached pool in bytes
+    if hasattr(values, 'nbytes'):
+        return int(values.nbytes)
+    return sys.getsizeof(values) + 32 * len(values) # list of Python int / float objects
+
+class PoolCache(object):
+    # Bounded LRU cache of sorted pool values keyed by poolId.
+    # Every entry remembers the file stamp it was read with, so a pool changed by another
+    # process is treated as a miss. Dirty entries hold a sort that has not been saved yet,
+    # their flush callback saves it when they are evicted or when flush() is called
+    def __init__(self, max_bytes, write_back=False):
+        self.max_bytes = max_bytes
+        self.write_back = write_back
+        self.entries = OrderedDict() # poolId -> (values, size, stamp, flush)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, id, stamp):
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None or entry[2] != stamp:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, id, stamp):
+        # like get, but neither counted as a lookup nor moved to the end of the LRU order
+        with self.lock:
+            entry = self.entries.get(id)
+            return entry[0] if entry is not None and entry[2] == stamp else None
+
+    def put(self, id, values, stamp, flush=None):
+        size = estimate_size(values)
+        evicted = []
+        with self.lock:
+            self.discard(id)
+            if size > self.max_bytes:
+                logger.info("Pool is larger than the cache, not cached")
+                evicted.append(flush)
+            else:
+                self.entries[id] = (values, size, stamp, flush)
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    _, (_, evicted_size, _, evicted_flush) = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted_size
+                    self.evictions += 1
+                    evicted.append(evicted_flush)
+        run_flushes(evicted) # outside of the lock, flushing writes files
+
+    def invalidate(self, id):
+        with self.lock:
+            self.discard(id) # a pending sort of the old values is dropped, the data itself is on disk
+
+    def discard(self, id):
+        entry = self.entries.pop(id, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def flush(self):
+        logger.info("Write back every dirty cached pool")
+        with self.lock:
+            flushes = []
+            for id, (values, size, stamp, flush) in self.entries.items():
+                if flush is not None:
+                    flushes.append(flush)
+                    self.entries[id] = (values, size, stamp, None)
+        run_flushes(flushes)
+        return len(flushes)
+
+    def stats(self):
+        with self.lock:
+            total_lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / total_lookups if total_lookups else 0.0,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries),
+                    "bytes": self.total_bytes,
+                    "max_bytes": self.max_bytes,
+                    "dirty_entries": sum(1 for entry in self.entries.values() if entry[3] is not None)}
+
+def run_flushes(flushes):
+    for flush in flushes:
+        if flush is None:
+            continue
+        try:
+            flush()
+        except Exception:
+            logger.exception("Cache write-back failed")
+
+
+class CachedStorage(object):
+    # Storage wrapper answering get_sorted_pool_values from a PoolCache,
+    # every other attribute is looked up on the wrapped storage
+    def __init__(self, storage, cache):
+        self.storage = storage
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def update_pool(self, pool):
+        id = pool['poolId']
+        status = self.storage.update_pool(pool)
+        self.cache.invalidate(id)
+        return status
+
+    def update_pools(self, pools):
+        statuses = self.storage.update_pools(pools)
+        for pool in pools:
+            self.cache.invalidate(pool['poolId'])
+        return statuses
+
+    def get_sorted_pool_values(self, id):
+        logger.info("Get sorted pool values through the pool cache")
+        stamp = self.storage.get_file_stamp(id)
+        sorted_pool_values_list = self.cache.get(id, stamp)
+        if sorted_pool_values_list is not None:
+            logger.info("Pool cache hit")
+            return sorted_pool_values_list
+
+        if not self.cache.write_back:
+            sorted_pool_values_list, stamp = self.storage.get_stamped_sorted_pool_values(id)
+            if sorted_pool_values_list is not None:
+                self.cache.put(id, sorted_pool_values_list, stamp)
+            return sorted_pool_values_list
+
+        # the stamp the values were read under, a later update must not be attached to them
+        sorted_pool_values_list, is_dirty, stamp = self.storage.read_sorted_pool_values(id)
+        if sorted_pool_values_list is not None:
+            flush = None
+            if is_dirty:
+                flush = lambda: self.write_back(id, sorted_pool_values_list, stamp)
+            self.cache.put(id, sorted_pool_values_list, stamp, flush)
+        return sorted_pool_values_list
+
+    def get_sorted_pools_values(self, ids):
+        logger.info("Get sorted values of many pools through the pool cache")
+        sorted_pools_values = {}
+        missed_ids = []
+        for id in dict.fromkeys(ids):
+            stamp = self.storage.get_file_stamp(id)
+            sorted_pool_values_list = self.cache.get(id, stamp)
+            if sorted_pool_values_list is None:
+                missed_ids.append(id)
+            else:
+                sorted_pools_values[id] = sorted_pool_values_list
+
+        stamped_pools_values = self.storage.get_stamped_sorted_pools_values(missed_ids)
+        for id, (sorted_pool_values_list, stamp) in stamped_pools_values.items():
+            self.cache.put(id, sorted_pool_values_list, stamp)
+            sorted_pools_values[id] = sorted_pool_values_list
+        return sorted_pools_values
+
+    def get_pool_values(self, id):
+        logger.info("Get pool values through the pool cache")
+        stamp = self.storage.get_file_stamp(id)
+        sorted_pool_values_list = self.cache.get(id, stamp)
+        if sorted_pool_values_list is not None:
+            logger.info("Pool cache hit")
+            return sorted_pool_values_list, len(sorted_pool_values_list)
+
+        pool_values_list, sorted_length = self.storage.get_pool_values(id)
+        if pool_values_list is not None and sorted_length >= len(pool_values_list):
+            self.cache.put(id, pool_values_list, stamp) # only sorted pools are cached
+        return pool_values_list, sorted_length
+
+    def get_pool_counts(self, id):
+        # a cached pool is sorted, even while its sort is not written back
+        sorted_pool_values_list = self.cache.peek(id, self.storage.get_file_stamp(id))
+        if sorted_pool_values_list is not None:
+            return len(sorted_pool_values_list), len(sorted_pool_values_list)
+        return self.storage.get_pool_counts(id)
+
+    def write_back(self, id, sorted_pool_values_list, stamp):
+        logger.info("Write back sorted pool values")
+        self.storage.save_sorted_pool_values(id, sorted_pool_values_list, stamp) # skipped if the pool changed since it was sorted
+
+
+class QueryCounter(object):
+    # Number of recent queries per poolId, decaying by half every half_life seconds.
+    # Only the max_pools most recently queried pools are tracked
+    def __init__(self, half_life=60.0, max_pools=100000):
+        self.half_life = half_life
+        self.max_pools = max_pools
+        self.counters = OrderedDict() # poolId -> (count, time of last query)
+        self.lock = threading.Lock()
+
+    def record(self, id):
+        now = time.monotonic()
+        with self.lock:
+            count, last_time = self.counters.pop(id, (0.0, now))
+            count = count * 0.5 ** ((now - last_time) / self.half_life) + 1
+            self.counters[id] = (count, now)
+            if len(self.counters) > self.max_pools:
+                self.counters.popitem(last=False)
+        return count
+
+
+class SummaryCache(object):
+    # Count, min, max and the sorted values at the ranks of a grid of percentiles, for the
+    # max_pools most recently queried hot pools. Like PoolCache, an entry is only used with
+    # the file stamp it was built from, so an append makes it stale until the next refresh
+    def __init__(self, max_pools=10000):
+        self.max_pools = max_pools
+        self.entries = OrderedDict() # poolId -> (summary, stamp)
+        self.hits = 0
+        self.misses = 0
+        self.off_grid = 0
+        self.lock = threading.Lock()
+
+    def get(self, id, stamp):
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None or entry[1] != stamp:
+                return None
+            self.entries.move_to_end(id)
+            return entry[0]
+
+    def put(self, id, summary, stamp):
+        with self.lock:
+            self.entries.pop(id, None)
+            self.entries[id] = (summary, stamp)
+            if len(self.entries) > self.max_pools:
+                self.entries.popitem(last=False)
+
+    def record(self, outcome):
+        # 'hits': answered from a summary, 'misses': no valid summary, 'off_grid': the summary lacks the ranks
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        with self.lock:
+            total_lookups = self.hits + self.misses + self.off_grid
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "off_grid": self.off_grid,
+                    "hit_rate": self.hits / total_lookups if total_lookups else 0.0,
+                    "entries": len(self.entries),
+                    "max_pools": self.max_pools}
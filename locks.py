@@ -0,0 +1,136 @@
+import os
+import stat
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from metrics import count_bytes_written
+try:
+    import fcntl
+except ImportError: # Windows, only in-process locks
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'pool-locks')
+
+
+class ReadWriteLock(object):
+    # Many readers or a single writer. A waiting writer blocks new readers,
+    # so a steady stream of queries cannot starve updates
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+
+class ShardLocks(object):
+    # One ReadWriteLock per shard path for the threads of this process, and an flock on
+    # a lock file per shard for the other processes (e.g. gunicorn workers).
+    # Lock files live outside of the data directory, shards are replaced by rename
+    # so they can not be locked themselves
+    def __init__(self, lock_dir=LOCK_DIR, use_file_locks=True):
+        self.lock_dir = lock_dir
+        self.use_file_locks = use_file_locks and fcntl is not None
+        self.locks = {} # shard path -> ReadWriteLock
+        self.guard = threading.Lock()
+        if self.use_file_locks:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def get_lock(self, path):
+        with self.guard:
+            lock = self.locks.get(path)
+            if lock is None:
+                lock = self.locks[path] = ReadWriteLock()
+            return lock
+
+    def get_lock_path(self, path):
+        # every process resolves the same shard to the same lock file
+        digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.lock_dir, digest + '.lock')
+
+    @contextmanager
+    def reading(self, path):
+        lock = self.get_lock(path)
+        lock.acquire_read()
+        try:
+            with self.file_lock(path, shared=True):
+                yield
+        finally:
+            lock.release_read()
+
+    @contextmanager
+    def writing(self, path):
+        lock = self.get_lock(path)
+        lock.acquire_write()
+        try:
+            with self.file_lock(path, shared=False):
+                yield
+        finally:
+            lock.release_write()
+
+    @contextmanager
+    def file_lock(self, path, shared):
+        if not self.use_file_locks:
+            yield
+            return
+        fd = os.open(self.get_lock_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd) # closing the descriptor releases the flock
+
+
+def fsync_directory(path):
+    # makes the files created, renamed or removed in a directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(path, write, mode='wb', fsync=True):
+    # write(f) fills a temporary file next to path, which then atomically replaces path:
+    # readers see the old or the new file, a crash never leaves a half written one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **({} if 'b' in mode else {'newline': ''})) as f:
+            write(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        count_bytes_written(path, os.path.getsize(tmp_path))
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644) # mkstemp creates it 0600
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
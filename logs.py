@@ -0,0 +1,121 @@
+import sys
+import json
+import uuid
+import logging
+import threading
+import contextvars
+import numpy as np
+
+# Request logging: every record carries the correlation ID of the request it was logged for,
+# INFO records of the hot path can be sampled and payloads are logged as short summaries
+# that are only formatted if the record is emitted
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+MAX_REQUEST_ID_LENGTH = 64
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+def set_request_id(request_id=None):
+    # the ID sent by the client, a new one otherwise
+    request_id = request_id[:MAX_REQUEST_ID_LENGTH] if request_id else new_request_id()
+    request_id_var.set(request_id)
+    return request_id
+
+def get_request_id():
+    return request_id_var.get()
+
+
+class RequestIdFilter(logging.Filter):
+    # adds the correlation ID of the current request to every record
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps 1 of every sample_rate INFO and DEBUG records of each message template, the first one
+    # included. Templates are the unformatted messages, so a lazily formatted message is one template
+    # whatever its arguments. Warnings and errors are always kept
+    MAX_TEMPLATES = 10000
+
+    def __init__(self, sample_rate=1):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.counts = {} # (logger name, message template) -> records seen
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.sample_rate <= 1 or record.levelno > logging.INFO:
+            return True
+        key = (record.name, record.msg)
+        with self.lock:
+            if len(self.counts) >= self.MAX_TEMPLATES and key not in self.counts:
+                self.counts.clear() # eagerly formatted messages would otherwise grow it forever
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+        return count % self.sample_rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per record
+    def format(self, record):
+        entry = {"time": self.formatTime(record),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "request_id": getattr(record, 'request_id', '-'),
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class ValuesSummary(object):
+    # a list of values as its count, min and max, computed only when the record is formatted
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __str__(self):
+        if len(self.values) == 0:
+            return "<0 values>"
+        if isinstance(self.values, np.ndarray):
+            return f"<{len(self.values)} values, min {self.values.min()}, max {self.values.max()}>"
+        try:
+            return f"<{len(self.values)} values, min {min(self.values)}, max {max(self.values)}>"
+        except TypeError: # not comparable, e.g. an invalid pool
+            return f"<{len(self.values)} values>"
+
+
+class PayloadSummary(object):
+    # a request body with every list longer than max_values replaced by its summary, formatted lazily
+    __slots__ = ('data', 'max_values')
+
+    def __init__(self, data, max_values=10):
+        self.data = data
+        self.max_values = max_values
+
+    def summarize(self, value):
+        if isinstance(value, (list, np.ndarray)) and len(value) > self.max_values:
+            return str(ValuesSummary(value))
+        return value
+
+    def __str__(self):
+        if isinstance(self.data, dict):
+            return str({key: self.summarize(value) for key, value in self.data.items()})
+        return str(self.summarize(self.data))
+
+
+def configure_logging(level='INFO', sample_rate=1, log_format='text', stream=None):
+    # replaces the handlers of the root logger
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter(sample_rate))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    return handler
@@ -0,0 +1,91 @@
+import time
+import logging
+import threading
+from metrics import RESORTED_SHARDS, RESORTED_POOLS
+
+logger = logging.getLogger(__name__)
+
+# Background re-sort of the pools appended to since their last sort. Without it the first query after
+# an update pays for the sort and for the rewrite of the shard saving it. The re-sort takes the same
+# shard locks as the queries and saves a sort only if no update changed the shard meanwhile, so an
+# update is never lost, at worst the shard is sorted again by the next pass
+
+
+class Resorter(object):
+    # Every interval seconds, sorts the unsorted pools of every shard, one shard at a time and only
+    # once no request started for idle_delay seconds. It sorts at most max_values_per_second values
+    # per second, and uses at most cpu_budget of a core: a shard sorted with t seconds of CPU is
+    # followed by a pause of t * (1 - cpu_budget) / cpu_budget
+    def __init__(self, storage, interval=10.0, idle_delay=1.0, max_values_per_second=1000000, cpu_budget=0.25):
+        if not 0 < cpu_budget <= 1:
+            raise ValueError(f"CPU budget must be in (0, 1], got {cpu_budget}")
+        self.storage = storage
+        self.interval = interval
+        self.idle_delay = idle_delay
+        self.max_values_per_second = max_values_per_second
+        self.cpu_budget = cpu_budget
+        self.last_request = time.monotonic() - idle_delay # idle until the first request
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def touch(self):
+        # called by every request
+        self.last_request = time.monotonic()
+
+    def wait_idle(self):
+        # False if stopped while waiting
+        while True:
+            busy_for = self.idle_delay - (time.monotonic() - self.last_request)
+            if busy_for <= 0:
+                return True
+            if self.stopped.wait(busy_for):
+                return False
+
+    def run_once(self):
+        # one pass over every shard, returns the number of pools sorted
+        sorted_pools = 0
+        for path in self.storage.get_shard_paths():
+            unsorted_pools = self.storage.get_unsorted_pools(path)
+            if not unsorted_pools:
+                continue
+            if not self.wait_idle():
+                break
+            logger.info("Re-sort %d pools of shard %s", len(unsorted_pools), path)
+            start, cpu_start = time.monotonic(), time.thread_time()
+            try:
+                shard_sorted_pools = self.storage.sort_shard(path)
+            except Exception:
+                RESORTED_SHARDS.labels('failed').inc()
+                logger.exception("Background re-sort of shard %s failed", path)
+                continue
+            RESORTED_SHARDS.labels('sorted' if shard_sorted_pools else 'skipped').inc()
+            RESORTED_POOLS.inc(shard_sorted_pools)
+            sorted_pools += shard_sorted_pools
+            self.throttle(start, cpu_start, sum(unsorted_pools.values()))
+        return sorted_pools
+
+    def throttle(self, start, cpu_start, values):
+        cpu_seconds = time.thread_time() - cpu_start
+        rate_pause = values / self.max_values_per_second - (time.monotonic() - start) if self.max_values_per_second else 0 # 0 is no rate limit
+        pause = max(cpu_seconds * (1 - self.cpu_budget) / self.cpu_budget, rate_pause)
+        if pause > 0:
+            self.stopped.wait(pause)
+
+    def start(self):
+        logger.info(f"Start background re-sort every {self.interval} seconds, CPU budget {self.cpu_budget}")
+
+        def resort_forever():
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.run_once()
+                except Exception:
+                    logger.exception("Background re-sort failed")
+
+        self.thread = threading.Thread(target=resort_forever, name='resorter', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,198 @@
+import os
+import time
+import bisect
+import functools
+import threading
+
+# In-process metrics in the Prometheus text exposition format, served by /metrics.
+# Recording is a lock and a few additions, so the instrumentation stays on in production.
+# Every process has its own metrics: with several worker processes each one is scraped apart
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(4**i for i in range(4, 14)) # 256 bytes to 64 MiB
+
+
+def format_labels(labelnames, labelvalues, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    # monotonically increasing value per label set
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {} # label values -> CounterChild
+        self.lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        # bind the labels once and keep the child, recording is then a single locked addition
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(labelvalues, CounterChild())
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def collect(self):
+        lines = []
+        for labelvalues, child in sorted(self.children.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(child.value)}")
+        return lines
+
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram(object):
+    # count of observations per bucket, with their sum and count, per label set
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children = {} # label values -> HistogramChild
+        self.lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(labelvalues, HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def collect(self):
+        lines = []
+        for labelvalues, child in sorted(self.children.items()):
+            with child.lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                bound_label = 'le="%s"' % format_value(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, bound_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value) # buckets are upper bounds, le="x" counts value <= x
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class CallbackMetric(object):
+    # value read from a function when /metrics is rendered, e.g. the counters of a cache.
+    # callback returns {label values: value}
+    def __init__(self, name, documentation, labelnames, callback, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def collect(self):
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}" for labelvalues, value in sorted(self.callback().items())]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def render(self):
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda metric: metric.name):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.collect()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter('pool_requests_total', "Requests by endpoint and status code", ['endpoint', 'status']))
+REQUEST_SECONDS = REGISTRY.register(Histogram('pool_request_seconds', "Request latency by endpoint", ['endpoint']))
+STAGE_SECONDS = REGISTRY.register(Histogram('pool_stage_seconds', "Time spent in each stage of update and query, stages can be nested", ['stage']))
+SHARD_LOAD_BYTES = REGISTRY.register(Histogram('pool_shard_load_bytes', "Size of the shards loaded whole", buckets=SIZE_BUCKETS))
+BYTES_READ = REGISTRY.register(Counter('pool_bytes_read_total', "Bytes read from data files by file type, memory-mapped pool files count their mapped size", ['file']))
+BYTES_WRITTEN = REGISTRY.register(Counter('pool_bytes_written_total', "Bytes written to data files by file type", ['file']))
+SORTS = REGISTRY.register(Counter('pool_sorts_total', "Pools sorted by method", ['method']))
+SORTED_VALUES = REGISTRY.register(Counter('pool_sorted_values_total', "Values of the unsorted tails that were sorted"))
+LOG_SYNC_BATCH = REGISTRY.register(Histogram('pool_log_sync_batch_size', "Appends made durable together by one group commit", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)))
+WORKER_TASKS = REGISTRY.register(Counter('pool_worker_tasks_total', "Queries of large pools sent to the worker processes by result, 'rejected' when the worker pool was full", ['result']))
+WORKER_TASK_SECONDS = REGISTRY.register(Histogram('pool_worker_task_seconds', "Time from sending a query to a worker process to its answer, waiting included"))
+RESORTED_SHARDS = REGISTRY.register(Counter('pool_resort_shards_total', "Shards with unsorted pools handled by the background re-sort by result, 'skipped' when an update or a query changed the shard first", ['result']))
+RESORTED_POOLS = REGISTRY.register(Counter('pool_resort_pools_total', "Pools sorted and saved by the background re-sort"))
+EXPIRED_WINDOW_VALUES = REGISTRY.register(Counter('pool_window_expired_values_total', "Values of the windowed pools past their retention by action, 'archived' when moved to the archive directory", ['action']))
+
+
+def timed(stage):
+    # decorator recording the duration of every call in pool_stage_seconds{stage=...}
+    child = STAGE_SECONDS.labels(stage)
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def get_file_label(path):
+    return os.path.splitext(path)[1] or 'none'
+
+def count_bytes_read(path, size):
+    BYTES_READ.labels(get_file_label(path)).inc(size)
+
+def count_bytes_written(path, size):
+    BYTES_WRITTEN.labels(get_file_label(path)).inc(size)
@@ -0,0 +1,32 @@
+import os
+import glob
+import argparse
+import logging
+from storage import load_data, parse_pool_values, BinaryStorage, CsvStorage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def migrate_csv_to_binary(source_dir, target_dir):
+    logger.info(f"Migrate CSV shards in {source_dir} to binary storage in {target_dir}")
+    target = BinaryStorage(target_dir)
+    CsvStorage(root=source_dir).compact_all() # updates still pending in the shard logs
+
+    total_pools = 0
+    for csv_path in sorted(glob.glob(os.path.join(source_dir, '*.csv'))):
+        df = load_data(csv_path)
+        for id, row in df.iterrows():
+            pool_values_list = parse_pool_values(row["poolValues"]) # safely convert string to list
+            target.write_pool_values(int(id), pool_values_list, int(row["sorted_length"]))
+            total_pools += 1
+        logger.info(f"Migrated {len(df)} pools from {csv_path}")
+    return total_pools
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert data/*.csv shards into the binary pool storage")
+    parser.add_argument('--source', default='data', help="directory holding the CSV shards")
+    parser.add_argument('--target', default='data', help="root directory of the binary storage")
+    args = parser.parse_args()
+    total_pools = migrate_csv_to_binary(args.source, args.target)
+    print(f"Migrated {total_pools} pools")
@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import time
+import glob
+import datetime
+import pstats
+import cProfile
+import argparse
+import logging
+import threading
+import collections
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+# Opt-in per-request profiles of /update and /query. A request is profiled when it asks for it with
+# the X-Profile: 1 header or the ?profile=1 query flag, or 1 of every sample_rate requests. Profiles are
+# cProfile dumps (.prof) or stacks sampled from the request thread (.folded, one "a;b;c count" line per
+# stack, the input of flamegraph tools). Nothing is registered unless a profile directory is configured.
+#   python profiling.py profiles/ --endpoint query --top 20
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_QUERY_FLAG = 'profile'
+PROFILE_MODES = ('cprofile', 'sample')
+PROFILED_PATHS = ('/update', '/update/bulk', '/query', '/query/batch')
+UNSAFE_FILE_CHARACTERS = re.compile(r'[^A-Za-z0-9_]') # request IDs sent by clients end up in file names
+
+
+class CProfileSession(object):
+    # deterministic profile of every function call of the thread that started it
+    suffix = '.prof'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class StackSampler(object):
+    # the stack of the thread that started it, read every interval seconds by a background thread.
+    # Cheaper than cProfile on call-heavy code, the profiled thread itself does no extra work
+    suffix = '.folded'
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = collections.Counter() # "outer;...;inner" -> samples
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        target_id = threading.get_ident()
+        self.thread = threading.Thread(target=self.sample, args=(target_id,), daemon=True)
+        self.thread.start()
+
+    def sample(self, target_id):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(target_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler(object):
+    # decides which requests are profiled and writes their profiles to directory
+    def __init__(self, directory, mode='cprofile', sample_rate=0, max_files=1000, interval=0.001):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}', expected one of {list(PROFILE_MODES)}")
+        self.directory = directory
+        self.mode = mode
+        self.sample_rate = sample_rate # 0 profiles only the requests asking for it
+        self.max_files = max_files
+        self.interval = interval
+        self.requests = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def should_profile(self, path, flag):
+        if path not in PROFILED_PATHS:
+            return False
+        if flag:
+            return True
+        if self.sample_rate <= 0:
+            return False
+        with self.lock:
+            self.requests += 1
+            return self.requests % self.sample_rate == 0
+
+    def start(self):
+        session = CProfileSession() if self.mode == 'cprofile' else StackSampler(self.interval)
+        session.start()
+        return session
+
+    def save(self, session, path, request_id, seconds):
+        # <time>-<endpoint>-<milliseconds>ms-<request id>.prof, the report reads the endpoint and duration back
+        session.stop()
+        if len(os.listdir(self.directory)) >= self.max_files:
+            logger.warning("Profile directory %s holds %d files, profile of request %s dropped", self.directory, self.max_files, request_id)
+            return None
+        endpoint = path.strip('/').replace('/', '_')
+        file_name = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{endpoint}-{seconds * 1e3:.0f}ms-{UNSAFE_FILE_CHARACTERS.sub('_', request_id)}{session.suffix}"
+        file_path = os.path.join(self.directory, file_name)
+        session.dump(file_path)
+        logger.info("Profile of request %s written to %s", request_id, file_path)
+        return file_path
+
+    def run(self, path, request_id, function, *args):
+        # profile one call, for the executors of the ASGI app
+        session = self.start()
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.save(session, path, request_id, time.perf_counter() - start)
+
+
+def is_profile_flag(value):
+    return value is not None and value not in ('', '0')
+
+def get_profiler(directory, mode='cprofile', sample_rate=0, max_files=1000):
+    # None without a directory, profiling is off
+    if not directory:
+        return None
+    logger.info(f"Profile requests to {directory} with '{mode}', sample rate {sample_rate}")
+    return Profiler(directory, mode=mode, sample_rate=sample_rate, max_files=max_files)
+
+def install_flask_profiler(app, profiler, get_request_id):
+    # hooks added only when profiling is on, so a disabled profiler costs nothing per request
+    @app.before_request
+    def start_profile():
+        flag = is_profile_flag(request.headers.get(PROFILE_HEADER)) or is_profile_flag(request.args.get(PROFILE_QUERY_FLAG))
+        if profiler.should_profile(request.path, flag):
+            g.profile_session = profiler.start()
+            g.profile_start = time.perf_counter()
+
+    @app.teardown_request
+    def save_profile(exception=None):
+        session = g.pop('profile_session', None)
+        if session is not None:
+            profiler.save(session, request.path, get_request_id(), time.perf_counter() - g.profile_start)
+
+
+def parse_profile_name(file_name):
+    # (endpoint, milliseconds) from a profile file name
+    parts = os.path.basename(file_name).split('-')
+    return parts[1], int(parts[2][:-2])
+
+def summarize_profiles(directory, endpoint=None):
+    # profile files, number and median duration per endpoint
+    paths = sorted(glob.glob(os.path.join(directory, '*.prof')) + glob.glob(os.path.join(directory, '*.folded')))
+    if endpoint is not None:
+        paths = [path for path in paths if parse_profile_name(path)[0] == endpoint]
+    durations = collections.defaultdict(list)
+    for path in paths:
+        name, milliseconds = parse_profile_name(path)
+        durations[name].append(milliseconds)
+    endpoints = {name: {"profiles": len(values), "median_ms": sorted(values)[len(values) // 2], "max_ms": max(values)} for name, values in durations.items()}
+    return paths, endpoints
+
+def merge_folded_stacks(paths):
+    # samples per function, where it was running (self) and anywhere on the stack (total)
+    self_samples, total_samples = collections.Counter(), collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                frames = stack.split(';')
+                self_samples[frames[-1]] += int(count)
+                for frame in set(frames):
+                    total_samples[frame] += int(count)
+    return self_samples, total_samples
+
+def print_report(directory, endpoint=None, top=20, sort='cumulative', stream=sys.stdout):
+    paths, endpoints = summarize_profiles(directory, endpoint)
+    for name, summary in sorted(endpoints.items()):
+        print(f"{name}: {summary['profiles']} profiles, median {summary['median_ms']}ms, max {summary['max_ms']}ms", file=stream)
+    prof_paths = [path for path in paths if path.endswith(CProfileSession.suffix)]
+    if prof_paths:
+        stats = pstats.Stats(*prof_paths, stream=stream)
+        stats.files = [] # pstats would print one line per merged file
+        stats.sort_stats(sort).print_stats(top)
+    folded_paths = [path for path in paths if path.endswith(StackSampler.suffix)]
+    if folded_paths:
+        self_samples, total_samples = merge_folded_stacks(folded_paths)
+        print(f"{'self':>8} {'total':>8}  function", file=stream)
+        for frame, count in self_samples.most_common(top):
+            print(f"{count:>8} {total_samples[frame]:>8}  {frame}", file=stream)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the request profiles of a directory and print the hottest functions")
+    parser.add_argument('directory', help="POOL_PROFILE_DIR of the server")
+    parser.add_argument('--endpoint', help="e.g. 'query' or 'update_bulk', every endpoint by default")
+    parser.add_argument('--top', type=int, default=20, help="functions printed")
+    parser.add_argument('--sort', default='cumulative', help="pstats sort key of the cProfile profiles, e.g. 'tottime'")
+    args = parser.parse_args()
+    print_report(args.directory, args.endpoint, args.top, args.sort)
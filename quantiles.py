@@ -0,0 +1,121 @@
+import math
+import logging
+import numpy as np
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Quantile formulas shared by the request handlers of api.py and the worker processes of workers.py.
+# They only depend on their arguments, so a query gives the same answer wherever it runs
+
+@timed('calculate_quantile')
+def calculate_quantile(sorted_list, percentile):
+    logger.info("Compute the percentile quantile of the sorted list")
+    
+    total_elements = len(sorted_list)
+    
+    logger.info("Check for special cases to limit computation")
+    
+    if (total_elements == 1) or (sorted_list[0] == sorted_list[-1]) or (percentile == 0):
+        logger.info("Special case")
+        quantile = sorted_list[0]
+    elif percentile == 100:
+        logger.info("Special case")
+        quantile = sorted_list[-1]
+    else:
+        rank = (total_elements - 1) * percentile/ 100
+        left_index = max(0, math.floor(rank))
+        right_index = min(total_elements-1, left_index+1)
+        weight = rank - math.floor(rank)
+        quantile = sorted_list[left_index] * (1-weight) + sorted_list[right_index] * weight
+        
+    return quantile, total_elements
+
+@timed('calculate_quantile')
+def calculate_quantiles(sorted_list, percentiles):
+    logger.info("Compute many percentile quantiles of the sorted list at once")
+    
+    total_elements = len(sorted_list)
+    
+    # vectorized form of the formula in calculate_quantile, evaluated with the same float operations.
+    # Only the two neighbouring elements of every percentile are read, the list is not converted
+    percentile_array = np.asarray(percentiles, dtype=np.float64)
+    rank = (total_elements - 1) * percentile_array/ 100
+    left_index = np.maximum(0, np.floor(rank)).astype(np.int64)
+    right_index = np.minimum(total_elements-1, left_index+1)
+    weight = rank - np.floor(rank)
+    left_values = np.array([sorted_list[i] for i in left_index.tolist()], dtype=np.float64)
+    right_values = np.array([sorted_list[i] for i in right_index.tolist()], dtype=np.float64)
+    quantiles = (left_values * (1-weight) + right_values * weight).tolist()
+    
+    for i, percentile in enumerate(percentiles): # special cases return the stored value itself
+        if (total_elements == 1) or (sorted_list[0] == sorted_list[-1]) or (percentile == 0):
+            quantiles[i] = sorted_list[0]
+        elif percentile == 100:
+            quantiles[i] = sorted_list[-1]
+    return quantiles, total_elements
+
+@timed('build_summary')
+def build_summary(sorted_list, percentiles):
+    logger.info("Precompute the summary of the sorted list")
+    
+    total_elements = len(sorted_list)
+    ranks = {} # the two neighbouring ranks used by calculate_quantile for every percentile of the grid
+    for percentile in percentiles:
+        rank = (total_elements - 1) * percentile/ 100
+        left_index = max(0, math.floor(rank))
+        right_index = min(total_elements-1, left_index+1)
+        ranks[left_index] = sorted_list[left_index]
+        ranks[right_index] = sorted_list[right_index]
+    return {"count": total_elements, "min": sorted_list[0], "max": sorted_list[-1], "ranks": ranks}
+
+@timed('calculate_quantile')
+def calculate_summary_quantile(summary, percentile):
+    logger.info("Compute the percentile quantile from the summary")
+    
+    # same special cases and formula as calculate_quantile, None if the summary lacks one of the two ranks
+    total_elements = summary["count"]
+    if (total_elements == 1) or (summary["min"] == summary["max"]) or (percentile == 0):
+        quantile = summary["min"]
+    elif percentile == 100:
+        quantile = summary["max"]
+    else:
+        rank = (total_elements - 1) * percentile/ 100
+        left_index = max(0, math.floor(rank))
+        right_index = min(total_elements-1, left_index+1)
+        weight = rank - math.floor(rank)
+        if left_index not in summary["ranks"] or right_index not in summary["ranks"]:
+            return None, total_elements
+        quantile = summary["ranks"][left_index] * (1-weight) + summary["ranks"][right_index] * weight
+    
+    return quantile, total_elements
+
+@timed('select_quantile')
+def select_quantile(values_list, percentile):
+    logger.info("Compute the percentile quantile of the unsorted list by selection")
+    
+    total_elements = len(values_list)
+    if total_elements == 1:
+        return values_list[0], total_elements
+    
+    # same special cases and formula as calculate_quantile, sorted_list[i] is found by selection instead of sorting.
+    # Positions are taken from the original list so ints stay ints, ties resolve like the stable sort
+    values_array = np.asarray(values_list, dtype=np.float64)
+    first_index = int(np.argmin(values_array)) # first occurrence, i.e. sorted_list[0]
+    last_index = total_elements - 1 - int(np.argmax(values_array[::-1])) # last occurrence, i.e. sorted_list[-1]
+    
+    if (values_list[first_index] == values_list[last_index]) or (percentile == 0):
+        quantile = values_list[first_index]
+    elif percentile == 100:
+        quantile = values_list[last_index]
+    else:
+        rank = (total_elements - 1) * percentile/ 100
+        left_index = max(0, math.floor(rank))
+        right_index = min(total_elements-1, left_index+1)
+        weight = rank - math.floor(rank)
+        partitioned_indexes = np.argpartition(values_array, (left_index, right_index))
+        left_value = values_list[int(partitioned_indexes[left_index])]
+        right_value = values_list[int(partitioned_indexes[right_index])]
+        quantile = left_value * (1-weight) + right_value * weight
+        
+    return quantile, total_elements
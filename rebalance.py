@@ -0,0 +1,96 @@
+import os
+import shutil
+import argparse
+import logging
+import pandas as pd
+from storage import get_storage, does_path_exist, POOL_FILE_SUFFIX
+from sharding import get_sharding, save_shard_map, SizeBoundedSharding
+from sketch import SketchStore, SKETCH_DIR
+from windows import WINDOW_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Offline re-sharding: copy every pool of a data directory into a new data directory laid out
+# with another sharding, then point POOL_DATA_DIR / POOL_SHARDING at it. Stop the API first.
+
+
+def get_pool_sizes(storage):
+    logger.info("Measure the stored size of every pool")
+    pool_sizes = {}
+    for path in storage.get_shard_paths():
+        if storage.name == 'csv':
+            df = pd.read_csv(path, usecols=["poolId", "poolValues"]) # the values are not parsed
+            pool_sizes.update(zip(df["poolId"].tolist(), df["poolValues"].str.len().tolist()))
+        else:
+            for file_name in os.listdir(path):
+                if file_name.endswith(POOL_FILE_SUFFIX):
+                    pool_sizes[int(os.path.splitext(file_name)[0])] = os.path.getsize(os.path.join(path, file_name))
+    return pool_sizes
+
+def get_shard_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+    return os.path.getsize(path)
+
+def plan_size_bounded_shards(pool_sizes, max_shard_bytes):
+    # consecutive poolIds packed into shards of at most max_shard_bytes, a larger pool gets a shard of its own.
+    # Oversized shards are split and tiny ones merged with their neighbours
+    shards = []
+    shard_bytes = 0
+    for id in sorted(pool_sizes):
+        if not shards or (shard_bytes > 0 and shard_bytes + pool_sizes[id] > max_shard_bytes):
+            shards.append((id, 's' + str(len(shards))))
+            shard_bytes = 0
+        shard_bytes += pool_sizes[id]
+    return shards
+
+def rebalance(source_dir, target_dir, storage_name='csv', sharding_name='size', max_shard_bytes=10**6, range_size=1000, total_shards=256):
+    logger.info(f"Rebalance {source_dir} into {target_dir} with '{sharding_name}' sharding")
+    if os.path.isdir(target_dir) and os.listdir(target_dir):
+        raise ValueError("The target directory must be empty")
+    source = get_storage(storage_name, root=source_dir) # every shard file is read, whatever sharding wrote it
+    if storage_name == 'csv':
+        source.compact_all() # pending shard logs
+    source_shards = source.get_shard_paths()
+
+    if sharding_name == SizeBoundedSharding.name:
+        save_shard_map(target_dir, plan_size_bounded_shards(get_pool_sizes(source), max_shard_bytes))
+    os.makedirs(target_dir, exist_ok=True)
+    target_sharding = get_sharding(sharding_name, target_dir, range_size=range_size, total_shards=total_shards)
+    target = get_storage(storage_name, root=target_dir, sharding=target_sharding)
+
+    total_pools = 0
+    for path in source_shards:
+        df = source.load_data(path)
+        total_pools += len(df)
+        for target_path, target_df in df.groupby([target.get_path_by_id(id) for id in df.index], sort=False):
+            if storage_name == 'csv' and does_path_exist(target_path):
+                target_df = pd.concat([target.load_data(target_path), target_df])
+            target.save_data(target_path, target_df)
+    SketchStore(source_dir).split_shard_files()
+    for directory in (SKETCH_DIR, WINDOW_DIR): # one file or directory per pool, whatever the sharding
+        if os.path.isdir(os.path.join(source_dir, directory)):
+            shutil.copytree(os.path.join(source_dir, directory), os.path.join(target_dir, directory))
+
+    shard_bytes = [get_shard_bytes(path) for path in target.get_shard_paths()]
+    summary = {"pools": total_pools,
+               "source_shards": len(source_shards),
+               "source_largest_shard_bytes": max((get_shard_bytes(path) for path in source_shards), default=0),
+               "target_shards": len(shard_bytes),
+               "target_largest_shard_bytes": max(shard_bytes, default=0)}
+    logger.info(f"Rebalanced {summary}")
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copy a data directory into a new one with another sharding")
+    parser.add_argument('--source', default='data', help="data directory to read")
+    parser.add_argument('--target', required=True, help="new data directory, must be empty")
+    parser.add_argument('--storage', default='csv', choices=['csv', 'binary'])
+    parser.add_argument('--sharding', default='size', choices=['legacy', 'range', 'hash', 'size'])
+    parser.add_argument('--max-shard-bytes', type=int, default=10**6, help="shard size limit of the 'size' sharding")
+    parser.add_argument('--range-size', type=int, default=1000, help="poolIds per shard of the 'range' sharding")
+    parser.add_argument('--hash-shards', type=int, default=256, help="number of shards of the 'hash' sharding")
+    args = parser.parse_args()
+    summary = rebalance(args.source, args.target, args.storage, args.sharding, args.max_shard_bytes, args.range_size, args.hash_shards)
+    print(summary)
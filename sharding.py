@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import zlib
+import bisect
+import logging
+import threading
+from locks import replace_file
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = 'data'
+SHARD_MAP_FILE = 'shards.json'
+
+
+class LegacySharding(object):
+    # abs(poolId) // 1000, the layout of the original data directory
+    name = 'legacy'
+
+    def get_shard(self, id):
+        return str(abs(id)//1000)
+
+
+class RangeSharding(object):
+    # poolId // range_size, so poolId 5 and poolId -5 are in different shards
+    name = 'range'
+
+    def __init__(self, range_size=1000):
+        self.range_size = range_size
+
+    def get_shard(self, id):
+        return str(id // self.range_size)
+
+
+class HashSharding(object):
+    # crc32 of the poolId, spreads the pools of a busy poolId range over every shard
+    name = 'hash'
+
+    def __init__(self, total_shards=256):
+        self.total_shards = total_shards
+
+    def get_shard(self, id):
+        return 'h' + str(zlib.crc32(str(id).encode()) % self.total_shards)
+
+
+class SizeBoundedSharding(object):
+    # Contiguous poolId ranges read from <root>/shards.json, written by rebalance.py so that every
+    # shard holds about the same amount of data. Shard i holds the poolIds from its start to the
+    # start of shard i + 1, the first shard also holds every smaller poolId. Without a shard map
+    # it falls back to range sharding. The map is reloaded when it changes
+    name = 'size'
+    RELOAD_INTERVAL = 1.0 # seconds between checks of the shard map
+
+    def __init__(self, root=DATA_DIR, range_size=1000):
+        self.path = os.path.join(root, SHARD_MAP_FILE)
+        self.fallback = RangeSharding(range_size)
+        self.starts = []
+        self.names = []
+        self.stamp = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.checked_at is not None and now - self.checked_at < self.RELOAD_INTERVAL:
+                return
+            self.checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self.starts, self.names, self.stamp = [], [], None
+                return
+            stamp = stat.st_mtime_ns, stat.st_size
+            if stamp == self.stamp:
+                return
+            logger.info("Load shard map")
+            with open(self.path) as f:
+                shards = sorted(json.load(f)["shards"], key=lambda shard: shard["start"])
+            self.starts = [shard["start"] for shard in shards]
+            self.names = [shard["name"] for shard in shards]
+            self.stamp = stamp
+
+    def get_shard(self, id):
+        self.load()
+        if not self.starts:
+            return self.fallback.get_shard(id)
+        return self.names[max(0, bisect.bisect_right(self.starts, id) - 1)]
+
+def save_shard_map(root, shards):
+    # shards: list of (start poolId, shard name)
+    os.makedirs(root, exist_ok=True)
+    data = {"shards": [{"start": start, "name": name} for start, name in shards]}
+    replace_file(os.path.join(root, SHARD_MAP_FILE), lambda f: json.dump(data, f), mode='w')
+
+
+SHARDING_STRATEGIES = {LegacySharding.name: LegacySharding, RangeSharding.name: RangeSharding,
+                       HashSharding.name: HashSharding, SizeBoundedSharding.name: SizeBoundedSharding}
+
+def get_sharding(name='legacy', root=DATA_DIR, range_size=1000, total_shards=256):
+    logger.info(f"Use '{name}' sharding")
+    if name == LegacySharding.name:
+        return LegacySharding()
+    if name == RangeSharding.name:
+        return RangeSharding(range_size)
+    if name == HashSharding.name:
+        return HashSharding(total_shards)
+    if name == SizeBoundedSharding.name:
+        return SizeBoundedSharding(root, range_size)
+    raise ValueError(f"Unknown sharding '{name}', expected one of {sorted(SHARDING_STRATEGIES)}")
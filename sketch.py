@@ -0,0 +1,230 @@
+import os
+import glob
+import json
+import math
+import logging
+import numpy as np
+from locks import ShardLocks, replace_file
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = 'data'
+SKETCH_DIR = 'sketches'
+SKETCH_SUFFIX = '.sketch'
+SHARD_FILE_SUFFIX = '.json' # layout of earlier versions
+POOL_MODES = ('exact', 'sketch', 'both')
+
+
+class DDSketch(object):
+    # Mergeable quantile sketch with a relative error guarantee (DDSketch, Masson et al. 2019).
+    # A value x > 0 is counted in bucket ceil(log_gamma(x)), gamma = (1 + a) / (1 - a), and a bucket
+    # is answered by the value within relative distance a of everything it holds. Negative values
+    # use a second bucket store, zeros are counted apart. The number of buckets grows with
+    # log(max / min) only, not with the number of values
+    def __init__(self, relative_accuracy=0.01, max_buckets=4096):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be in the range (0, 1)")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {} # bucket index -> count
+        self.negative = {} # bucket index of -x -> count
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values_array = np.asarray(values, dtype=np.float64)
+        if values_array.size == 0:
+            return
+        self.count += int(values_array.size)
+        self.min = min(self.min, float(values_array.min()))
+        self.max = max(self.max, float(values_array.max()))
+        self.zero_count += int(np.count_nonzero(values_array == 0))
+        add_to_store(self.positive, self.get_indexes(values_array[values_array > 0]))
+        add_to_store(self.negative, self.get_indexes(-values_array[values_array < 0]))
+        self.collapse()
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative_accuracy can be merged")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.collapse()
+
+    def get_indexes(self, positive_values):
+        return np.ceil(np.log(positive_values) / self.log_gamma).astype(np.int64)
+
+    def get_bucket_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def collapse(self):
+        # merge the buckets of the values closest to zero, the high quantiles keep their accuracy
+        for store in (self.positive, self.negative):
+            if len(store) > self.max_buckets:
+                indexes = sorted(store)
+                lowest_kept = indexes[len(indexes) - self.max_buckets]
+                store[lowest_kept] += sum(store.pop(index) for index in indexes[:len(indexes) - self.max_buckets])
+
+    def get_value_at_rank(self, rank):
+        # approximate value of sorted_list[rank]
+        for index in sorted(self.negative, reverse=True): # most negative first
+            rank -= self.negative[index]
+            if rank < 0:
+                return max(self.min, -self.get_bucket_value(index))
+        rank -= self.zero_count
+        if rank < 0:
+            return 0.0
+        for index in sorted(self.positive):
+            rank -= self.positive[index]
+            if rank < 0:
+                return min(self.max, self.get_bucket_value(index))
+        return self.max
+
+    def quantile(self, percentile):
+        # same rank and interpolation as calculate_quantile, on approximate values
+        if self.count == 0:
+            return None
+        if percentile == 0 or self.min == self.max:
+            return self.min
+        if percentile == 100:
+            return self.max
+        rank = (self.count - 1) * percentile/ 100
+        left_index = max(0, math.floor(rank))
+        right_index = min(self.count-1, left_index+1)
+        weight = rank - math.floor(rank)
+        return self.get_value_at_rank(left_index) * (1-weight) + self.get_value_at_rank(right_index) * weight
+
+    def to_dict(self):
+        return {"relative_accuracy": self.relative_accuracy,
+                "count": self.count,
+                "min": self.min if self.count else None,
+                "max": self.max if self.count else None,
+                "zero_count": self.zero_count,
+                "positive": {str(index): count for index, count in self.positive.items()},
+                "negative": {str(index): count for index, count in self.negative.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.count = data["count"]
+        sketch.min = data["min"] if data["count"] else math.inf
+        sketch.max = data["max"] if data["count"] else -math.inf
+        sketch.zero_count = data["zero_count"]
+        sketch.positive = {int(index): count for index, count in data["positive"].items()}
+        sketch.negative = {int(index): count for index, count in data["negative"].items()}
+        return sketch
+
+def add_to_store(store, indexes):
+    if indexes.size == 0:
+        return
+    unique_indexes, counts = np.unique(indexes, return_counts=True)
+    for index, count in zip(unique_indexes.tolist(), counts.tolist()):
+        store[index] = store.get(index, 0) + count
+
+
+class SketchStore(object):
+    # Mode and sketch of every pool not in 'exact' mode, one JSON file per pool in data/sketches/,
+    # so a lookup or an update only reads the file of its own pool. 'sketch' pools only have a sketch,
+    # 'both' pools also keep their raw values in the pool storage. A pool without a file is in 'exact' mode
+    def __init__(self, root=DATA_DIR, locks=None, relative_accuracy=0.01):
+        self.root = root
+        self.locks = locks if locks is not None else ShardLocks()
+        self.relative_accuracy = relative_accuracy
+
+    def get_pool_path(self, id):
+        return os.path.join(self.root, SKETCH_DIR, str(id) + SKETCH_SUFFIX)
+
+    def get_pool_ids(self):
+        directory = os.path.join(self.root, SKETCH_DIR)
+        return sorted(int(file_name[:-len(SKETCH_SUFFIX)]) for file_name in os.listdir(directory) if file_name.endswith(SKETCH_SUFFIX)) if os.path.isdir(directory) else []
+
+    def read_entry(self, path):
+        # the JSON of a pool file, None for a pool in 'exact' mode, a single failed open.
+        # Pool files are replaced by rename, they are read without a lock
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def load_entry(self, path):
+        entry = self.read_entry(path)
+        return {"mode": entry["mode"], "sketch": DDSketch.from_dict(entry["sketch"])} if entry is not None else None
+
+    def save_entry(self, path, entry):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {"mode": entry["mode"], "sketch": entry["sketch"].to_dict()}
+        replace_file(path, lambda f: json.dump(data, f), mode='w')
+
+    def get_entry(self, id):
+        return self.load_entry(self.get_pool_path(id))
+
+    def get_mode(self, id):
+        entry = self.read_entry(self.get_pool_path(id)) # the sketch itself is not built
+        return entry["mode"] if entry is not None else 'exact'
+
+    def get_modes(self, ids):
+        logger.info("Get the mode of many pools")
+        return {id: self.get_mode(id) for id in ids}
+
+    def get_sketch(self, id):
+        entry = self.get_entry(id)
+        return entry["sketch"] if entry is not None else None
+
+    def set_mode(self, id, mode, pool_values_list=None, relative_accuracy=None):
+        logger.info(f"Set pool mode to '{mode}'")
+        path = self.get_pool_path(id)
+        with self.locks.writing(path):
+            entry = self.load_entry(path)
+            if mode == 'exact':
+                if entry is not None:
+                    os.remove(path)
+                return
+            if entry is not None:
+                entry["mode"] = mode
+            else:
+                sketch = DDSketch(relative_accuracy or self.relative_accuracy)
+                if pool_values_list is not None:
+                    sketch.add(pool_values_list) # the values stored before the pool got a sketch
+                entry = {"mode": mode, "sketch": sketch}
+            self.save_entry(path, entry)
+
+    def add_pools(self, pools):
+        logger.info("Add pool values to the sketches, loading and saving each pool once")
+        statuses = [None] * len(pools)
+        indexes_by_id = {}
+        for i, pool in enumerate(pools):
+            indexes_by_id.setdefault(pool["poolId"], []).append(i)
+        for id, indexes in indexes_by_id.items():
+            path = self.get_pool_path(id)
+            with self.locks.writing(path):
+                entry = self.load_entry(path)
+                for i in indexes:
+                    statuses[i] = "appended" if entry["sketch"].count else "inserted"
+                    entry["sketch"].add(pools[i]["poolValues"])
+                self.save_entry(path, entry)
+        return statuses
+
+    def split_shard_files(self):
+        # sketches saved by earlier versions, one JSON file per shard, are split into pool files once.
+        # Returns the number of shard files split
+        logger.info("Split the shard files of the sketches into pool files")
+        shard_paths = sorted(glob.glob(os.path.join(self.root, SKETCH_DIR, '*' + SHARD_FILE_SUFFIX)))
+        for shard_path in shard_paths:
+            with open(shard_path) as f:
+                entries = json.load(f)
+            for id, entry in entries.items():
+                path = self.get_pool_path(int(id))
+                with self.locks.writing(path):
+                    if not os.path.exists(path): # a pool file written since is newer
+                        replace_file(path, lambda f: json.dump(entry, f), mode='w')
+            os.remove(shard_path)
+        return len(shard_paths)
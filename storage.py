@@ -0,0 +1,1143 @@
+import os
+import ast
+import csv
+import glob
+import json
+import struct
+import logging
+import operator
+import threading
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from locks import ShardLocks, replace_file, fsync_directory
+from sharding import LegacySharding
+from sketch import SKETCH_DIR
+from windows import WINDOW_DIR
+from logs import ValuesSummary
+from metrics import timed, count_bytes_read, count_bytes_written, SHARD_LOAD_BYTES, SORTS, SORTED_VALUES, LOG_SYNC_BATCH
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = 'data'
+
+POOL_FILE_MAGIC = b'POOLF64\x00'
+POOL_FILE_HEADER = struct.Struct('<8sq') # magic, sorted_length
+POOL_FILE_SUFFIX = '.f64'
+VALUE_DTYPE = np.dtype('<f8')
+
+WRITE_MODES = ('rewrite', 'log')
+LOG_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+COMPACTING_SUFFIX = '.compacting'
+APPLIED_SUFFIX = '.applied'
+LOG_SYNC_MODES = ('group', 'none')
+COMMIT_DELAY = 0.001 # seconds the leader of a group commit waits for other appends to join
+SORTED_SUFFIX = '.sorted' # directory of the memory-mapped copies of the large sorted pools of a CSV shard
+MAPPED_DTYPES = {'.i64': np.dtype('<i8'), '.f64': VALUE_DTYPE} # pools of ints only and of floats only
+MMAP_MIN_LENGTH = 10000 # shorter sorted pools are parsed from their CSV row, as fast as mapping a file
+EXPORT_BLOCK_SIZE = 1 << 18 # bytes of a CSV row read at a time when its values are streamed
+NUMPY_SORT_MIN_LENGTH = 1000 # shorter unsorted tails are sorted faster by sorted() than through an array
+EXACT_FLOAT_LIMIT = 2**53 # ints of a smaller magnitude are exact in float64
+
+csv.field_size_limit(2**31 - 1) # the poolValues cell of a large pool is longer than the default 128 KiB
+
+
+def does_path_exist(path):
+    logger.info("Check if given path exists")
+    path_exists = os.path.exists(path)
+    return path_exists
+
+def does_pool_exist(id, list_id):
+    logger.info("Check if poolId exists in the id list")
+    pool_exists = (id in list_id)
+    return pool_exists
+
+def get_path_by_id(id):
+    logger.info("Get file path by poolId")
+    file_path = 'data/' + str(abs(id)//1000) + '.csv'
+    return file_path
+
+@timed('load_data')
+def load_data(path):
+    logger.info("Load file into Dataframe")
+    shard_bytes = os.path.getsize(path)
+    SHARD_LOAD_BYTES.observe(shard_bytes)
+    count_bytes_read(path, shard_bytes)
+    df = pd.read_csv(path, index_col= "poolId")
+    if 'sorted' in df.columns: # shard written with the former 0 / 1 'sorted' label
+        total_elements = df['poolValues'].str.count(',') + 1
+        df['sorted'] = total_elements.where(df['sorted'] == 1, 0)
+        df = df.rename(columns={'sorted': 'sorted_length'})
+    return df
+
+@timed('save_data')
+def save_data(path, df):
+    logger.info("Write Dataframe to path")
+    replace_file(path, lambda f: df.to_csv(f, index=True), mode='w') # atomic rename-on-write
+
+def insert_pool(pool, current_df=None):
+    logger.info("Write new pool data to Dataframe")
+
+    total_elements = len(pool["poolValues"])
+    pool["poolValues"] = str(pool["poolValues"])
+    pool_df = pd.DataFrame([pool]).set_index('poolId')
+    if total_elements == 1:
+        pool_df['sorted_length'] = int(1) # no need to be sorted before calculating quantile
+    else:
+        pool_df['sorted_length'] = int(0) # need to be sorted before calculating quantile
+
+    if current_df is None:
+        new_df = pool_df
+    else:
+        new_df = pd.concat([current_df, pool_df])
+    return new_df
+
+def append_pool_values(pool, df):
+    logger.info("In Dataframe, append poolValues to current poolValues corresponding to given poolId, keep 'sorted_length' of the sorted prefix")
+
+    current_pool = df.loc[pool["poolId"]]
+    current_pool_values_list = parse_pool_values(current_pool["poolValues"]) # safely convert string to list
+
+    new_pool_values_list = current_pool_values_list + pool["poolValues"]
+
+    df.loc[pool['poolId'],'poolValues'] = str(new_pool_values_list) # update values, the sorted prefix is unchanged
+
+    return df
+
+def sort_pool_values(query, df):
+    logger.info("Try sorting pool values for given poolId")
+    queried_pool = df.loc[query["poolId"]]
+
+    queried_pool_values_list = parse_pool_values(queried_pool["poolValues"]) # safely convert string to list
+
+    sorted_length = queried_pool["sorted_length"]
+    if sorted_length < len(queried_pool_values_list):
+        logger.info("Sort pool values list: %s, the first %d values are already sorted, update 'sorted_length'", ValuesSummary(queried_pool_values_list), sorted_length)
+
+        sorted_pool_values_list = merge_sorted_prefix(queried_pool_values_list, sorted_length)
+        df.loc[query['poolId'],['poolValues', 'sorted_length']] = str(sorted_pool_values_list), len(sorted_pool_values_list)
+        df_has_changed = True
+
+        return sorted_pool_values_list, df, df_has_changed # dataframe changed, need to update file
+    else:
+        logger.info("The pool values list is already sorted, no need to do anything")
+        df_has_changed = False
+        return queried_pool_values_list, df, df_has_changed # no need to update file
+
+@timed('parse_pool_values')
+def parse_pool_values(pool_values):
+    # a stringified list of ints and floats is valid JSON, json.loads keeps every int and float
+    # as ast.literal_eval does, about 20 times faster. Anything else still goes to ast.literal_eval
+    try:
+        return json.loads(pool_values)
+    except ValueError:
+        return ast.literal_eval(pool_values)
+
+@timed('sort')
+def merge_sorted_prefix(values, sorted_length):
+    # sort only the values after the sorted prefix, then merge them into the prefix in linear time
+    SORTED_VALUES.inc(len(values) - sorted_length)
+    if isinstance(values, np.ndarray):
+        SORTS.labels('numpy').inc()
+        sorted_prefix = values[:sorted_length]
+        sorted_tail = np.sort(values[sorted_length:])
+        return np.insert(sorted_prefix, np.searchsorted(sorted_prefix, sorted_tail, side='right'), sorted_tail)
+    if len(values) - sorted_length < max(NUMPY_SORT_MIN_LENGTH, len(values) // 4):
+        SORTS.labels('timsort').inc()
+        return sorted(values) # Timsort takes the sorted prefix as a single run, so this already costs a tail sort plus a linear merge
+    
+    # same stable order as sorted(), found on a float64 copy. The list elements themselves are
+    # returned so ints stay ints. nan and ints float64 cannot hold exactly keep sorted()
+    try:
+        values_array = np.asarray(values, dtype=np.float64)
+    except OverflowError:
+        SORTS.labels('timsort').inc()
+        return sorted(values)
+    if not (np.abs(values_array) < EXACT_FLOAT_LIMIT).all():
+        SORTS.labels('timsort').inc()
+        return sorted(values)
+    SORTS.labels('numpy_argsort').inc()
+    tail_order = sorted_length + np.argsort(values_array[sorted_length:], kind='stable')
+    order = np.insert(np.arange(sorted_length), np.searchsorted(values_array[:sorted_length], values_array[tail_order], side='right'), tail_order)
+    return list(operator.itemgetter(*order.tolist())(values))
+
+
+class CsvStorage(object):
+    # One CSV file per shard, poolValues kept as a stringified Python list.
+    # In 'log' write mode, /update only appends the new values to data/<shard>.log and
+    # the log is merged into the CSV file later by compact_shard.
+    # Writers hold the shard write lock for the whole read-modify-write, readers the read lock;
+    # a sort found while reading is saved afterwards, only if the shard did not change meanwhile
+    name = 'csv'
+
+    def __init__(self, write_mode='rewrite', locks=None, root=DATA_DIR, sharding=None, mmap_min_length=MMAP_MIN_LENGTH, log_sync='group', commit_delay=COMMIT_DELAY):
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"Unknown write mode '{write_mode}', expected one of {WRITE_MODES}")
+        if log_sync not in LOG_SYNC_MODES:
+            raise ValueError(f"Unknown log sync mode '{log_sync}', expected one of {LOG_SYNC_MODES}")
+        self.write_mode = write_mode
+        self.group_commit = GroupCommit(commit_delay) if log_sync == 'group' else None # None acknowledges appends before they are durable
+        self.log_pool_ids = {} # log path -> (file stamp, poolIds of its records)
+        self.locks = locks if locks is not None else ShardLocks()
+        self.root = root
+        self.sharding = sharding if sharding is not None else LegacySharding()
+        self.indexes = {} # path -> shard index, see get_index
+        self.mmap_min_length = mmap_min_length # sorted pools this long are read from a memory-mapped copy, None disables it
+        self.unmapped_pools = {} # (path, poolId) -> value count of the sorted pools mixing ints and floats, never mapped
+
+    def get_path_by_id(self, id):
+        return os.path.join(self.root, self.sharding.get_shard(id) + '.csv')
+
+    def get_shard_paths(self):
+        return sorted(glob.glob(os.path.join(self.root, '*.csv')))
+
+    def get_log_path(self, path):
+        return os.path.splitext(path)[0] + LOG_SUFFIX
+
+    def get_index_path(self, path):
+        return os.path.splitext(path)[0] + INDEX_SUFFIX
+
+    def get_sorted_dir(self, path):
+        return os.path.splitext(path)[0] + SORTED_SUFFIX
+
+    def load_data(self, path):
+        return load_data(path)
+
+    @timed('save_data')
+    def save_data(self, path, df):
+        logger.info("Write Dataframe to path and update the shard index")
+        self.save_csv_bytes(path, df.to_csv(index=True).encode())
+
+    def save_csv_bytes(self, path, csv_bytes):
+        replace_file(path, lambda f: f.write(csv_bytes)) # atomic rename-on-write
+        self.save_index(path, build_shard_index(csv_bytes))
+
+    def save_index(self, path, shard_index):
+        # the index remembers the stamp of the CSV file it describes, any other writer makes it stale
+        shard_index["stamp"] = get_file_stamp(path)
+        replace_file(self.get_index_path(path), lambda f: json.dump(shard_index, f), mode='w', fsync=False) # rebuilt if lost
+        self.indexes[path] = shard_index
+
+    def get_index(self, path):
+        # {"stamp", "values_column", "pools": {poolId: [byte offset, byte length, value count, sorted_length]},
+        # "checksums": {poolId: CRC-32 of the row}} of the CSV rows, None if the shard does not exist.
+        # The caller holds a shard lock
+        file_stamp = get_file_stamp(path)
+        if file_stamp is None:
+            return None
+        shard_index = self.indexes.get(path)
+        if shard_index is not None and shard_index["stamp"] == file_stamp:
+            return shard_index
+        shard_index = read_shard_index(self.get_index_path(path))
+        if shard_index is not None and shard_index["stamp"] == file_stamp:
+            self.indexes[path] = shard_index
+            return shard_index
+
+        logger.info("Shard index is missing or stale, rebuild it")
+        with open(path, 'rb') as f:
+            csv_bytes = f.read()
+        count_bytes_read(path, len(csv_bytes))
+        if get_file_stamp(path) != file_stamp: # replaced while reading, by a writer of another process
+            return self.get_index(path)
+        self.save_index(path, build_shard_index(csv_bytes))
+        return self.indexes[path]
+
+    @timed('read_pool')
+    def read_indexed_pool_values(self, path, shard_index, id):
+        logger.info("Read pool values with one seek")
+        offset, length = shard_index["pools"][id][:2]
+        count_bytes_read(path, length)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            row = next(csv.reader([f.read(length).decode()]))
+        return parse_pool_values(row[shard_index["values_column"]]) # safely convert string to list
+
+    def read_indexed_sorted_pool_values(self, path, shard_index, id):
+        # A large sorted pool is copied once to a fixed-width file named after the checksum of its row,
+        # then every query maps it and reads only the elements it needs. Any rewrite of the row, an
+        # append or a pool recreated with as many values, changes the checksum and the copy is made again
+        count, checksum = shard_index["pools"][id][2], shard_index["checksums"][id]
+        if self.mmap_min_length is None or count < self.mmap_min_length or self.unmapped_pools.get((path, id)) == count:
+            return self.read_indexed_pool_values(path, shard_index, id)
+        mapped_values = read_mapped_pool(self.get_sorted_dir(path), id, count, checksum)
+        if mapped_values is not None:
+            return mapped_values
+
+        sorted_pool_values_list = self.read_indexed_pool_values(path, shard_index, id)
+        if not write_mapped_pool(self.get_sorted_dir(path), id, sorted_pool_values_list, checksum):
+            self.unmapped_pools[(path, id)] = count
+        return sorted_pool_values_list
+
+    def update_pool(self, pool):
+        if self.write_mode == 'log':
+            return self.append_log(pool)
+
+        logger.info("Insert or append pool in CSV storage")
+        file_path = self.get_path_by_id(pool['poolId'])
+        with self.locks.writing(file_path):
+            if not does_path_exist(file_path):
+                new_df = insert_pool(pool)
+                self.save_data(file_path, new_df)
+                logger.info('Successfully inserted new pool')
+                return "inserted"
+
+            df_file_path = self.load_data(file_path)
+            if does_pool_exist(pool["poolId"], df_file_path.index.values): #append
+                new_df = append_pool_values(pool, df_file_path)
+                self.save_data(file_path, new_df)
+                logger.info('Successfully appended pool')
+                return "appended"
+            else:
+                new_df = insert_pool(pool, df_file_path) #insert
+                self.save_data(file_path, new_df)
+                logger.info('Successfully inserted new pool')
+                return "inserted"
+
+    def update_pools(self, pools):
+        logger.info("Insert or append many pools in CSV storage, loading and saving each shard once")
+        statuses = [None] * len(pools)
+        pending_syncs = [] # appended logs, made durable together once every shard lock is released
+        for file_path, indexes in group_indexes_by_path(pools, self.get_path_by_id).items():
+            shard_pools = [pools[i] for i in indexes]
+            with self.locks.writing(file_path):
+                if self.write_mode == 'log':
+                    shard_statuses = get_pool_statuses(shard_pools, self.get_pool_ids(file_path))
+                    pending_syncs.append(self.write_log_records(file_path, shard_pools))
+                else:
+                    current_df = self.load_data(file_path) if does_path_exist(file_path) else None
+                    shard_statuses = get_pool_statuses(shard_pools, current_df.index.values if current_df is not None else [])
+                    self.save_data(file_path, apply_pools(shard_pools, current_df))
+            for i, status in zip(indexes, shard_statuses):
+                statuses[i] = status
+        for pending_sync in pending_syncs:
+            self.wait_durable(*pending_sync)
+        logger.info('Successfully updated %d pools', len(pools))
+        return statuses
+
+    def append_log(self, pool):
+        logger.info("Append pool values to shard log")
+        file_path = self.get_path_by_id(pool['poolId'])
+        with self.locks.writing(file_path): # the status must not race with another append or a compaction
+            pool_exists = does_pool_exist(pool["poolId"], self.get_pool_ids(file_path))
+            pending_sync = self.write_log_records(file_path, [pool])
+        self.wait_durable(*pending_sync) # outside the lock, so appends to the same shard join the group commit
+
+        if pool_exists:
+            logger.info('Successfully appended pool')
+            return "appended"
+        logger.info('Successfully inserted new pool')
+        return "inserted"
+
+    def get_pool_ids(self, path):
+        logger.info("Get poolIds stored in shard and its log")
+        pool_ids = set()
+        shard_index = self.get_index(path)
+        if shard_index is not None:
+            pool_ids.update(shard_index["pools"])
+
+        log_path = self.get_log_path(path)
+        for segment_path in (log_path + COMPACTING_SUFFIX, log_path):
+            pool_ids.update(self.get_log_pool_ids(segment_path))
+        return pool_ids
+
+    def get_log_pool_ids(self, log_path):
+        # reread only when the log was written by another process, appends of this one update the set
+        stamp = get_file_stamp(log_path)
+        if stamp is None:
+            return set()
+        cached = self.log_pool_ids.get(log_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        pool_ids = set(record["poolId"] for record in read_log_records(log_path))
+        self.log_pool_ids[log_path] = (stamp, pool_ids)
+        return pool_ids
+
+    def write_log_records(self, path, pools):
+        # the caller holds the shard write lock. Returns what wait_durable needs once the lock is released
+        log_path = self.get_log_path(path)
+        pool_ids = self.get_log_pool_ids(log_path)
+        is_new_log = not does_path_exist(log_path)
+        fd = append_log_records(log_path, pools, keep_open=self.group_commit is not None)
+        self.log_pool_ids[log_path] = (get_file_stamp(log_path), pool_ids | set(pool["poolId"] for pool in pools))
+        return fd, (os.path.dirname(log_path) or '.') if is_new_log else None
+
+    def wait_durable(self, fd, new_file_directory=None):
+        if self.group_commit is not None:
+            self.group_commit.wait_durable(fd, new_file_directory)
+
+    def compact_shard(self, path):
+        logger.info("Merge shard log into shard file")
+        # The caller holds the shard write lock. Before the shard is replaced, the checksums of the
+        # frozen segment and of the new shard are saved to <segment>.applied: after a crash between the
+        # replace and the removal of the segment, the segment is recognized and not applied twice
+        log_path = self.get_log_path(path)
+        segment_path = log_path + COMPACTING_SUFFIX
+        applied_path = segment_path + APPLIED_SUFFIX
+        if does_path_exist(applied_path):
+            if does_path_exist(segment_path) and does_path_exist(path) and read_checksum_file(applied_path) == (get_file_checksum(segment_path), get_file_checksum(path)):
+                logger.warning("Log segment %s was merged before a crash, remove it", segment_path)
+                self.remove_segment(segment_path, applied_path)
+            else:
+                os.remove(applied_path) # the crash happened before the shard was replaced, or after the segment was removed
+        if does_path_exist(log_path) and not does_path_exist(segment_path):
+            os.replace(log_path, segment_path) # freeze the log, new records go to a fresh one
+
+        records = read_log_records(segment_path)
+        if not records:
+            return False
+
+        current_df = self.load_data(path) if does_path_exist(path) else None
+        csv_bytes = apply_pools(records, current_df).to_csv(index=True).encode()
+        replace_file(applied_path, lambda f: f.write(f"{get_file_checksum(segment_path)} {get_checksum(csv_bytes)}"), mode='w')
+        self.save_csv_bytes(path, csv_bytes)
+        self.remove_segment(segment_path, applied_path)
+        logger.info('Successfully merged %d log records', len(records))
+        return True
+
+    def remove_segment(self, segment_path, applied_path):
+        os.remove(segment_path)
+        fsync_directory(os.path.dirname(segment_path) or '.') # the segment is gone for good before its marker
+        os.remove(applied_path)
+
+    def recover(self):
+        # replays the logs left by a stopped or crashed server, once at startup: a record torn by the
+        # crash is cut, then every log is merged into its shard
+        logger.info("Recover shard logs")
+        for log_path in glob.glob(os.path.join(self.root, '*' + LOG_SUFFIX)) + glob.glob(os.path.join(self.root, '*' + LOG_SUFFIX + COMPACTING_SUFFIX)):
+            with self.locks.writing(log_path.split(LOG_SUFFIX)[0] + '.csv'):
+                repair_log(log_path)
+        return self.compact_all()
+
+    def compact_all(self):
+        logger.info("Merge every shard log")
+        log_paths = glob.glob(os.path.join(self.root, '*' + LOG_SUFFIX)) + glob.glob(os.path.join(self.root, '*' + LOG_SUFFIX + COMPACTING_SUFFIX))
+        shard_paths = sorted(set(log_path.split(LOG_SUFFIX)[0] + '.csv' for log_path in log_paths))
+        for path in shard_paths:
+            with self.locks.writing(path):
+                self.compact_shard(path)
+        return len(shard_paths)
+
+    def merge_log(self, path):
+        # the query sees every acknowledged update
+        if self.write_mode != 'log':
+            return
+        log_path = self.get_log_path(path)
+        if does_path_exist(log_path) or does_path_exist(log_path + COMPACTING_SUFFIX):
+            with self.locks.writing(path):
+                self.compact_shard(path)
+
+    def save_if_unchanged(self, path, df, shard_stamp):
+        # the shard stamp after the save, None if the shard changed since it was read. An append to
+        # the shard log does not prevent the save, the stamp read with the values is returned then
+        with self.locks.writing(path):
+            if get_file_stamp(path) != shard_stamp[0]:
+                logger.info("Shard changed since it was read, do not save the sort")
+                return None
+            self.save_data(path, df)
+            saved_stamp = self.get_shard_stamp(path)
+            return saved_stamp if saved_stamp[1] == shard_stamp[1] else shard_stamp
+
+    def get_sorted_pool_values(self, id):
+        logger.info("Get sorted pool values from CSV storage")
+        return self.get_stamped_sorted_pool_values(id)[0]
+
+    def get_stamped_sorted_pool_values(self, id):
+        # the sorted values and the stamp of the shard they were read from, or saved to
+        file_path = self.get_path_by_id(id)
+        self.merge_log(file_path)
+        with self.locks.reading(file_path):
+            stamp = self.get_shard_stamp(file_path)
+            sorted_pool_values_list, new_df = self.sort_stored_pool_values(file_path, id)
+        if new_df is not None:
+            stamp = self.save_if_unchanged(file_path, new_df, stamp) or stamp
+        return sorted_pool_values_list, stamp
+
+    def get_sorted_pools_values(self, ids):
+        logger.info("Get sorted values of many pools from CSV storage, loading each shard once")
+        return {id: sorted_pool_values_list for id, (sorted_pool_values_list, stamp) in self.get_stamped_sorted_pools_values(ids).items()}
+
+    def get_stamped_sorted_pools_values(self, ids):
+        # {poolId: (sorted values, stamp of their shard)}
+        stamped_pools_values = {}
+        for file_path, shard_ids in group_ids_by_path(ids, self.get_path_by_id).items():
+            self.merge_log(file_path)
+            with self.locks.reading(file_path):
+                stamp = self.get_shard_stamp(file_path)
+                shard_pools_values, new_df = self.sort_stored_pools_values(file_path, shard_ids)
+            if new_df is not None:
+                stamp = self.save_if_unchanged(file_path, new_df, stamp) or stamp # a single save for every pool sorted in this shard
+            stamped_pools_values.update((id, (sorted_pool_values_list, stamp)) for id, sorted_pool_values_list in shard_pools_values.items())
+        return stamped_pools_values
+
+    def sort_stored_pools_values(self, file_path, ids):
+        shard_index = self.get_index(file_path)
+        if shard_index is None:
+            return {}, None
+        ids = [id for id in ids if id in shard_index["pools"]] # missing pools never touch the shard
+        if all(is_indexed_pool_sorted(shard_index, id) for id in ids):
+            return {id: self.read_indexed_sorted_pool_values(file_path, shard_index, id) for id in ids}, None
+
+        df_file_path = self.load_data(file_path)
+        sorted_pools_values = {}
+        df_has_changed = False
+        for id in ids:
+            if does_pool_exist(id, df_file_path.index.values):
+                sorted_pools_values[id], df_file_path, pool_has_changed = sort_pool_values({"poolId": id}, df_file_path)
+                df_has_changed = df_has_changed or pool_has_changed
+        return sorted_pools_values, (df_file_path if df_has_changed else None)
+
+    def get_pool_values(self, id):
+        logger.info("Get pool values from CSV storage without sorting them")
+        file_path = self.get_path_by_id(id)
+        self.merge_log(file_path)
+        with self.locks.reading(file_path):
+            return self.read_stored_pool_values(file_path, id)
+
+    def get_pool_counts(self, id):
+        # (value count, sorted_length) from the shard index without reading the values, (None, None) for
+        # a missing pool. Values still in the shard log are not counted, it only chooses where a query runs
+        file_path = self.get_path_by_id(id)
+        with self.locks.reading(file_path):
+            shard_index = self.get_index(file_path)
+        if shard_index is None or id not in shard_index["pools"]:
+            return None, None
+        return shard_index["pools"][id][2], shard_index["pools"][id][3]
+
+    def get_unsorted_pools(self, path):
+        # {poolId: unsorted values} of a shard, from its index. Values still in the shard log are not counted
+        with self.locks.reading(path):
+            shard_index = self.get_index(path)
+        if shard_index is None:
+            return {}
+        return {id: total_elements - sorted_length for id, (offset, length, total_elements, sorted_length) in shard_index["pools"].items() if sorted_length < total_elements}
+
+    def sort_shard(self, path):
+        # sorts every unsorted pool of a shard with a single rewrite, like the queries sort it:
+        # under the read lock, saved only if no update changed the shard meanwhile
+        self.merge_log(path)
+        with self.locks.reading(path):
+            shard_stamp = self.get_shard_stamp(path)
+            shard_index = self.get_index(path)
+            ids = [id for id in shard_index["pools"] if not is_indexed_pool_sorted(shard_index, id)] if shard_index is not None else []
+            if not ids:
+                return 0
+            _, new_df = self.sort_stored_pools_values(path, ids)
+        if new_df is None or not self.save_if_unchanged(path, new_df, shard_stamp):
+            return 0
+        if self.mmap_min_length is not None:
+            with self.locks.reading(path): # the memory-mapped copies of the large pools, built now rather than by their next query
+                shard_index = self.get_index(path)
+                for id in ids:
+                    if shard_index is not None and id in shard_index["pools"] and is_indexed_pool_sorted(shard_index, id):
+                        self.read_indexed_sorted_pool_values(path, shard_index, id)
+        return len(ids)
+
+    def get_stored_pool_ids(self, path):
+        # sorted poolIds of a shard, its log merged first
+        self.merge_log(path)
+        with self.locks.reading(path):
+            shard_index = self.get_index(path)
+        return sorted(shard_index["pools"]) if shard_index is not None else []
+
+    def iter_pool_values(self, id, chunk_size):
+        # the values of a pool in stored order, chunk_size at a time, without parsing the whole row.
+        # The shard is opened under the read lock: a rewrite renames a new file over it, the open one is unchanged
+        file_path = self.get_path_by_id(id)
+        self.merge_log(file_path)
+        with self.locks.reading(file_path):
+            shard_index = self.get_index(file_path)
+            if shard_index is None or id not in shard_index["pools"]:
+                return
+            offset, length = shard_index["pools"][id][:2]
+            f = open(file_path, 'rb')
+        with f:
+            f.seek(offset)
+            yield from iter_row_values(f, length, chunk_size)
+
+    def read_stored_pool_values(self, file_path, id):
+        shard_index = self.get_index(file_path)
+        if shard_index is None or id not in shard_index["pools"]:
+            return None, None
+        if is_indexed_pool_sorted(shard_index, id):
+            return self.read_indexed_sorted_pool_values(file_path, shard_index, id), shard_index["pools"][id][3]
+        return self.read_indexed_pool_values(file_path, shard_index, id), shard_index["pools"][id][3]
+
+    def sort_stored_pool_values(self, file_path, id):
+        # sorted values and the Dataframe to save, None if the pool was already sorted
+        shard_index = self.get_index(file_path)
+        if shard_index is None or id not in shard_index["pools"]:
+            return None, None
+        if is_indexed_pool_sorted(shard_index, id):
+            logger.info("The pool values list is already sorted, no need to do anything")
+            return self.read_indexed_sorted_pool_values(file_path, shard_index, id), None
+
+        df_file_path = self.load_data(file_path) # the sort is saved by rewriting the shard
+
+        sorted_pool_values_list, new_df, df_has_changed = sort_pool_values({"poolId": id}, df_file_path) # try sorting poolValues list
+        return sorted_pool_values_list, (new_df if df_has_changed else None)
+
+    def read_sorted_pool_values(self, id):
+        # (sorted values, is_dirty, stamp), the stamp is read under the same lock as the values
+        logger.info("Get sorted pool values from CSV storage without saving the sort")
+        file_path = self.get_path_by_id(id)
+        self.merge_log(file_path)
+        with self.locks.reading(file_path):
+            stamp = self.get_shard_stamp(file_path)
+            sorted_pool_values_list, new_df = self.sort_stored_pool_values(file_path, id)
+        return sorted_pool_values_list, new_df is not None, stamp
+
+    def save_sorted_pool_values(self, id, sorted_pool_values_list, stamp=None):
+        # the stamp of the saved shard, None if the pool changed since it was sorted
+        logger.info("Save sorted pool values, update 'sorted_length'")
+        file_path = self.get_path_by_id(id)
+        with self.locks.writing(file_path):
+            if stamp is not None and self.get_shard_stamp(file_path) != stamp:
+                logger.info("Pool changed since it was sorted, do not save the sort")
+                return None
+            df_file_path = self.load_data(file_path)
+            df_file_path.loc[id, ['poolValues', 'sorted_length']] = str(sorted_pool_values_list), len(sorted_pool_values_list)
+            self.save_data(file_path, df_file_path)
+            return self.get_shard_stamp(file_path)
+
+    def get_file_stamp(self, id):
+        return self.get_shard_stamp(self.get_path_by_id(id))
+
+    def get_shard_stamp(self, path):
+        # changes whenever the shard file or its log is written
+        return get_file_stamp(path), get_file_stamp(self.get_log_path(path))
+
+
+def build_shard_index(csv_bytes):
+    logger.info("Index the rows of a CSV shard")
+    lines = csv_bytes.splitlines(keepends=True)
+    header = next(csv.reader([lines[0].decode()]))
+    values_column = header.index("poolValues")
+    pools = {}
+    checksums = {}
+    offset = len(lines[0])
+    for line in lines[1:]:
+        row = next(csv.reader([line.decode()]))
+        total_elements = row[values_column].count(',') + 1
+        if "sorted_length" in header:
+            sorted_length = int(row[header.index("sorted_length")])
+        else: # shard written with the former 0 / 1 'sorted' label
+            sorted_length = total_elements if row[header.index("sorted")] == '1' else 0
+        pools[int(row[0])] = [offset, len(line), total_elements, sorted_length]
+        checksums[int(row[0])] = zlib.crc32(line)
+        offset += len(line)
+    return {"values_column": values_column, "pools": pools, "checksums": checksums}
+
+def iter_row_values(f, length, chunk_size, block_size=EXPORT_BLOCK_SIZE):
+    # parses the poolValues list of the CSV row of length bytes at the position of f, block by block.
+    # Values are numbers, so the list is the text between the first '[' and the next ']' of the row
+    remaining = length
+    tail = b''
+    values = []
+    in_list = False
+    while remaining > 0:
+        block = f.read(min(block_size, remaining))
+        if not block:
+            break
+        count_bytes_read(f.name, len(block))
+        remaining -= len(block)
+        data = tail + block
+        if not in_list:
+            start = data.find(b'[')
+            if start < 0:
+                tail = b''
+                continue
+            data = data[start + 1:]
+            in_list = True
+        end = data.find(b']')
+        if end >= 0:
+            complete, tail, remaining = data[:end], b'', 0
+        else:
+            cut = data.rfind(b',') # the last value of the block may be cut, it waits for the next block
+            complete, tail = (data[:cut], data[cut + 1:]) if cut >= 0 else (b'', data)
+        if complete.strip():
+            values += parse_pool_values('[' + complete.decode() + ']')
+        while len(values) >= chunk_size:
+            yield values[:chunk_size]
+            values = values[chunk_size:]
+    if values:
+        yield values
+
+def read_shard_index(path):
+    try:
+        with open(path) as f:
+            shard_index = json.load(f)
+    except (FileNotFoundError, ValueError): # missing, or torn by a crash
+        return None
+    if "checksums" not in shard_index: # written before the rows had checksums
+        return None
+    shard_index["stamp"] = tuple(shard_index["stamp"]) if shard_index.get("stamp") else None
+    shard_index["pools"] = {int(id): entry for id, entry in shard_index["pools"].items()}
+    shard_index["checksums"] = {int(id): checksum for id, checksum in shard_index["checksums"].items()}
+    return shard_index
+
+def is_indexed_pool_sorted(shard_index, id):
+    total_elements, sorted_length = shard_index["pools"][id][2:]
+    return sorted_length >= total_elements
+
+def group_ids_by_path(ids, get_path_by_id):
+    # distinct poolIds grouped by the file that stores them, in order of first appearance
+    ids_by_path = {}
+    for id in dict.fromkeys(ids):
+        ids_by_path.setdefault(get_path_by_id(id), []).append(id)
+    return ids_by_path
+
+def group_indexes_by_path(pools, get_path_by_id):
+    # positions of the pools grouped by the file that stores them
+    indexes_by_path = {}
+    for i, pool in enumerate(pools):
+        indexes_by_path.setdefault(get_path_by_id(pool["poolId"]), []).append(i)
+    return indexes_by_path
+
+def get_file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def append_log_record(path, pool):
+    append_log_records(path, [pool])
+
+@timed('append')
+def append_log_records(path, pools, keep_open=False):
+    # a single write of whole lines, so concurrent appenders never interleave records.
+    # keep_open returns a descriptor of the log for GroupCommit, which closes it
+    records = ''.join(json.dumps(pool) + '\n' for pool in pools)
+    with open(path, 'a') as f:
+        f.write(records)
+        fd = os.dup(f.fileno()) if keep_open else None
+    count_bytes_written(path, len(records))
+    return fd
+
+def repair_log(path):
+    # cuts a record torn by a crash, the next append would otherwise be glued to it
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            logger.warning("Cut %d bytes of a torn record at the end of %s", len(data) - end, path)
+            f.truncate(end)
+            os.fsync(f.fileno())
+
+def get_checksum(data):
+    return f"{len(data)}:{zlib.crc32(data)}"
+
+def get_file_checksum(path):
+    with open(path, 'rb') as f:
+        return get_checksum(f.read())
+
+def read_checksum_file(path):
+    with open(path) as f:
+        return tuple(f.read().split())
+
+def get_pool_statuses(pools, existing_ids):
+    # "appended" if the pool exists before this pool is applied, the first record of a new pool is "inserted"
+    seen_ids = set(existing_ids)
+    statuses = []
+    for pool in pools:
+        statuses.append("appended" if pool["poolId"] in seen_ids else "inserted")
+        seen_ids.add(pool["poolId"])
+    return statuses
+
+def read_log_records(path):
+    if not does_path_exist(path):
+        return []
+    count_bytes_read(path, os.path.getsize(path))
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.endswith('\n')] # skip a torn last line
+
+def apply_pools(pools, current_df=None):
+    logger.info("Insert or append many pools in Dataframe")
+    # group the values of each pool first so every pool is parsed and re-stringified once
+    pool_values_by_id = {}
+    for pool in pools:
+        pool_values_by_id.setdefault(pool["poolId"], []).extend(pool["poolValues"])
+
+    new_df = current_df
+    for id, pool_values_list in pool_values_by_id.items():
+        pool = {"poolId": id, "poolValues": pool_values_list}
+        if new_df is not None and does_pool_exist(id, new_df.index.values):
+            new_df = append_pool_values(pool, new_df)
+        else:
+            new_df = insert_pool(pool, new_df)
+    return new_df
+
+class CommitBatch(object):
+    # the appends made durable by one round of fsyncs, shared by their waiters
+    def __init__(self):
+        self.files = [] # (descriptor, directory of a new log or None)
+        self.done = False
+        self.error = None # the first fsync error, the appends of the batch are not acknowledged
+
+
+class GroupCommit(object):
+    # Makes the log appends of concurrent requests durable together, one fsync per file and batch.
+    # Every appender hands over a descriptor of the log it wrote to and waits. The first one waiting leads
+    # the batch: it sleeps delay seconds so others can join, then fsyncs every file of the batch once while
+    # the next batch gathers. Descriptors stay valid when a compaction renames the log meanwhile
+    def __init__(self, delay=COMMIT_DELAY):
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.batch = CommitBatch() # the batch gathering appends
+        self.leading = False
+
+    def wait_durable(self, fd, new_file_directory=None):
+        with self.condition:
+            batch = self.batch
+            batch.files.append((fd, new_file_directory))
+            while not batch.done:
+                if self.leading: # another batch is being synced, or this one sleeps before its sync
+                    self.condition.wait()
+                    continue
+                self.leading = True
+                self.condition.release()
+                try:
+                    time.sleep(self.delay)
+                finally:
+                    self.condition.acquire()
+                synced, self.batch = self.batch, CommitBatch()
+                self.condition.release()
+                try:
+                    synced.error = sync_files(synced.files)
+                finally:
+                    self.condition.acquire()
+                    self.leading = False
+                    synced.done = True
+                    self.condition.notify_all()
+            if batch.error is not None:
+                raise OSError(f"Log append could not be made durable: {batch.error}")
+
+@timed('log_sync')
+def sync_files(files):
+    # fsyncs every file once, then the directories of the new ones. Returns the first error, None if all succeeded
+    LOG_SYNC_BATCH.observe(len(files))
+    synced = set()
+    error = None
+    for fd, new_file_directory in files:
+        try:
+            file_id = os.fstat(fd)[1:3] # inode and device, several appends share one fsync
+            if file_id not in synced:
+                os.fsync(fd)
+                synced.add(file_id)
+            if new_file_directory is not None and new_file_directory not in synced:
+                fsync_directory(new_file_directory)
+                synced.add(new_file_directory)
+        except OSError as e:
+            error = error or e
+        finally:
+            os.close(fd)
+    return error
+
+def start_compactor(storage, interval):
+    logger.info(f"Start background compaction every {interval} seconds")
+
+    def compact_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                storage.compact_all()
+            except Exception:
+                logger.exception("Background compaction failed")
+
+    compactor = threading.Thread(target=compact_forever, name='compactor', daemon=True)
+    compactor.start()
+    return compactor
+
+
+class BinaryStorage(object):
+    # One directory per shard, one file per pool: a 16 byte header followed by the
+    # pool values as a contiguous little-endian float64 array.
+    # Locks are taken per shard directory, like the CSV storage takes them per shard file
+    name = 'binary'
+
+    def __init__(self, root=DATA_DIR, locks=None, sharding=None):
+        self.root = root
+        self.locks = locks if locks is not None else ShardLocks()
+        self.sharding = sharding if sharding is not None else LegacySharding()
+
+    def get_path_by_id(self, id):
+        logger.info("Get shard directory by poolId")
+        return os.path.join(self.root, self.sharding.get_shard(id))
+
+    def get_shard_paths(self):
+        # the copies of the CSV shards in <shard>.sorted/ are left in the root by a migration in place
+        return sorted(path for path in glob.glob(os.path.join(self.root, '*')) if os.path.isdir(path) and os.path.basename(path) not in (SKETCH_DIR, WINDOW_DIR) and not path.endswith(SORTED_SUFFIX))
+
+    def get_pool_path(self, id):
+        return os.path.join(self.get_path_by_id(id), str(id) + POOL_FILE_SUFFIX)
+
+    def read_pool_values(self, id):
+        return self.read_stamped_pool_values(id)[:2]
+
+    def read_stamped_pool_values(self, id):
+        # (values, sorted_length, stamp), the stamp is read under the same lock as the values
+        logger.info("Memory-map pool values")
+        pool_path = self.get_pool_path(id)
+        with self.locks.reading(self.get_path_by_id(id)):
+            stamp = self.get_file_stamp(id)
+            if not does_path_exist(pool_path):
+                return None, None, stamp
+            return (*read_pool_file(pool_path), stamp) # the mapping keeps its size, later appends are not seen
+
+    def get_pool_values(self, id):
+        return self.read_pool_values(id)
+
+    def get_pool_counts(self, id):
+        pool_path = self.get_pool_path(id)
+        with self.locks.reading(self.get_path_by_id(id)):
+            if not does_path_exist(pool_path):
+                return None, None
+            return read_pool_file_counts(pool_path)
+
+    def get_unsorted_pools(self, path):
+        # {poolId: unsorted values} of a shard directory, from the pool file headers
+        unsorted_pools = {}
+        with self.locks.reading(path):
+            for file_name in sorted(os.listdir(path)):
+                if file_name.endswith(POOL_FILE_SUFFIX):
+                    total_elements, sorted_length = read_pool_file_counts(os.path.join(path, file_name))
+                    if sorted_length < total_elements:
+                        unsorted_pools[int(file_name[:-len(POOL_FILE_SUFFIX)])] = total_elements - sorted_length
+        return unsorted_pools
+
+    def sort_shard(self, path):
+        # sorts and saves the unsorted pools of a shard directory, each one unless it changed meanwhile
+        sorted_pools = 0
+        for id in self.get_unsorted_pools(path):
+            sorted_values, is_dirty, stamp = self.read_sorted_pool_values(id)
+            if is_dirty and self.save_sorted_pool_values(id, sorted_values, stamp):
+                sorted_pools += 1
+        return sorted_pools
+
+    def get_stored_pool_ids(self, path):
+        with self.locks.reading(path):
+            return sorted(int(file_name[:-len(POOL_FILE_SUFFIX)]) for file_name in os.listdir(path) if file_name.endswith(POOL_FILE_SUFFIX))
+
+    def iter_pool_values(self, id, chunk_size):
+        # slices of the mapped file, appends made after it was mapped are not seen
+        values, sorted_length = self.read_pool_values(id)
+        if values is None:
+            return
+        for start in range(0, len(values), chunk_size):
+            yield values[start:start + chunk_size].tolist()
+
+    def write_pool_values(self, id, values, sorted_length):
+        logger.info("Write pool values to pool file")
+        pool_path = self.get_pool_path(id)
+        os.makedirs(os.path.dirname(pool_path), exist_ok=True)
+        write_pool_file(pool_path, values, sorted_length)
+
+    def update_pool(self, pool):
+        logger.info("Insert or append pool in binary storage")
+        pool_path = self.get_pool_path(pool['poolId'])
+        with self.locks.writing(self.get_path_by_id(pool['poolId'])):
+            if does_path_exist(pool_path):
+                append_pool_file(pool_path, pool['poolValues'])
+                logger.info('Successfully appended pool')
+                return "appended"
+
+            total_elements = len(pool['poolValues'])
+            self.write_pool_values(pool['poolId'], pool['poolValues'], int(total_elements == 1))
+            logger.info('Successfully inserted new pool')
+            return "inserted"
+
+    def get_sorted_pool_values(self, id):
+        logger.info("Get sorted pool values from binary storage")
+        return self.get_stamped_sorted_pool_values(id)[0]
+
+    def get_stamped_sorted_pool_values(self, id):
+        # the sorted values and the stamp of the pool file they were read from, or saved to
+        sorted_values, is_dirty, stamp = self.read_sorted_pool_values(id)
+        if is_dirty:
+            stamp = self.save_sorted_pool_values(id, sorted_values, stamp) or stamp
+        return sorted_values, stamp
+
+    def update_pools(self, pools):
+        logger.info("Insert or append many pools in binary storage")
+        return [self.update_pool(pool) for pool in pools] # every pool is its own file, there is no shard to rewrite
+
+    def get_sorted_pools_values(self, ids):
+        logger.info("Get sorted values of many pools from binary storage")
+        return {id: sorted_values for id, (sorted_values, stamp) in self.get_stamped_sorted_pools_values(ids).items()}
+
+    def get_stamped_sorted_pools_values(self, ids):
+        stamped_pools_values = {}
+        for id in ids:
+            sorted_values, stamp = self.get_stamped_sorted_pool_values(id)
+            if sorted_values is not None:
+                stamped_pools_values[id] = sorted_values, stamp
+        return stamped_pools_values
+
+    def read_sorted_pool_values(self, id):
+        # (sorted values, is_dirty, stamp), the stamp is read under the same lock as the values
+        logger.info("Get sorted pool values from binary storage without saving the sort")
+        values, sorted_length, stamp = self.read_stamped_pool_values(id)
+        if values is None:
+            return None, False, stamp
+        if sorted_length >= len(values):
+            logger.info("The pool values list is already sorted, no need to do anything")
+            return values, False, stamp
+        logger.info("Sort pool values, the first %d values are already sorted", sorted_length)
+        return merge_sorted_prefix(values, sorted_length), True, stamp
+
+    def save_sorted_pool_values(self, id, sorted_values, stamp=None):
+        # the stamp of the saved pool file, None if the pool changed since it was sorted
+        logger.info("Save sorted pool values, update 'sorted_length'")
+        with self.locks.writing(self.get_path_by_id(id)):
+            if stamp is not None and self.get_file_stamp(id) != stamp:
+                logger.info("Pool changed since it was sorted, do not save the sort")
+                return None
+            self.write_pool_values(id, sorted_values, len(sorted_values))
+            return self.get_file_stamp(id)
+
+    def get_file_stamp(self, id):
+        # a tuple like the CSV stamp, a pool created meanwhile still changes the stamp of a missing pool
+        return get_file_stamp(self.get_pool_path(id)),
+
+    def load_data(self, path):
+        logger.info("Load shard directory into Dataframe")
+        rows = []
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith(POOL_FILE_SUFFIX):
+                continue
+            values, sorted_length = read_pool_file(os.path.join(path, file_name))
+            rows.append({"poolId": int(file_name[:-len(POOL_FILE_SUFFIX)]), "poolValues": values, "sorted_length": sorted_length})
+        return pd.DataFrame(rows, columns=["poolId", "poolValues", "sorted_length"]).set_index('poolId')
+
+    def save_data(self, path, df):
+        logger.info("Write Dataframe to shard directory")
+        os.makedirs(path, exist_ok=True)
+        for id, row in df.iterrows():
+            pool_values = row["poolValues"]
+            if isinstance(pool_values, str):
+                pool_values = parse_pool_values(pool_values) # CSV cell
+            write_pool_file(os.path.join(path, str(id) + POOL_FILE_SUFFIX), pool_values, int(row["sorted_length"]))
+
+
+@timed('read_pool')
+def read_pool_file_counts(path, dtype=VALUE_DTYPE):
+    # (value count, sorted_length) from the header and the size of a pool file
+    with open(path, 'rb') as f:
+        magic, sorted_length = POOL_FILE_HEADER.unpack(f.read(POOL_FILE_HEADER.size))
+    if magic != POOL_FILE_MAGIC:
+        raise ValueError(f"{path} is not a pool file")
+    return (os.path.getsize(path) - POOL_FILE_HEADER.size) // dtype.itemsize, sorted_length
+
+def read_pool_file(path, dtype=VALUE_DTYPE):
+    total_elements, sorted_length = read_pool_file_counts(path, dtype)
+    values = np.memmap(path, dtype=dtype, mode='r', offset=POOL_FILE_HEADER.size, shape=(total_elements,))
+    count_bytes_read(path, values.nbytes)
+    return values, sorted_length
+
+@timed('save_data')
+def write_pool_file(path, values, sorted_length, dtype=VALUE_DTYPE, fsync=True):
+    def write(f):
+        f.write(POOL_FILE_HEADER.pack(POOL_FILE_MAGIC, sorted_length))
+        f.write(np.asarray(values, dtype=dtype).tobytes())
+    replace_file(path, write, fsync=fsync) # readers never see a half written pool
+
+
+class MappedPoolValues(object):
+    # read-only sequence over a memory-mapped sorted pool, elements come back as the Python ints
+    # or floats of the parsed CSV list, so quantiles and responses are unchanged
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.values[index].tolist()
+        return self.values[index].item()
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.values, dtype=dtype)
+
+    def tolist(self):
+        return self.values.tolist()
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+def get_mapped_suffix(sorted_values):
+    # file suffix of the dtype holding every value exactly, None for a pool mixing ints and floats
+    value_types = set(map(type, sorted_values))
+    if value_types == {int} and -2**63 <= sorted_values[0] and sorted_values[-1] < 2**63:
+        return '.i64'
+    if value_types == {float}:
+        return '.f64'
+    return None
+
+def get_mapped_path(directory, id, checksum, suffix):
+    return os.path.join(directory, f"{id}.{checksum:08x}{suffix}")
+
+def read_mapped_pool(directory, id, count, checksum):
+    # None if the pool has no copy of its current row, e.g. values were appended since it was copied.
+    # Copies are not fsynced, one cut short or damaged by a crash counts as missing and is copied again
+    for suffix, dtype in MAPPED_DTYPES.items():
+        path = get_mapped_path(directory, id, checksum, suffix)
+        if does_path_exist(path):
+            try:
+                values, sorted_length = read_pool_file(path, dtype)
+            except (struct.error, ValueError): # no full header, a wrong magic or no values to map
+                logger.warning("Damaged memory-mapped copy %s, copy the pool again", path)
+                continue
+            if len(values) == count and sorted_length == count:
+                return MappedPoolValues(values)
+    return None
+
+def write_mapped_pool(directory, id, sorted_values, checksum):
+    logger.info("Copy the sorted pool to a memory-mapped file")
+    suffix = get_mapped_suffix(sorted_values)
+    if suffix is None:
+        return False
+    os.makedirs(directory, exist_ok=True)
+    mapped_path = get_mapped_path(directory, id, checksum, suffix)
+    write_pool_file(mapped_path, sorted_values, len(sorted_values), MAPPED_DTYPES[suffix], fsync=False) # copied again if lost
+    for file_name in os.listdir(directory): # the former copies of the pool, the temporary files of other writers end in .tmp
+        if file_name.split('.')[0] == str(id) and os.path.splitext(file_name)[1] in MAPPED_DTYPES and file_name != os.path.basename(mapped_path):
+            try:
+                os.remove(os.path.join(directory, file_name))
+            except FileNotFoundError: # removed by a concurrent copy
+                pass
+    return True
+
+@timed('append')
+def append_pool_file(path, values, fsync=True):
+    values_bytes = np.asarray(values, dtype=VALUE_DTYPE).tobytes()
+    with open(path, 'r+b') as f: # the sorted prefix in the header stays valid
+        size = f.seek(0, os.SEEK_END)
+        values_end = POOL_FILE_HEADER.size + (size - POOL_FILE_HEADER.size) // VALUE_DTYPE.itemsize * VALUE_DTYPE.itemsize
+        if values_end != size:
+            # a torn append left part of a value, every later value would be misaligned
+            logger.warning("Drop %d bytes of a torn append at the end of %s", size - values_end, path)
+            f.truncate(values_end)
+            f.seek(values_end)
+        f.write(values_bytes)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    count_bytes_written(path, len(values_bytes))
+
+
+STORAGE_BACKENDS = {CsvStorage.name: CsvStorage, BinaryStorage.name: BinaryStorage}
+
+def get_storage(name='csv', **options):
+    logger.info(f"Use '{name}' storage backend")
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend '{name}', expected one of {sorted(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[name](**options)
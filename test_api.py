@@ -1,7 +1,16 @@
 import pytest
-from api import insert_pool, append_pool_values, sort_pool_values, get_path_by_id
+from api import insert_pool, append_pool_values, sort_pool_values, get_path_by_id, load_data
+from api import calculate_quantile, calculate_quantiles, select_quantile, should_sort_pool
+from api import build_summary, calculate_summary_quantile, query_response
+from cache import SummaryCache, QueryCounter
+from storage import CsvStorage
+import api
+from sketch import SketchStore
+from windows import WindowStore
+import random
 import requests
 import os
+import shutil
 import numpy as np
 import pandas as pd
 
@@ -32,6 +41,15 @@ class TestUpdate(object):
         #teardown
         os.remove(file_path_created_by_calling_api)
         
+    def test_request_id_header(self):
+        #setup
+        response_1 = requests.post(self.URL_update, json = {"poolId": "1369", "poolValues": [1]}, headers = {"X-Request-ID": "client-1369"})
+        response_2 = requests.post(self.URL_update, json = {"poolId": "1369", "poolValues": [1]})
+        
+        #assert
+        assert response_1.headers["X-Request-ID"] == "client-1369"
+        assert len(response_2.headers["X-Request-ID"]) == 16
+    
     def test_update_just_insert_pool(self):
         #setup
         pool = {"poolId": 99991369, "poolValues": [1, 7, 2, 6, 5.5, 3.141592653589793]}
@@ -171,6 +189,38 @@ class TestUpdate(object):
         assert response.status_code == 400
         assert data['error'] == expected_message
 
+class TestBinaryUpdate(object):
+    URL_update = "http://127.0.0.1:1234/update"
+    URL_query = "http://127.0.0.1:1234/query"
+    
+    def test_binary_update_then_query(self):
+        #setup
+        file_path_created_by_calling_api = get_path_by_id(99991369)
+        if os.path.exists(file_path_created_by_calling_api):
+            os.remove(file_path_created_by_calling_api)
+        values = np.array([1, 7, 2, 6, 5.5, 2, -2, -3, -2, -3], dtype='<f8')
+        
+        response_1 = requests.post(self.URL_update, params = {"poolId": 99991369}, data = values[:4].tobytes(), headers = {"Content-Type": "application/octet-stream"})
+        response_2 = requests.post(self.URL_update, params = {"poolId": 99991369}, data = values[4:].tobytes(), headers = {"Content-Type": "application/octet-stream"})
+        response_3 = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 90}, headers = {"Content-Type": "application/json"})
+        
+        #assert
+        assert response_1.json() == {"status": "inserted"}
+        assert response_2.json() == {"status": "appended"}
+        assert response_3.json()["calculated_quantile"] == 6.1
+        assert response_3.json()["total_count_of_elements"] == 10
+        
+        #teardown
+        os.remove(file_path_created_by_calling_api)
+    
+    def test_binary_update_invalid_length(self):
+        #setup
+        response = requests.post(self.URL_update, params = {"poolId": 99991369}, data = b'\x00' * 12, headers = {"Content-Type": "application/octet-stream"})
+        
+        #assert
+        assert response.status_code == 400
+        assert response.json() == {"error": "Binary 'poolValues' must be little-endian float64, the body length must be a multiple of 8"}
+
 class TestQuery(object):
     URL_query = "http://127.0.0.1:1234/query"
     URL_update = "http://127.0.0.1:1234/update"
@@ -485,7 +535,7 @@ class TestInsertPool(object):
         # assert
         assert len(new_df) == 1
         assert new_df.loc[pool["poolId"]]["poolValues"] == str(pool["poolValues"])
-        assert new_df.loc[pool["poolId"]]["sorted"] == 1 # because poolValues has just 1 element
+        assert new_df.loc[pool["poolId"]]["sorted_length"] == 1 # because poolValues has just 1 element
     
     def test_insert_poolvalues_has_more_elements(self):
         # setup
@@ -494,15 +544,15 @@ class TestInsertPool(object):
         # assert
         assert len(new_df) == 1
         assert new_df.loc[pool["poolId"]]["poolValues"] == str(pool["poolValues"])
-        assert new_df.loc[pool["poolId"]]["sorted"] == 0 # because poolValues has more than 1 element
+        assert new_df.loc[pool["poolId"]]["sorted_length"] == 0 # because poolValues has more than 1 element
     
     def test_insert_poolvalues_has_one_element_to_current_df(self):
         # setup
         # Note that since it is handled by the does_pool_exist function, pool["poolId"] will not match any poolId in current_df
         pool = {"poolId": 1111, "poolValues": [2]}
-        current_df = pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 3]", "sorted": 0},
-                                   {"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted": 1},
-                                   {"poolId": 4444, "poolValues": "[1, 3, 5]", "sorted": 0}]).set_index('poolId')
+        current_df = pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 3]", "sorted_length": 0},
+                                   {"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted_length": 2},
+                                   {"poolId": 4444, "poolValues": "[1, 3, 5]", "sorted_length": 0}]).set_index('poolId')
         
         new_df = insert_pool(pool, current_df)
         diff_df = pd.concat([new_df,current_df]).drop_duplicates(keep=False) 
@@ -510,15 +560,15 @@ class TestInsertPool(object):
         # to make sure the only difference between new_df and current_df is caused by pool data
         assert len(diff_df) == 1
         assert diff_df.loc[pool["poolId"]]["poolValues"] == str(pool["poolValues"])
-        assert new_df.loc[pool["poolId"]]["sorted"] == 1 # because poolValues has just 1 element
+        assert new_df.loc[pool["poolId"]]["sorted_length"] == 1 # because poolValues has just 1 element
     
     def test_insert_poolvalues_has_more_elements_to_current_df(self):
         # setup
         # Note that since it is handled by the does_pool_exist function, pool["poolId"] will not match any poolId in current_df
         pool = {"poolId": 1111, "poolValues": [2,3]}
-        current_df = pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 3]", "sorted": 0},
-                                   {"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted": 1},
-                                   {"poolId": 4444, "poolValues": "[1, 3, 5]", "sorted": 0}]).set_index('poolId')
+        current_df = pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 3]", "sorted_length": 0},
+                                   {"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted_length": 2},
+                                   {"poolId": 4444, "poolValues": "[1, 3, 5]", "sorted_length": 0}]).set_index('poolId')
         
         new_df = insert_pool(pool, current_df)
         diff_df = pd.concat([new_df,current_df]).drop_duplicates(keep=False) 
@@ -526,15 +576,15 @@ class TestInsertPool(object):
         # to make sure the only difference between new_df and current_df is caused by pool data
         assert len(diff_df) == 1
         assert diff_df.loc[pool["poolId"]]["poolValues"] == str(pool["poolValues"])
-        assert diff_df.loc[pool["poolId"]]["sorted"] == 0 # because poolValues has more than 1 element
+        assert diff_df.loc[pool["poolId"]]["sorted_length"] == 0 # because poolValues has more than 1 element
             
 class TestAppendPoolValues(object): 
     def test_append_poolvalues(self):
         #setup
         # Note that since it is handled by the does_pool_exist function, pool["poolId"] will match with one poolId in current_df
         pool = {"poolId": 3333, "poolValues": [2,3]}
-        dict_list = [{"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted": 1},
-                                   {"poolId": 4444, "poolValues": "[1, 3, 5]", "sorted": 0}]
+        dict_list = [{"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted_length": 2},
+                                   {"poolId": 4444, "poolValues": "[1, 3, 5]", "sorted_length": 0}]
         
         df = pd.DataFrame(dict_list).set_index('poolId')  
         tally_df = pd.DataFrame(dict_list).set_index('poolId')    
@@ -547,15 +597,15 @@ class TestAppendPoolValues(object):
         # assert
         assert len(diff_df) == 1
         assert diff_df.loc[pool["poolId"]]["poolValues"] == str([-1, 2] + pool["poolValues"])
-        assert diff_df.loc[pool["poolId"]]["sorted"] == 0 # 'sorted' changed from 1 to 0 by appending new values
+        assert diff_df.loc[pool["poolId"]]["sorted_length"] == 2 # the sorted prefix is kept when new values are appended
         
 class TestSortPoolValues(object): 
     def test_sort_poolvalues_already_sorted(self):
         # Sort an already sorted row in Dataframe, need to confirm nothing changed
         #setup
         query = {"poolId": 3333, "percentile": 90}  
-        dict_list = [{"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted": 1},
-                                   {"poolId": 4444, "poolValues": "[1, 3, 5, 4]", "sorted": 0}]
+        dict_list = [{"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted_length": 2},
+                                   {"poolId": 4444, "poolValues": "[1, 3, 5, 4]", "sorted_length": 0}]
         df = pd.DataFrame(dict_list).set_index('poolId')
         tally_df = pd.DataFrame(dict_list).set_index('poolId')
         
@@ -572,8 +622,8 @@ class TestSortPoolValues(object):
         # Sort the poolValues of an unsorted row in Dataframe
         #setup
         query = {"poolId": 4444, "percentile": 90}  
-        dict_list = [{"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted": 1},
-                                   {"poolId": 4444, "poolValues": "[1, 3, 5, 4]", "sorted": 0}]
+        dict_list = [{"poolId": 3333, "poolValues": str(sorted([-1, 2])), "sorted_length": 2},
+                                   {"poolId": 4444, "poolValues": "[1, 3, 5, 4]", "sorted_length": 0}]
         
         df = pd.DataFrame(dict_list).set_index('poolId')
         tally_df = pd.DataFrame(dict_list).set_index('poolId')
@@ -585,9 +635,449 @@ class TestSortPoolValues(object):
         #assert
         assert type(queried_pool_values_list) is list
         assert str(queried_pool_values_list) == str(sorted([1, 3, 5, 4]))
-        assert df.loc[query["poolId"]]["sorted"] == 1
+        assert df.loc[query["poolId"]]["sorted_length"] == 4
         assert len(diff_df) == 1
         assert diff_df.index[0] == query["poolId"]
         assert df_has_changed == True
         
-        
\ No newline at end of file
+    def test_sort_pool_values_sorted_prefix(self):
+        # Only the values appended after the sorted prefix need to be sorted
+        #setup
+        query = {"poolId": 4444, "percentile": 90}  
+        dict_list = [{"poolId": 4444, "poolValues": "[1, 3, 5, 4, 0, 3.5]", "sorted_length": 3}]
+        df = pd.DataFrame(dict_list).set_index('poolId')
+        
+        queried_pool_values_list, df, df_has_changed = sort_pool_values(query, df)
+        
+        #assert
+        assert queried_pool_values_list == [0, 1, 3, 3.5, 4, 5]
+        assert df.loc[query["poolId"]]["poolValues"] == "[0, 1, 3, 3.5, 4, 5]"
+        assert df.loc[query["poolId"]]["sorted_length"] == 6
+        assert df_has_changed == True
+
+class TestLoadData(object):
+    def test_load_data_converts_sorted_label(self, tmp_path):
+        # Shards saved with the former 0 / 1 'sorted' label are read with 'sorted_length'
+        #setup
+        path = tmp_path / "2.csv"
+        pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 7, 2]", "sorted": 0},
+                      {"poolId": 2266, "poolValues": "[-1, 2.5]", "sorted": 1}]).set_index('poolId').to_csv(path)
+        
+        df = load_data(str(path))
+        
+        #assert
+        assert "sorted" not in df.columns
+        assert df.loc[2222]["sorted_length"] == 0
+        assert df.loc[2266]["sorted_length"] == 2
+
+class TestSelectQuantile(object):
+    def test_select_quantile_matches_calculate_quantile(self):
+        #setup
+        rng = random.Random(1369)
+        values_lists = [[rng.choice([rng.randint(-5, 5), rng.uniform(-5, 5)]) for _ in range(rng.randint(1, 50))] for _ in range(200)]
+        percentiles = [0, 0.1, 25, 50, 90, 99.9, 100]
+        
+        #assert
+        for values_list in values_lists:
+            for percentile in percentiles:
+                selected = select_quantile(values_list, percentile)
+                calculated = calculate_quantile(sorted(values_list), percentile)
+                assert selected == calculated
+                assert type(selected[0]) is type(calculated[0])
+    
+    def test_select_quantile_keeps_int_type(self):
+        #setup
+        values_list = [3, 1, 2]
+        
+        #assert
+        assert select_quantile(values_list, 0) == (1, 3)
+        assert type(select_quantile(values_list, 0)[0]) is int
+        assert select_quantile(values_list, 100) == (3, 3)
+        assert select_quantile(values_list, 50) == (2.0, 3)
+    
+    def test_select_quantile_identical_elements(self):
+        #setup
+        values_list = [2.0, 2, 2]
+        
+        #assert
+        assert select_quantile(values_list, 90) == calculate_quantile(sorted(values_list), 90)
+        assert type(select_quantile(values_list, 90)[0]) is float # sorted_list[0] of the stable sort
+    
+    def test_select_quantile_numpy_array(self):
+        #setup
+        values_array = np.array([1, 7, 2, 6, 5.5, 2, -2, -3, -2, -3])
+        
+        #assert
+        assert select_quantile(values_array, 90) == calculate_quantile(np.sort(values_array), 90)
+
+class TestShouldSortPool(object):
+    def test_rarely_queried_pool_is_not_sorted(self):
+        #assert
+        assert should_sort_pool(1, 10) is False
+        assert should_sort_pool(5, 10**6) is False
+    
+    def test_often_queried_pool_is_sorted(self):
+        #assert
+        assert should_sort_pool(2, 2) is True
+        assert should_sort_pool(20, 10**6) is True
+
+class TestCalculateQuantiles(object):
+    def test_calculate_quantiles_matches_calculate_quantile(self):
+        #setup
+        rng = random.Random(1369)
+        sorted_lists = [sorted(rng.choice([rng.randint(-5, 5), rng.uniform(-5, 5)]) for _ in range(rng.randint(1, 50))) for _ in range(200)]
+        percentiles = [0, 0.1, 25, 50, 90, 99.9, 100, 33]
+        
+        #assert
+        for sorted_list in sorted_lists:
+            quantiles, total_elements = calculate_quantiles(sorted_list, percentiles)
+            assert total_elements == len(sorted_list)
+            for percentile, quantile in zip(percentiles, quantiles):
+                assert quantile == calculate_quantile(sorted_list, percentile)[0]
+                assert type(quantile) is type(calculate_quantile(sorted_list, percentile)[0])
+    
+    def test_calculate_quantiles_reads_only_neighbouring_elements(self):
+        #setup
+        class RecordedList(list):
+            def __getitem__(self, index):
+                read_indexes.append(index)
+                return list.__getitem__(self, index)
+        read_indexes = []
+        sorted_list = RecordedList(range(1001))
+        
+        quantiles, total_elements = calculate_quantiles(sorted_list, [10, 50.05, 99])
+        
+        #assert
+        assert quantiles == [100, 500.5, 990]
+        assert set(read_indexes) == {0, -1, 100, 101, 500, 501, 990, 991} # the ends for the special cases, two elements per percentile
+
+class TestSummary(object):
+    GRID = [0, 1, 5, 10, 25, 50, 75, 90, 95, 99, 99.9, 100]
+    
+    def test_summary_matches_calculate_quantile_on_grid(self):
+        #setup
+        rng = random.Random(1369)
+        sorted_lists = [sorted(rng.choice([rng.randint(-5, 5), rng.uniform(-5, 5)]) for _ in range(rng.randint(1, 500))) for _ in range(200)]
+        
+        #assert
+        for sorted_list in sorted_lists:
+            summary = build_summary(sorted_list, self.GRID)
+            for percentile in self.GRID:
+                quantile = calculate_summary_quantile(summary, percentile)
+                assert quantile == calculate_quantile(sorted_list, percentile)
+                assert type(quantile[0]) is type(calculate_quantile(sorted_list, percentile)[0])
+    
+    def test_summary_off_grid(self):
+        #setup
+        sorted_list = list(range(1001))
+        summary = build_summary(sorted_list, [50, 90])
+        
+        #assert
+        assert calculate_summary_quantile(summary, 90.05) == calculate_quantile(sorted_list, 90.05) # same two ranks as 90
+        assert calculate_summary_quantile(summary, 33) == (None, 1001)
+        assert calculate_summary_quantile(summary, 100) == (1000, 1001)
+    
+    def test_query_answered_from_summary(self, tmp_path, monkeypatch):
+        #setup
+        storage = CsvStorage(root=str(tmp_path))
+        storage.update_pool({"poolId": 1369, "poolValues": [5, 1, 4, 2, 3]})
+        summary_cache = SummaryCache()
+        monkeypatch.setattr(api, 'storage', storage)
+        monkeypatch.setattr(api, 'sketch_store', SketchStore(str(tmp_path)))
+        monkeypatch.setattr(api, 'query_counter', QueryCounter())
+        monkeypatch.setattr(api, 'summary_cache', summary_cache)
+        monkeypatch.setattr(api, 'POOL_SUMMARY_GRID', [50, 90])
+        monkeypatch.setattr(api, 'POOL_SUMMARY_MIN_QUERIES', 2)
+        
+        responses = [query_response({"poolId": 1369, "percentile": 90})[0] for _ in range(5)]
+        off_grid_response = query_response({"poolId": 1369, "percentile": 10})[0]
+        storage.update_pool({"poolId": 1369, "poolValues": [6]})
+        appended_response = query_response({"poolId": 1369, "percentile": 90})[0]
+        
+        #assert
+        assert [response["calculated_quantile"] for response in responses] == [4.6] * 5
+        assert off_grid_response["calculated_quantile"] == 1.4
+        assert appended_response["calculated_quantile"] == 5.5
+        assert summary_cache.stats()["hits"] == 1 # the third query sorts the pool, saving the sort makes its summary stale
+        assert summary_cache.stats()["off_grid"] == 1
+        assert summary_cache.stats()["misses"] == 5
+
+class TestBatchQuery(object):
+    URL_batch_query = "http://127.0.0.1:1234/query/batch"
+    URL_update = "http://127.0.0.1:1234/update"
+    
+    def test_batch_query_valid_data(self):
+        #setup
+        pool_1 = {"poolId": 99991369, "poolValues": [1, 7, 2, 6, 5.5, 2, -2, -3, -2, -3]}
+        pool_2 = {"poolId": 99991370, "poolValues": [3, 1]}
+        batch = {"poolIds": [99991369, 99991370], "percentiles": [0, 50, 90, 99.9, 100]}
+        
+        file_path_created_by_calling_api = get_path_by_id(pool_1["poolId"]) 
+        if os.path.exists(file_path_created_by_calling_api):
+            os.remove(file_path_created_by_calling_api)
+        
+        requests.post(self.URL_update, json = pool_1, headers = {"Content-Type": "application/json"})
+        requests.post(self.URL_update, json = pool_2, headers = {"Content-Type": "application/json"})
+        
+        response = requests.post(self.URL_batch_query, json = batch, headers = {"Content-Type": "application/json"})
+        data = response.json()
+        
+        #assert
+        assert response.status_code == 200
+        assert len(data['results']) == 2
+        for pool, result in zip([pool_1, pool_2], data['results']):
+            assert result['poolId'] == pool['poolId']
+            assert result['total_count_of_elements'] == len(pool['poolValues'])
+            for percentile, quantile in zip(batch['percentiles'], result['quantiles']):
+                assert quantile['percentile'] == percentile
+                assert quantile['calculated_quantile'] == pytest.approx(np.quantile(pool['poolValues'], percentile/100))
+        
+        #teardown
+        os.remove(file_path_created_by_calling_api)
+    
+    def test_batch_query_reports_errors_per_item(self):
+        #setup
+        pool = {"poolId": 99991369, "poolValues": [3, 1]}
+        batch = {"poolIds": [99991369, "abcd", 99991999], "percentiles": [50, 100.1, "a"]}
+        
+        file_path_created_by_calling_api = get_path_by_id(pool["poolId"]) 
+        if os.path.exists(file_path_created_by_calling_api):
+            os.remove(file_path_created_by_calling_api)
+        
+        requests.post(self.URL_update, json = pool, headers = {"Content-Type": "application/json"})
+        
+        response = requests.post(self.URL_batch_query, json = batch, headers = {"Content-Type": "application/json"})
+        data = response.json()
+        
+        #assert
+        assert response.status_code == 200
+        assert data['results'][0]['quantiles'] == [{"percentile": 50, "calculated_quantile": 2.0},
+                                                   {"percentile": 100.1, "error": "Percentiles must be in the range [0, 100]"},
+                                                   {"percentile": "a", "error": "'percentile' must be a real number"}]
+        assert data['results'][1] == {"poolId": "abcd", "error": "'poolId' must be an integer"}
+        assert data['results'][2] == {"poolId": 99991999, "error": "poolId does not exist"}
+        
+        #teardown
+        os.remove(file_path_created_by_calling_api)
+    
+    def test_batch_query_lacking_percentiles(self):
+        #setup
+        batch = {"poolIds": [99991369]}
+        expected_message = "Batch query must contain both 'poolIds' and 'percentiles' and only contain this values"
+        
+        response = requests.post(self.URL_batch_query, json = batch, headers = {"Content-Type": "application/json"})
+        data = response.json()
+        
+        #assert
+        assert response.status_code == 400
+        assert data['error'] == expected_message
+    
+    def test_batch_query_empty_poolids(self):
+        #setup
+        batch = {"poolIds": [], "percentiles": [50]}
+        expected_message = "Number of elements in 'poolIds' must be greater than 0"
+        
+        response = requests.post(self.URL_batch_query, json = batch, headers = {"Content-Type": "application/json"})
+        data = response.json()
+        
+        #assert
+        assert response.status_code == 400
+        assert data['error'] == expected_message
+
+class TestBulkUpdate(object):
+    URL_bulk_update = "http://127.0.0.1:1234/update/bulk"
+    URL_query = "http://127.0.0.1:1234/query"
+    
+    def test_bulk_update_json_list(self):
+        #setup
+        pools = [{"poolId": 99991369, "poolValues": [1, 7, 2]},
+                 {"poolId": 99991370, "poolValues": [3]},
+                 {"poolId": 99991369, "poolValues": [6, 5.5]},
+                 {"poolId": 99991369, "poolValues": [True]},
+                 {"poolId": 99991371}]
+        
+        file_path_created_by_calling_api = get_path_by_id(pools[0]["poolId"]) 
+        if os.path.exists(file_path_created_by_calling_api):
+            os.remove(file_path_created_by_calling_api)
+        
+        response = requests.post(self.URL_bulk_update, json = pools, headers = {"Content-Type": "application/json"})
+        data = response.json()
+        query_response = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 100}, headers = {"Content-Type": "application/json"})
+        
+        #assert
+        assert response.status_code == 200
+        assert data['results'] == [{"status": "inserted"},
+                                   {"status": "inserted"},
+                                   {"status": "appended"},
+                                   {"error": "All elements of 'poolValues' must be real number"},
+                                   {"error": "Pool must contain both 'poolId' and 'poolValues' and only contain this values"}]
+        assert query_response.json()['total_count_of_elements'] == 5
+        
+        #teardown
+        os.remove(file_path_created_by_calling_api)
+    
+    def test_bulk_update_ndjson(self):
+        #setup
+        lines = ['{"poolId": 99991369, "poolValues": [1, 7, 2]}', 'not json', '{"poolId": 99991369, "poolValues": [4]}']
+        
+        file_path_created_by_calling_api = get_path_by_id(99991369) 
+        if os.path.exists(file_path_created_by_calling_api):
+            os.remove(file_path_created_by_calling_api)
+        
+        response = requests.post(self.URL_bulk_update, data = "\n".join(lines) + "\n", headers = {"Content-Type": "application/x-ndjson"})
+        data = response.json()
+        
+        #assert
+        assert response.status_code == 200
+        assert data['results'] == [{"status": "inserted"},
+                                   {"error": "Pool must contain both 'poolId' and 'poolValues' and only contain this values"},
+                                   {"status": "appended"}]
+        
+        #teardown
+        os.remove(file_path_created_by_calling_api)
+    
+    def test_bulk_update_not_a_list(self):
+        #setup
+        pool = {"poolId": 99991369, "poolValues": [1]}
+        expected_message = "Bulk update must be a list of pools"
+        
+        response = requests.post(self.URL_bulk_update, json = pool, headers = {"Content-Type": "application/json"})
+        data = response.json()
+        
+        #assert
+        assert response.status_code == 400
+        assert data['error'] == expected_message
+
+class TestMetricsEndpoint(object):
+    URL_metrics = "http://127.0.0.1:1234/metrics"
+    URL_query = "http://127.0.0.1:1234/query"
+    
+    def test_metrics(self):
+        #setup
+        requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 101})
+        response = requests.get(self.URL_metrics)
+        
+        #assert
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert 'pool_requests_total{endpoint="/query",status="400"}' in response.text
+        assert 'pool_stage_seconds_count{stage="validate"}' in response.text
+        assert '# TYPE pool_request_seconds histogram' in response.text
+
+class TestPoolMode(object):
+    URL_pool_mode = "http://127.0.0.1:1234/pool/mode"
+    URL_update = "http://127.0.0.1:1234/update"
+    URL_query = "http://127.0.0.1:1234/query"
+    URL_batch_query = "http://127.0.0.1:1234/query/batch"
+    
+    @pytest.fixture(autouse=True)
+    def clear_files(self):
+        file_paths = [get_path_by_id(99991369), SketchStore().get_pool_path(99991369)]
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        shutil.rmtree(WindowStore().get_pool_dir(99991369), ignore_errors=True)
+        yield
+        #teardown
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        shutil.rmtree(WindowStore().get_pool_dir(99991369), ignore_errors=True)
+    
+    def test_sketch_mode(self):
+        #setup
+        pool_values = [float(i) for i in range(1, 1001)]
+        
+        mode_response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "sketch", "relative_accuracy": 0.02}, headers = {"Content-Type": "application/json"})
+        response_1 = requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": pool_values[:500]}, headers = {"Content-Type": "application/json"})
+        response_2 = requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": pool_values[500:]}, headers = {"Content-Type": "application/json"})
+        query_response = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 90}, headers = {"Content-Type": "application/json"})
+        data = query_response.json()
+        
+        #assert
+        assert mode_response.json() == {"poolId": 99991369, "mode": "sketch"}
+        assert response_1.json()['status'] == "inserted"
+        assert response_2.json()['status'] == "appended"
+        assert not os.path.exists(get_path_by_id(99991369)) # no raw values stored
+        assert data['approximate'] is True
+        assert data['relative_accuracy'] == 0.02
+        assert data['total_count_of_elements'] == 1000
+        assert data['calculated_quantile'] == pytest.approx(calculate_quantile(pool_values, 90)[0], rel=0.02)
+    
+    def test_both_mode_checked_against_exact(self):
+        #setup
+        pool = {"poolId": 99991369, "poolValues": [1, 7, 2, 6, 5.5, 3.141592653589793]}
+        query = {"poolId": 99991369, "percentile": 30}
+        
+        requests.post(self.URL_update, json = pool, headers = {"Content-Type": "application/json"})
+        mode_response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "both"}, headers = {"Content-Type": "application/json"})
+        requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": [4]}, headers = {"Content-Type": "application/json"})
+        approximate_data = requests.post(self.URL_query, json = query, headers = {"Content-Type": "application/json"}).json()
+        exact_data = requests.post(self.URL_query + "?exact=1", json = query, headers = {"Content-Type": "application/json"}).json()
+        batch_data = requests.post(self.URL_batch_query, json = {"poolIds": [99991369], "percentiles": [30]}, headers = {"Content-Type": "application/json"}).json()
+        
+        #assert
+        assert mode_response.status_code == 200
+        assert approximate_data['approximate'] is True
+        assert approximate_data['total_count_of_elements'] == 7 # the sketch holds the values stored before the mode was set
+        assert exact_data['approximate'] is False
+        assert exact_data['calculated_quantile'] == calculate_quantile(sorted(pool['poolValues'] + [4]), 30)[0]
+        assert approximate_data['calculated_quantile'] == pytest.approx(exact_data['calculated_quantile'], rel=0.01)
+        assert batch_data['results'][0]['approximate'] is True
+        assert batch_data['results'][0]['quantiles'][0]['calculated_quantile'] == approximate_data['calculated_quantile']
+    
+    def test_sketch_mode_refused_for_pool_with_values(self):
+        #setup
+        expected_message = "Pool already has raw values, use 'both' mode to answer it from a sketch"
+        requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": [1]}, headers = {"Content-Type": "application/json"})
+        
+        response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "sketch"}, headers = {"Content-Type": "application/json"})
+        
+        #assert
+        assert response.status_code == 400
+        assert response.json()['error'] == expected_message
+    
+    def test_invalid_mode(self):
+        #setup
+        expected_message = "'mode' must be 'exact', 'sketch', 'both' or 'window'"
+        
+        response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "fast"}, headers = {"Content-Type": "application/json"})
+        
+        #assert
+        assert response.status_code == 400
+        assert response.json()['error'] == expected_message
+    
+    def test_window_mode(self):
+        #setup
+        mode_response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "window", "retention_values": 5}, headers = {"Content-Type": "application/json"})
+        response_1 = requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": [10, 1, 7]}, headers = {"Content-Type": "application/json"})
+        response_2 = requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": [4, 2, 9]}, headers = {"Content-Type": "application/json"})
+        all_data = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 50}, headers = {"Content-Type": "application/json"}).json()
+        window_data = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 100, "window": {"values": 3}}, headers = {"Content-Type": "application/json"}).json()
+        seconds_data = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 0, "window": {"seconds": 3600}}, headers = {"Content-Type": "application/json"}).json()
+        batch_data = requests.post(self.URL_batch_query, json = {"poolIds": [99991369], "percentiles": [50]}, headers = {"Content-Type": "application/json"}).json()
+        exact_response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "exact"}, headers = {"Content-Type": "application/json"})
+        
+        #assert
+        assert mode_response.json() == {"poolId": 99991369, "mode": "window"}
+        assert response_1.json()['status'] == "inserted"
+        assert response_2.json()['status'] == "appended"
+        assert not os.path.exists(get_path_by_id(99991369)) # only in the window segments
+        assert all_data == {"calculated_quantile": 4, "total_count_of_elements": 5, "approximate": False} # retention keeps the newest 5 values
+        assert window_data['calculated_quantile'] == 9 and window_data['total_count_of_elements'] == 3
+        assert seconds_data['calculated_quantile'] == 1 and seconds_data['total_count_of_elements'] == 5
+        assert batch_data['results'][0]['quantiles'][0]['calculated_quantile'] == 4
+        assert exact_response.status_code == 400
+    
+    def test_window_refused(self):
+        #setup
+        requests.post(self.URL_update, json = {"poolId": 99991369, "poolValues": [1]}, headers = {"Content-Type": "application/json"})
+        
+        mode_response = requests.post(self.URL_pool_mode, json = {"poolId": 99991369, "mode": "window"}, headers = {"Content-Type": "application/json"})
+        query_response = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 50, "window": {"values": 1}}, headers = {"Content-Type": "application/json"})
+        invalid_response = requests.post(self.URL_query, json = {"poolId": 99991369, "percentile": 50, "window": {"values": 0}}, headers = {"Content-Type": "application/json"})
+        
+        #assert
+        assert mode_response.json()['error'] == "Pool already has values, only a new pool can be set to 'window' mode"
+        assert query_response.json()['error'] == "'window' is only supported by pools in 'window' mode"
+        assert invalid_response.json()['error'] == "'window' must contain either 'seconds', a positive real number, or 'values', a positive integer"
@@ -0,0 +1,196 @@
+import pytest
+from api import get_path_by_id
+import asgi_api
+from profiling import Profiler
+import os
+import json
+import asyncio
+import numpy as np
+
+def call_app(method, path, body=b'', content_type=b'application/json', chunk_size=None, query_string=b''):
+    # drive the ASGI app directly, the body is sent in chunks of chunk_size bytes
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] if chunk_size else [body]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    scope = {"type": "http", "method": method, "path": path, "query_string": query_string, "headers": [(b"content-type", content_type)]}
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_api.app(scope, receive, send))
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+@pytest.fixture
+def pool_file():
+    file_path = get_path_by_id(99991369)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    yield file_path
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+class TestAsgiUpdate(object):
+    def test_update_insert_then_append_pool(self, pool_file):
+        #setup
+        pool_1 = {"poolId": 99991369, "poolValues": [1, 7, 2, 6, 5.5, 3.141592653589793]}
+        pool_2 = {"poolId": 99991369, "poolValues": [2]}
+
+        status_1, data_1 = call_app("POST", "/update", json.dumps(pool_1).encode())
+        status_2, data_2 = call_app("POST", "/update", json.dumps(pool_2).encode(), chunk_size=5)
+
+        #assert
+        assert status_1 == 200
+        assert data_1 == {"status": "inserted"}
+        assert status_2 == 200
+        assert data_2 == {"status": "appended"}
+
+    def test_update_invalid_pool(self):
+        #setup
+        pool = {"poolId": 99991369, "poolValues": [1, 2, "3"]}
+
+        status, data = call_app("POST", "/update", json.dumps(pool).encode())
+
+        #assert
+        assert status == 400
+        assert data == {"error": "All elements of 'poolValues' must be real number"}
+
+    def test_update_binary_pool(self, pool_file):
+        #setup
+        body = np.array([3, 1, 2.5], dtype='<f8').tobytes()
+
+        status_1, data_1 = call_app("POST", "/update", body, content_type=b'application/octet-stream', query_string=b'poolId=99991369')
+        status_2, data_2 = call_app("POST", "/update", body, content_type=b'application/octet-stream')
+        status_3, data_3 = call_app("POST", "/query", json.dumps({"poolId": 99991369, "percentile": 50}).encode())
+
+        #assert
+        assert (status_1, data_1) == (200, {"status": "inserted"})
+        assert status_2 == 400
+        assert data_2 == {"error": "Pool must contain both 'poolId' and 'poolValues' and only contain this values"}
+        assert data_3["calculated_quantile"] == 2.5
+
+    def test_request_id_header(self):
+        #setup
+        sent = []
+        scope = {"type": "http", "method": "GET", "path": "/stats", "headers": [(b"x-request-id", b"client-1369")]}
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            sent.append(message)
+        asyncio.run(asgi_api.app(scope, receive, send))
+
+        #assert
+        assert (b"x-request-id", b"client-1369") in sent[0]["headers"]
+
+    def test_metrics(self):
+        #setup
+        call_app("POST", "/query", json.dumps({"poolId": 99991369, "percentile": 101}).encode())
+        sent = []
+        scope = {"type": "http", "method": "GET", "path": "/metrics", "headers": []}
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            sent.append(message)
+        asyncio.run(asgi_api.app(scope, receive, send))
+
+        #assert
+        assert sent[0]["status"] == 200
+        assert b'pool_requests_total{endpoint="/query",status="400"}' in sent[1]["body"]
+
+    def test_update_invalid_json(self):
+        #setup
+        status, data = call_app("POST", "/update", b'{"poolId": ')
+
+        #assert
+        assert status == 400
+        assert data == {"error": "Request body must be valid JSON"}
+
+    def test_bulk_update_ndjson(self, pool_file):
+        #setup
+        body = b'{"poolId": 99991369, "poolValues": [3, 1]}\n\n{"poolId": 99991369, "poolValues": [2]}\nnot json\n'
+
+        status, data = call_app("POST", "/update/bulk", body, content_type=b'application/x-ndjson', chunk_size=7)
+
+        #assert
+        assert status == 200
+        assert data["results"][:2] == [{"status": "inserted"}, {"status": "appended"}]
+        assert "error" in data["results"][2]
+
+class TestAsgiQuery(object):
+    def test_query_same_answer_as_flask(self, pool_file):
+        #setup
+        call_app("POST", "/update", json.dumps({"poolId": 99991369, "poolValues": [1, 7, 2, 6, 5.5, 3.141592653589793]}).encode())
+
+        status, data = call_app("POST", "/query", json.dumps({"poolId": 99991369, "percentile": 30}).encode())
+        expected_data, expected_status = asgi_api.query_response({"poolId": 99991369, "percentile": 30})
+
+        #assert
+        assert status == expected_status == 200
+        assert data == expected_data
+        assert data["total_count_of_elements"] == 6
+
+    def test_query_pool_does_not_exist(self, pool_file):
+        #setup
+        status, data = call_app("POST", "/query", json.dumps({"poolId": 99991369, "percentile": 30}).encode())
+
+        #assert
+        assert status == 400
+        assert data == {"error": "poolId does not exist"}
+
+    def test_query_batch(self, pool_file):
+        #setup
+        call_app("POST", "/update", json.dumps({"poolId": 99991369, "poolValues": [3, 1, 2]}).encode())
+
+        status, data = call_app("POST", "/query/batch", json.dumps({"poolIds": [99991369], "percentiles": [0, 100]}).encode())
+
+        #assert
+        assert status == 200
+        assert data["results"][0]["quantiles"] == [{"percentile": 0, "calculated_quantile": 1}, {"percentile": 100, "calculated_quantile": 3}]
+
+class TestAsgiRouting(object):
+    def test_unknown_path(self):
+        #assert
+        assert call_app("POST", "/unknown")[0] == 404
+
+    def test_wrong_method(self):
+        #assert
+        assert call_app("GET", "/query")[0] == 405
+
+    def test_stats(self):
+        #setup
+        status, data = call_app("GET", "/stats")
+
+        #assert
+        assert status == 200
+        assert "cache" in data
+
+class TestAsgiProcessExecutor(object):
+    def test_spawned_processes(self, monkeypatch):
+        #setup
+        monkeypatch.setattr(asgi_api, 'POOL_ASYNC_EXECUTOR', 'process')
+        monkeypatch.setattr(asgi_api, 'POOL_ASYNC_WORKERS', 1)
+        monkeypatch.setattr(asgi_api, 'executor', None)
+        try:
+            status, data = call_app("GET", "/stats") # handled by the worker process
+            start_method = asgi_api.executor._mp_context.get_start_method()
+        finally:
+            asgi_api.shutdown_executor()
+
+        #assert
+        assert status == 200
+        assert "cache" in data
+        assert start_method == 'spawn'
+
+class TestAsgiProfiling(object):
+    def test_profile_request(self, tmp_path, monkeypatch):
+        #setup
+        monkeypatch.setattr(asgi_api.api, 'profiler', Profiler(str(tmp_path)))
+        call_app("POST", "/query", json.dumps({"poolId": 99991369, "percentile": 101}).encode())
+        status, data = call_app("POST", "/query", json.dumps({"poolId": 99991369, "percentile": 101}).encode(), query_string=b"profile=1")
+
+        #assert
+        assert status == 400
+        assert len(os.listdir(tmp_path)) == 1
+        assert os.listdir(tmp_path)[0].endswith('.prof')
@@ -0,0 +1,218 @@
+import pytest
+from cache import PoolCache, CachedStorage, QueryCounter, SummaryCache
+from storage import BinaryStorage, CsvStorage
+import os
+import numpy as np
+import pandas as pd
+
+class TestPoolCache(object):
+    def test_hit_and_miss(self):
+        #setup
+        cache = PoolCache(max_bytes=10**6)
+        cache.put(1, [1, 2, 3], stamp=(1, 10))
+
+        #assert
+        assert cache.get(1, (1, 10)) == [1, 2, 3]
+        assert cache.get(1, (2, 20)) is None # file changed since the pool was cached
+        assert cache.get(2, (1, 10)) is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 2
+
+    def test_lru_eviction(self):
+        #setup
+        cache = PoolCache(max_bytes=2 * 8 * 100)
+        for id in (1, 2):
+            cache.put(id, np.zeros(100), stamp=None)
+        cache.get(1, None) # pool 2 becomes the least recently used
+        cache.put(3, np.zeros(100), stamp=None)
+
+        #assert
+        assert cache.get(1, None) is not None
+        assert cache.get(2, None) is None
+        assert cache.get(3, None) is not None
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["bytes"] == 2 * 8 * 100
+
+    def test_eviction_flushes_dirty_entry(self):
+        #setup
+        flushed = []
+        cache = PoolCache(max_bytes=8 * 100, write_back=True)
+        cache.put(1, np.zeros(100), stamp=None, flush=lambda: flushed.append(1))
+        cache.put(2, np.zeros(100), stamp=None)
+
+        #assert
+        assert flushed == [1]
+
+    def test_flush(self):
+        #setup
+        flushed = []
+        cache = PoolCache(max_bytes=10**6, write_back=True)
+        cache.put(1, [1], stamp=None, flush=lambda: flushed.append(1))
+
+        #assert
+        assert cache.stats()["dirty_entries"] == 1
+        assert cache.flush() == 1
+        assert cache.flush() == 0 # already written back
+        assert flushed == [1]
+
+    def test_invalidate(self):
+        #setup
+        cache = PoolCache(max_bytes=10**6)
+        cache.put(1, [1], stamp=None)
+        cache.invalidate(1)
+
+        #assert
+        assert cache.get(1, None) is None
+        assert cache.stats()["bytes"] == 0
+
+class TestQueryCounter(object):
+    def test_record(self, monkeypatch):
+        #setup
+        now = [0.0]
+        monkeypatch.setattr('cache.time.monotonic', lambda: now[0])
+        counter = QueryCounter(half_life=10)
+
+        count_1 = counter.record(1)
+        count_2 = counter.record(1)
+        now[0] = 10.0
+        count_3 = counter.record(1)
+
+        #assert
+        assert count_1 == 1
+        assert count_2 == 2
+        assert count_3 == 2 # halved after one half life, plus this query
+        assert counter.record(2) == 1
+
+    def test_max_pools(self):
+        #setup
+        counter = QueryCounter(max_pools=2)
+        for id in (1, 2, 3):
+            counter.record(id)
+
+        #assert
+        assert list(counter.counters) == [2, 3]
+
+class TestSummaryCache(object):
+    def test_get_checks_stamp(self):
+        #setup
+        cache = SummaryCache()
+        cache.put(1, {"count": 1}, stamp=(1, 2))
+
+        #assert
+        assert cache.get(1, (1, 2)) == {"count": 1}
+        assert cache.get(1, (1, 3)) is None # the pool was appended to
+        assert cache.get(2, (1, 2)) is None
+
+    def test_max_pools_and_stats(self):
+        #setup
+        cache = SummaryCache(max_pools=2)
+        for id in (1, 2, 3):
+            cache.put(id, {"count": id}, stamp=None)
+        for outcome in ('hits', 'hits', 'hits', 'misses'):
+            cache.record(outcome)
+
+        #assert
+        assert list(cache.entries) == [2, 3]
+        assert cache.stats() == {"hits": 3, "misses": 1, "off_grid": 0, "hit_rate": 0.75, "entries": 2, "max_pools": 2}
+
+class TestCachedStorage(object):
+    def test_query_hits_cache_until_append(self, tmp_path):
+        #setup
+        storage = CachedStorage(BinaryStorage(str(tmp_path)), PoolCache(max_bytes=10**6))
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+
+        sorted_values_1 = storage.get_sorted_pool_values(1369)
+        sorted_values_2 = storage.get_sorted_pool_values(1369)
+        storage.update_pool({"poolId": 1369, "poolValues": [0]})
+        sorted_values_3 = storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert list(sorted_values_1) == [1, 2, 3]
+        assert sorted_values_2 is sorted_values_1
+        assert list(sorted_values_3) == [0, 1, 2, 3]
+        assert storage.cache.stats()["hits"] == 1
+        assert storage.cache.stats()["misses"] == 2
+
+    def test_write_back_is_delayed_until_flush(self, tmp_path, monkeypatch):
+        #setup
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('data')
+        storage = CachedStorage(CsvStorage(), PoolCache(max_bytes=10**6, write_back=True))
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+        file_path = storage.get_path_by_id(1369)
+
+        sorted_pool_values_list = storage.get_sorted_pool_values(1369)
+        sorted_length_before_flush = pd.read_csv(file_path, index_col="poolId").loc[1369]["sorted_length"]
+        storage.cache.flush()
+        df = pd.read_csv(file_path, index_col="poolId")
+
+        #assert
+        assert sorted_pool_values_list == [1, 2, 3]
+        assert sorted_length_before_flush == 0
+        assert df.loc[1369]["poolValues"] == "[1, 2, 3]"
+        assert df.loc[1369]["sorted_length"] == 3
+
+    def test_write_back_skipped_when_pool_changed(self, tmp_path):
+        #setup
+        binary_storage = BinaryStorage(str(tmp_path))
+        storage = CachedStorage(binary_storage, PoolCache(max_bytes=10**6, write_back=True))
+        binary_storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+
+        storage.get_sorted_pool_values(1369)
+        binary_storage.update_pool({"poolId": 1369, "poolValues": [0]}) # written behind the cache's back
+        storage.cache.flush()
+        values, sorted_length = binary_storage.read_pool_values(1369)
+
+        #assert
+        assert list(values) == [3, 1, 2, 0]
+        assert sorted_length == 0
+
+    @pytest.mark.parametrize("write_back", [False, True])
+    @pytest.mark.parametrize("get_sorted_values", [lambda storage: storage.get_sorted_pool_values(1369),
+                                                   lambda storage: storage.get_sorted_pools_values([1369])[1369]], ids=['pool', 'batch'])
+    def test_update_between_read_and_caching_is_not_lost(self, tmp_path, monkeypatch, write_back, get_sorted_values):
+        #setup
+        binary_storage = BinaryStorage(str(tmp_path))
+        storage = CachedStorage(binary_storage, PoolCache(max_bytes=10**6, write_back=write_back))
+        binary_storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+        read_sorted_pool_values = binary_storage.read_sorted_pool_values
+
+        def read_then_update(id):
+            read = read_sorted_pool_values(id)
+            binary_storage.update_pool({"poolId": id, "poolValues": [0]}) # lands after the read, before the values are cached
+            return read
+        monkeypatch.setattr(binary_storage, 'read_sorted_pool_values', read_then_update)
+
+        stale_values = get_sorted_values(storage)
+        monkeypatch.undo()
+        storage.cache.flush()
+        sorted_values = get_sorted_values(storage)
+        values, _ = binary_storage.read_pool_values(1369)
+
+        #assert
+        assert list(stale_values) == [1, 2, 3]
+        assert list(sorted_values) == [0, 1, 2, 3] # not served from the cache
+        assert sorted(values) == [0, 1, 2, 3] # the write-back did not drop the appended value
+
+    def test_get_pool_values_returns_cached_sorted_pool(self, tmp_path):
+        #setup
+        storage = CachedStorage(BinaryStorage(str(tmp_path)), PoolCache(max_bytes=10**6))
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+
+        values, sorted_length = storage.get_pool_values(1369) # unsorted pools are not cached
+        sorted_values = storage.get_sorted_pool_values(1369)
+        cached_values, cached_sorted_length = storage.get_pool_values(1369)
+
+        #assert
+        assert list(values) == [3, 1, 2]
+        assert sorted_length == 0
+        assert cached_values is sorted_values
+        assert cached_sorted_length == 3
+
+    def test_missing_pool_is_not_cached(self, tmp_path):
+        #setup
+        storage = CachedStorage(BinaryStorage(str(tmp_path)), PoolCache(max_bytes=10**6))
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) is None
+        assert storage.cache.stats()["entries"] == 0
@@ -0,0 +1,62 @@
+import pytest
+from codec import JsonCodec, OrjsonCodec, get_json_codec, parse_binary_pool
+import json
+import numpy as np
+
+class TestJsonCodec(object):
+    @pytest.mark.parametrize("codec", [JsonCodec(), OrjsonCodec()])
+    def test_loads_matches_json(self, codec):
+        #setup
+        documents = ['{"poolId": 1369, "poolValues": [1, 7, 2.5, 1e-05, -0.0, 3.141592653589793]}',
+                     '{"poolId": -9223372036854775808, "poolValues": [18446744073709551615]}',
+                     '{"poolValues": [NaN, Infinity]}',
+                     '[true, null, "1"]']
+
+        #assert
+        for document in documents:
+            loaded, expected = codec.loads(document.encode()), json.loads(document)
+            assert repr(loaded) == repr(expected) # same values and same int / float types
+        with pytest.raises(ValueError):
+            codec.loads(b'{"poolId": ')
+
+    def test_orjson_big_int(self):
+        #assert
+        assert JsonCodec().loads(b'[18446744073709551616]') == [18446744073709551616]
+        assert type(OrjsonCodec().loads(b'[18446744073709551616]')[0]) is float # beyond 64 bits
+
+    @pytest.mark.parametrize("codec", [JsonCodec(), OrjsonCodec()])
+    def test_dumps(self, codec):
+        #setup
+        resp = {"total_count_of_elements": 3, "calculated_quantile": np.float64(4.6), "approximate": False, "big": 2**70}
+
+        #assert
+        assert json.loads(codec.dumps(resp)) == {"approximate": False, "big": 2**70, "calculated_quantile": 4.6, "total_count_of_elements": 3}
+        assert list(json.loads(codec.dumps(resp))) == ["approximate", "big", "calculated_quantile", "total_count_of_elements"]
+
+    def test_get_json_codec(self):
+        #assert
+        assert get_json_codec('auto').name == 'orjson'
+        assert get_json_codec('json').name == 'json'
+        with pytest.raises(ValueError):
+            get_json_codec('pickle')
+
+class TestParseBinaryPool(object):
+    def test_valid_pool(self):
+        #setup
+        is_valid, message, pool = parse_binary_pool('-1369', np.array([3, 1.5, 2], dtype='<f8').tobytes())
+
+        #assert
+        assert is_valid
+        assert pool["poolId"] == -1369
+        assert pool["poolValues"].tolist() == [3, 1.5, 2]
+
+    @pytest.mark.parametrize("id_arg, body, message", [
+        (None, b'\x00' * 8, "Pool must contain both 'poolId' and 'poolValues' and only contain this values"),
+        ('13.5', b'\x00' * 8, "'poolId' must be an integer"),
+        ('1369', b'', "Number of elements in 'poolValues' must be greater than 0"),
+        ('1369', b'\x00' * 12, "Binary 'poolValues' must be little-endian float64, the body length must be a multiple of 8"),
+        ('1369', np.array([1, np.nan]).tobytes(), "All elements of 'poolValues' must be real number"),
+    ])
+    def test_invalid_pool(self, id_arg, body, message):
+        #assert
+        assert parse_binary_pool(id_arg, body) == (False, message, None)
@@ -0,0 +1,174 @@
+import pytest
+from locks import ReadWriteLock, ShardLocks, replace_file
+from storage import BinaryStorage, CsvStorage
+import os
+import time
+import threading
+import multiprocessing
+
+TOTAL_APPENDERS = 4
+TOTAL_APPENDS = 25
+POOL_IDS = (1369, 1370) # same shard
+
+def append_values(storage, appender):
+    for i in range(TOTAL_APPENDS):
+        for id in POOL_IDS:
+            storage.update_pool({"poolId": id, "poolValues": [appender * 1000 + i]})
+
+def query_values(storage, stop):
+    while not stop.is_set():
+        for id in POOL_IDS:
+            storage.get_sorted_pool_values(id)
+
+def run_appenders_and_queriers(storage, total_queriers=2):
+    stop = threading.Event()
+    appenders = [threading.Thread(target=append_values, args=(storage, appender)) for appender in range(TOTAL_APPENDERS)]
+    queriers = [threading.Thread(target=query_values, args=(storage, stop)) for _ in range(total_queriers)]
+    for thread in appenders + queriers:
+        thread.start()
+    for thread in appenders:
+        thread.join()
+    stop.set()
+    for thread in queriers:
+        thread.join()
+
+def expected_values(total_appenders=TOTAL_APPENDERS):
+    return sorted(appender * 1000 + i for appender in range(total_appenders) for i in range(TOTAL_APPENDS))
+
+def append_values_in_process(directory, lock_dir, appender):
+    os.chdir(directory)
+    append_values(CsvStorage(locks=ShardLocks(lock_dir)), appender)
+
+class TestReadWriteLock(object):
+    def test_readers_share_writer_excludes(self):
+        #setup
+        lock = ReadWriteLock()
+        events = []
+        lock.acquire_read()
+        lock.acquire_read() # a second reader does not wait
+
+        def write():
+            lock.acquire_write()
+            events.append("write")
+            lock.release_write()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        time.sleep(0.1)
+        events.append("readers done")
+        lock.release_read()
+        lock.release_read()
+        writer.join()
+
+        #assert
+        assert events == ["readers done", "write"]
+
+    def test_waiting_writer_blocks_new_readers(self):
+        #setup
+        lock = ReadWriteLock()
+        events = []
+        lock.acquire_read()
+
+        def write():
+            lock.acquire_write()
+            events.append("write")
+            lock.release_write()
+
+        def read():
+            lock.acquire_read()
+            events.append("read")
+            lock.release_read()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        time.sleep(0.1)
+        reader = threading.Thread(target=read)
+        reader.start()
+        time.sleep(0.1)
+        lock.release_read()
+        writer.join()
+        reader.join()
+
+        #assert
+        assert events == ["write", "read"]
+
+class TestShardLocks(object):
+    def test_lock_file_outside_of_shard_directory(self, tmp_path):
+        #setup
+        locks = ShardLocks(str(tmp_path / 'locks'))
+        with locks.writing('data/1.csv'):
+            pass
+
+        #assert
+        assert locks.get_lock_path('data/1.csv') == locks.get_lock_path(os.path.abspath('data/1.csv'))
+        assert locks.get_lock_path('data/1.csv') != locks.get_lock_path('data/2.csv')
+        assert os.listdir(str(tmp_path / 'locks')) == [os.path.basename(locks.get_lock_path('data/1.csv'))]
+
+class TestReplaceFile(object):
+    def test_replace_file(self, tmp_path):
+        #setup
+        path = str(tmp_path / '1.csv')
+        replace_file(path, lambda f: f.write("a\n"), mode='w')
+        replace_file(path, lambda f: f.write("b\n"), mode='w')
+
+        #assert
+        assert open(path).read() == "b\n"
+        assert os.listdir(str(tmp_path)) == ['1.csv'] # no temporary file left
+
+    def test_failed_write_keeps_old_file(self, tmp_path):
+        #setup
+        path = str(tmp_path / '1.csv')
+        replace_file(path, lambda f: f.write("a\n"), mode='w')
+
+        def write(f):
+            f.write("half written")
+            raise IOError("disk full")
+
+        with pytest.raises(IOError):
+            replace_file(path, write, mode='w')
+
+        #assert
+        assert open(path).read() == "a\n"
+        assert os.listdir(str(tmp_path)) == ['1.csv']
+
+class TestConcurrentAppendersAndQueriers(object):
+    @pytest.fixture(autouse=True)
+    def data_dir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('data')
+
+    @pytest.mark.parametrize("write_mode", ['rewrite', 'log'])
+    def test_csv_storage(self, tmp_path, write_mode):
+        #setup
+        storage = CsvStorage(write_mode, locks=ShardLocks(str(tmp_path / 'locks')))
+        run_appenders_and_queriers(storage)
+
+        #assert
+        for id in POOL_IDS:
+            assert storage.get_sorted_pool_values(id) == expected_values() # no value lost
+            assert storage.get_pool_values(id)[1] == len(expected_values())
+
+    def test_binary_storage(self, tmp_path):
+        #setup
+        storage = BinaryStorage('data', locks=ShardLocks(str(tmp_path / 'locks')))
+        run_appenders_and_queriers(storage)
+
+        #assert
+        for id in POOL_IDS:
+            assert list(storage.get_sorted_pool_values(id)) == expected_values()
+
+    def test_csv_storage_across_processes(self, tmp_path):
+        #setup
+        lock_dir = str(tmp_path / 'locks')
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=append_values_in_process, args=(str(tmp_path), lock_dir, appender)) for appender in range(TOTAL_APPENDERS)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        storage = CsvStorage(locks=ShardLocks(lock_dir))
+
+        #assert
+        assert [process.exitcode for process in processes] == [0] * TOTAL_APPENDERS
+        for id in POOL_IDS:
+            assert storage.get_sorted_pool_values(id) == expected_values()
@@ -0,0 +1,97 @@
+import pytest
+from logs import SamplingFilter, RequestIdFilter, JsonFormatter, ValuesSummary, PayloadSummary, set_request_id, get_request_id, configure_logging
+import io
+import json
+import logging
+import threading
+import numpy as np
+
+def make_record(msg, args=(), level=logging.INFO):
+    return logging.LogRecord('api', level, __file__, 1, msg, args, None)
+
+class TestSamplingFilter(object):
+    def test_sample_rate(self):
+        #setup
+        sampling = SamplingFilter(sample_rate=10)
+        kept = [sampling.filter(make_record("Check if given path exists")) for _ in range(25)]
+        kept_with_args = [sampling.filter(make_record("Updated %d pools", (i,))) for i in range(25)]
+
+        #assert
+        assert kept.count(True) == 3 # the 1st, 11th and 21st
+        assert kept[0] is True
+        assert kept_with_args.count(True) == 3 # one template whatever the arguments
+
+    def test_warnings_are_kept(self):
+        #setup
+        sampling = SamplingFilter(sample_rate=10)
+
+        #assert
+        assert all(sampling.filter(make_record("Request failed", level=logging.ERROR)) for _ in range(5))
+        assert all(SamplingFilter().filter(make_record("Check if given path exists")) for _ in range(5))
+
+class TestRequestId(object):
+    def test_request_id_per_thread(self):
+        #setup
+        request_ids = {}
+        def handle(name):
+            set_request_id(name)
+            record = make_record("ENDPOINT /query")
+            RequestIdFilter().filter(record)
+            request_ids[name] = record.request_id
+        threads = [threading.Thread(target=handle, args=(name,)) for name in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        #assert
+        assert request_ids == {"a": "a", "b": "b"}
+        assert len(set_request_id(None)) == 16
+        assert len(set_request_id("x" * 1000)) == 64
+
+    def test_json_format(self):
+        #setup
+        stream = io.StringIO()
+        configure_logging('INFO', log_format='json', stream=stream)
+        set_request_id("1369")
+        logging.getLogger('api').info("QUERY DATA: %s", {"poolId": 1})
+
+        #assert
+        entry = json.loads(stream.getvalue())
+        assert entry["request_id"] == "1369"
+        assert entry["message"] == "QUERY DATA: {'poolId': 1}"
+        assert entry["level"] == "INFO"
+
+        #teardown
+        configure_logging('INFO')
+
+class TestPayloadSummary(object):
+    def test_values_summary(self):
+        #assert
+        assert str(ValuesSummary([3, 1.5, 2])) == "<3 values, min 1.5, max 3>"
+        assert str(ValuesSummary(np.array([3, 1.5, 2]))) == "<3 values, min 1.5, max 3.0>"
+        assert str(ValuesSummary([1, "2"])) == "<2 values>"
+        assert str(ValuesSummary([])) == "<0 values>"
+
+    def test_payload_summary(self):
+        #setup
+        pool = {"poolId": 1369, "poolValues": list(range(100))}
+
+        #assert
+        assert str(PayloadSummary(pool, max_values=10)) == "{'poolId': 1369, 'poolValues': '<100 values, min 0, max 99>'}"
+        assert str(PayloadSummary({"poolId": 1369, "poolValues": [1, 2]})) == "{'poolId': 1369, 'poolValues': [1, 2]}"
+        assert str(PayloadSummary(None)) == "None"
+
+    def test_summary_is_lazy(self):
+        #setup
+        class Values(list):
+            formatted = 0
+            def __len__(self):
+                Values.formatted += 1
+                return list.__len__(self)
+        logger = logging.getLogger('test_logs.lazy')
+        logger.setLevel(logging.WARNING)
+        logger.info("Sort pool values list: %s", ValuesSummary(Values(range(10))))
+
+        #assert
+        assert Values.formatted == 0
@@ -0,0 +1,102 @@
+import pytest
+from maintenance import Resorter
+from storage import CsvStorage, BinaryStorage
+from metrics import RESORTED_SHARDS
+import time
+import random
+
+def make_storage(storage_class, tmp_path):
+    storage = storage_class(root=str(tmp_path))
+    rng = random.Random(0)
+    for id in (1369, 1370, 2369):
+        storage.update_pool({"poolId": id, "poolValues": [rng.randint(0, 100) for _ in range(50)]})
+        storage.update_pool({"poolId": id, "poolValues": [rng.randint(0, 100) / 2 for _ in range(50)]})
+    storage.update_pool({"poolId": 2370, "poolValues": [1]}) # already sorted
+    return storage
+
+class TestResorter(object):
+    @pytest.mark.parametrize("storage_class", [CsvStorage, BinaryStorage])
+    def test_sort_unsorted_pools(self, tmp_path, storage_class):
+        #setup
+        storage = make_storage(storage_class, tmp_path)
+        values = {id: list(storage.get_pool_values(id)[0]) for id in (1369, 1370, 2369, 2370)}
+        unsorted_pools = {}
+        for path in storage.get_shard_paths():
+            unsorted_pools.update(storage.get_unsorted_pools(path))
+
+        sorted_pools = Resorter(storage, max_values_per_second=0, cpu_budget=1).run_once()
+
+        #assert
+        assert unsorted_pools == {1369: 100, 1370: 100, 2369: 100}
+        assert sorted_pools == 3
+        assert all(storage.get_unsorted_pools(path) == {} for path in storage.get_shard_paths())
+        for id, pool_values in values.items():
+            pool_values_list, sorted_length = storage.get_pool_values(id)
+            assert list(pool_values_list) == sorted(pool_values)
+            assert sorted_length == len(pool_values)
+        assert Resorter(storage).run_once() == 0 # nothing left to sort
+
+    def test_update_during_sort_is_kept(self, tmp_path):
+        #setup
+        storage = make_storage(CsvStorage, tmp_path)
+        save_if_unchanged = storage.save_if_unchanged
+        def update_then_save(path, df, file_stamp):
+            storage.save_if_unchanged = save_if_unchanged
+            storage.update_pool({"poolId": 1369, "poolValues": [-1]}) # between the sort and its save
+            return save_if_unchanged(path, df, file_stamp)
+        storage.save_if_unchanged = update_then_save
+        skipped = RESORTED_SHARDS.labels('skipped').value
+        resorter = Resorter(storage, max_values_per_second=0, cpu_budget=1)
+
+        first_pass = resorter.run_once()
+        values_list, sorted_length = storage.get_pool_values(1369)
+        second_pass = resorter.run_once()
+
+        #assert
+        assert first_pass == 1 # the sort of shard 1 is dropped, 2369 of shard 2 is sorted
+        assert RESORTED_SHARDS.labels('skipped').value == skipped + 1
+        assert len(values_list) == 101 and values_list[-1] == -1
+        assert sorted_length == 0
+        assert second_pass == 2
+        assert storage.get_pool_values(1369)[0][0] == -1
+
+    def test_waits_for_idle_time(self, tmp_path):
+        #setup
+        storage = make_storage(CsvStorage, tmp_path)
+        resorter = Resorter(storage, idle_delay=0.3, max_values_per_second=0, cpu_budget=1)
+        resorter.touch()
+
+        start = time.monotonic()
+        resorter.run_once()
+        elapsed = time.monotonic() - start
+
+        #assert
+        assert elapsed >= 0.3
+
+    def test_rate_limit_and_cpu_budget(self, tmp_path):
+        #setup
+        storage = make_storage(CsvStorage, tmp_path)
+        resorter = Resorter(storage, max_values_per_second=1000, cpu_budget=1)
+
+        start = time.monotonic()
+        resorter.run_once()
+        elapsed = time.monotonic() - start
+
+        #assert
+        assert elapsed >= 0.3 # 300 values at 1000 per second
+        with pytest.raises(ValueError):
+            Resorter(storage, cpu_budget=0)
+
+    def test_background_thread(self, tmp_path):
+        #setup
+        storage = make_storage(BinaryStorage, tmp_path)
+        resorter = Resorter(storage, interval=0.05, idle_delay=0)
+        resorter.start()
+        deadline = time.monotonic() + 10
+        while any(storage.get_unsorted_pools(path) for path in storage.get_shard_paths()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        resorter.stop()
+
+        #assert
+        assert not any(storage.get_unsorted_pools(path) for path in storage.get_shard_paths())
+        assert not resorter.thread.is_alive()
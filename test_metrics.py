@@ -0,0 +1,105 @@
+import pytest
+from metrics import Counter, Histogram, CallbackMetric, Registry, timed, REGISTRY, STAGE_SECONDS, BYTES_WRITTEN, BYTES_READ, SORTS
+from storage import CsvStorage, BinaryStorage
+import os
+import time
+
+class TestMetrics(object):
+    def test_counter(self):
+        #setup
+        registry = Registry()
+        requests_total = registry.register(Counter('test_requests_total', "Requests", ['endpoint', 'status']))
+        requests_total.labels('/query', 200).inc()
+        requests_total.labels('/query', 200).inc(2)
+        requests_total.labels('/query', 400).inc()
+
+        #assert
+        assert registry.render().splitlines() == ['# HELP test_requests_total Requests',
+                                                  '# TYPE test_requests_total counter',
+                                                  'test_requests_total{endpoint="/query",status="200"} 3',
+                                                  'test_requests_total{endpoint="/query",status="400"} 1']
+        with pytest.raises(ValueError):
+            registry.register(Counter('test_requests_total', "Requests"))
+
+    def test_histogram(self):
+        #setup
+        registry = Registry()
+        seconds = registry.register(Histogram('test_seconds', "Latency", ['stage'], buckets=(0.1, 1.0)))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            seconds.labels('sort').observe(value)
+
+        #assert
+        assert registry.render().splitlines()[2:] == ['test_seconds_bucket{stage="sort",le="0.1"} 2',
+                                                      'test_seconds_bucket{stage="sort",le="1.0"} 3',
+                                                      'test_seconds_bucket{stage="sort",le="+Inf"} 4',
+                                                      'test_seconds_sum{stage="sort"} 3.65',
+                                                      'test_seconds_count{stage="sort"} 4']
+
+    def test_callback_metric(self):
+        #setup
+        registry = Registry()
+        registry.register(CallbackMetric('test_hit_rate', "Hit rate", ['cache'], lambda: {('summary',): 0.5}))
+
+        #assert
+        assert registry.render().splitlines()[2:] == ['test_hit_rate{cache="summary"} 0.5']
+
+    def test_label_escaping(self):
+        #setup
+        registry = Registry()
+        registry.register(Counter('test_total', "Total", ['path'])).labels('a"b\\c').inc()
+
+        #assert
+        assert registry.render().splitlines()[2] == 'test_total{path="a\\"b\\\\c"} 1'
+
+    def test_timed(self):
+        #setup
+        @timed('test_stage')
+        def slow(x):
+            time.sleep(0.01)
+            return x
+        @timed('test_stage_error')
+        def failing():
+            raise ValueError()
+
+        result = slow(1369)
+        with pytest.raises(ValueError):
+            failing()
+
+        #assert
+        assert result == 1369
+        assert slow.__name__ == 'slow'
+        assert STAGE_SECONDS.labels('test_stage').count == 1
+        assert STAGE_SECONDS.labels('test_stage').sum >= 0.01
+        assert STAGE_SECONDS.labels('test_stage_error').count == 1
+
+class TestStorageInstrumentation(object):
+    def test_csv_storage(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path))
+        written_before = BYTES_WRITTEN.labels('.csv').value
+        read_before = BYTES_READ.labels('.csv').value
+        sorts_before = SORTS.labels('timsort').value
+        load_before = STAGE_SECONDS.labels('load_data').count
+
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+        first_size = os.path.getsize(storage.get_path_by_id(1369))
+        storage.update_pool({"poolId": 1369, "poolValues": [0]})
+        storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert BYTES_WRITTEN.labels('.csv').value - written_before == first_size + 2 * os.path.getsize(storage.get_path_by_id(1369)) # insert, append, saved sort
+        assert BYTES_READ.labels('.csv').value > read_before
+        assert SORTS.labels('timsort').value == sorts_before + 1
+        assert STAGE_SECONDS.labels('load_data').count == load_before + 2 # the append and the sort
+
+    def test_binary_storage(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        written_before = BYTES_WRITTEN.labels('.f64').value
+
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+        storage.update_pool({"poolId": 1369, "poolValues": [0]})
+
+        #assert
+        assert BYTES_WRITTEN.labels('.f64').value - written_before == 16 + 3 * 8 + 8
+        assert 'pool_bytes_written_total{file=".f64"}' in REGISTRY.render()
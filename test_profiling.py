@@ -0,0 +1,95 @@
+import pytest
+from profiling import Profiler, StackSampler, get_profiler, install_flask_profiler, summarize_profiles, merge_folded_stacks, print_report
+from flask import Flask
+import io
+import os
+import time
+import pstats
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def make_app(profiler):
+    app = Flask(__name__)
+    @app.route("/query", methods=['POST'])
+    def query():
+        busy_wait(0.02)
+        return {"calculated_quantile": 1}
+    @app.route("/stats", methods=['GET'])
+    def stats():
+        return {}
+    install_flask_profiler(app, profiler, lambda: "abc/../1369")
+    return app
+
+class TestProfiler(object):
+    def test_off_by_default(self):
+        #assert
+        assert get_profiler('') is None
+        with pytest.raises(ValueError):
+            Profiler('profiles', mode='perf')
+
+    def test_should_profile(self, tmp_path):
+        #setup
+        requested_only = Profiler(str(tmp_path))
+        sampled = Profiler(str(tmp_path), sample_rate=3)
+
+        #assert
+        assert requested_only.should_profile('/query', True)
+        assert not requested_only.should_profile('/query', False)
+        assert not requested_only.should_profile('/stats', True) # only /update and /query
+        assert [sampled.should_profile('/update', False) for _ in range(6)] == [False, False, True, False, False, True]
+
+    def test_flask_cprofile(self, tmp_path):
+        #setup
+        client = make_app(Profiler(str(tmp_path))).test_client()
+        client.post('/query', json={})
+        client.post('/query?profile=1', json={})
+        client.post('/query', json={}, headers={"X-Profile": "1"})
+        client.get('/stats', headers={"X-Profile": "1"})
+        file_names = os.listdir(tmp_path)
+
+        #assert
+        assert len(file_names) == 2
+        assert all(file_name.endswith('-abc____1369.prof') for file_name in file_names) # the request ID cannot leave the directory
+        stats = pstats.Stats(str(tmp_path / file_names[0]))
+        assert any(function_name == 'busy_wait' for (file_name, line, function_name) in stats.stats)
+
+    def test_flask_stack_sampler(self, tmp_path):
+        #setup
+        client = make_app(Profiler(str(tmp_path), mode='sample', sample_rate=1)).test_client()
+        client.post('/query', json={})
+        paths, endpoints = summarize_profiles(str(tmp_path))
+        self_samples, total_samples = merge_folded_stacks(paths)
+
+        #assert
+        assert len(paths) == 1 and paths[0].endswith('.folded')
+        assert endpoints["query"]["profiles"] == 1
+        assert endpoints["query"]["median_ms"] >= 20
+        assert max(self_samples, key=self_samples.get).startswith('busy_wait (test_profiling.py')
+        assert any(frame.startswith('query (test_profiling.py') for frame in total_samples)
+
+    def test_max_files(self, tmp_path):
+        #setup
+        profiler = Profiler(str(tmp_path), max_files=1)
+        saved = [profiler.save(profiler.start(), '/query', str(i), 0.001) for i in range(3)]
+
+        #assert
+        assert saved[0] is not None
+        assert saved[1:] == [None, None]
+        assert len(os.listdir(tmp_path)) == 1
+
+    def test_report(self, tmp_path):
+        #setup
+        profiler = Profiler(str(tmp_path))
+        profiler.run('/query', '1', busy_wait, 0.01)
+        profiler.run('/update/bulk', '2', busy_wait, 0.01)
+        stream = io.StringIO()
+        print_report(str(tmp_path), endpoint='update_bulk', stream=stream)
+
+        #assert
+        assert summarize_profiles(str(tmp_path))[1].keys() == {"query", "update_bulk"}
+        assert "update_bulk: 1 profiles" in stream.getvalue()
+        assert "query: " not in stream.getvalue()
+        assert "busy_wait" in stream.getvalue()
@@ -0,0 +1,120 @@
+import pytest
+from sharding import LegacySharding, RangeSharding, HashSharding, SizeBoundedSharding, get_sharding, save_shard_map
+from storage import CsvStorage, BinaryStorage
+from sketch import SketchStore
+from windows import WindowStore
+from rebalance import rebalance, plan_size_bounded_shards
+import os
+import pandas as pd
+
+class TestSharding(object):
+    def test_legacy_sharding(self):
+        #assert
+        assert LegacySharding().get_shard(1369) == "1"
+        assert LegacySharding().get_shard(-1369) == "1" # the original layout, kept for existing data
+
+    def test_range_sharding(self):
+        #setup
+        sharding = RangeSharding(range_size=100)
+
+        #assert
+        assert sharding.get_shard(1369) == "13"
+        assert sharding.get_shard(5) != sharding.get_shard(-5)
+
+    def test_hash_sharding(self):
+        #setup
+        sharding = HashSharding(total_shards=16)
+        shards = set(sharding.get_shard(id) for id in range(1000, 2000))
+
+        #assert
+        assert sharding.get_shard(1369) == sharding.get_shard(1369)
+        assert len(shards) == 16 # one busy poolId range is spread over every shard
+
+    def test_size_bounded_sharding(self, tmp_path):
+        #setup
+        sharding = SizeBoundedSharding(str(tmp_path))
+        shard_without_map = sharding.get_shard(1369)
+        save_shard_map(str(tmp_path), [(10, "s0"), (500, "s1"), (2000, "s2")])
+        sharding.checked_at = None # do not wait for the reload interval
+
+        #assert
+        assert shard_without_map == "1"
+        assert sharding.get_shard(-5) == "s0"
+        assert sharding.get_shard(499) == "s0"
+        assert sharding.get_shard(500) == "s1"
+        assert sharding.get_shard(10**9) == "s2"
+
+    def test_get_unknown_sharding(self):
+        #assert
+        assert isinstance(get_sharding('hash'), HashSharding)
+        with pytest.raises(ValueError):
+            get_sharding('random')
+
+    def test_storage_root_and_sharding(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), sharding=RangeSharding())
+        storage.update_pool({"poolId": 5, "poolValues": [1]})
+        storage.update_pool({"poolId": -5, "poolValues": [2]})
+
+        #assert
+        assert [os.path.basename(path) for path in storage.get_shard_paths()] == ["-1.csv", "0.csv"]
+        assert storage.get_sorted_pool_values(5) == [1]
+        assert storage.get_sorted_pool_values(-5) == [2]
+
+class TestRebalance(object):
+    def test_plan_size_bounded_shards(self):
+        #setup
+        pool_sizes = {1: 10, 2: 10, 3: 10, 1000: 50, 1001: 5, 5000: 1}
+
+        #assert
+        assert plan_size_bounded_shards(pool_sizes, 25) == [(1, "s0"), (3, "s1"), (1000, "s2"), (1001, "s3")]
+
+    def test_rebalance_csv(self, tmp_path):
+        #setup
+        source = CsvStorage(root=str(tmp_path / "source"))
+        os.mkdir(source.root)
+        large_pool = {"poolId": 1369, "poolValues": list(range(1000))}
+        source.update_pool(large_pool.copy())
+        for id in (1370, 1371, 2369, -2369):
+            source.update_pool({"poolId": id, "poolValues": [id, 1]})
+        source.get_sorted_pool_values(1370)
+        SketchStore(source.root).set_mode(7369, 'sketch', [1, 2])
+
+        summary = rebalance(source.root, str(tmp_path / "target"), sharding_name='size', max_shard_bytes=100)
+        target = CsvStorage(root=str(tmp_path / "target"), sharding=get_sharding('size', str(tmp_path / "target")))
+
+        #assert
+        assert summary["pools"] == 5
+        assert summary["target_shards"] == 3 # the large pool alone, the small ones merged
+        assert summary["target_largest_shard_bytes"] < summary["source_largest_shard_bytes"]
+        assert target.get_sorted_pool_values(1369) == list(range(1000))
+        assert target.get_pool_values(1370) == ([1, 1370], 2) # the sorted prefix is kept
+        assert target.get_sorted_pool_values(-2369) == [-2369, 1]
+        assert SketchStore(target.root).get_sketch(7369).count == 2
+
+    def test_rebalance_binary_to_hash(self, tmp_path):
+        #setup
+        source = BinaryStorage(str(tmp_path / "source"))
+        for id in range(1000, 1100):
+            source.update_pool({"poolId": id, "poolValues": [id, 0.5]})
+        window_store = WindowStore(source.root)
+        window_store.set_config(7369)
+        window_store.add_pools([{"poolId": 7369, "poolValues": [3, 1]}])
+
+        summary = rebalance(source.root, str(tmp_path / "target"), storage_name='binary', sharding_name='hash', total_shards=8)
+        target = BinaryStorage(str(tmp_path / "target"), sharding=HashSharding(8))
+
+        #assert
+        assert summary["source_shards"] == 1
+        assert summary["target_shards"] == 8
+        assert list(target.get_sorted_pool_values(1050)) == [0.5, 1050]
+        assert [run.tolist() for run in WindowStore(target.root).get_window_values(7369)] == [[1, 3]] # not a shard, copied as is
+
+    def test_target_must_be_empty(self, tmp_path):
+        #setup
+        (tmp_path / "target").mkdir()
+        (tmp_path / "target" / "1.csv").write_text("")
+
+        #assert
+        with pytest.raises(ValueError):
+            rebalance(str(tmp_path / "source"), str(tmp_path / "target"))
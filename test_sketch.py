@@ -0,0 +1,133 @@
+import pytest
+from sketch import DDSketch, SketchStore
+from api import calculate_quantile
+import os
+import json
+import numpy as np
+
+class TestDDSketch(object):
+    @pytest.mark.parametrize("relative_accuracy", [0.01, 0.05])
+    def test_relative_error_bound(self, relative_accuracy):
+        #setup
+        rng = np.random.default_rng(0)
+        values = np.concatenate([rng.lognormal(0, 2, 5000), -rng.lognormal(0, 1, 1000), np.zeros(10)]).tolist()
+        sketch = DDSketch(relative_accuracy)
+        sketch.add(values[:3000])
+        sketch.add(values[3000:])
+        sorted_values = sorted(values)
+
+        #assert
+        assert sketch.count == len(values)
+        for percentile in (0, 1, 10, 25, 50, 75, 90, 99, 99.9, 100):
+            exact_quantile = calculate_quantile(sorted_values, percentile)[0]
+            assert sketch.quantile(percentile) == pytest.approx(exact_quantile, rel=relative_accuracy, abs=1e-12)
+
+    def test_merge(self):
+        #setup
+        rng = np.random.default_rng(1)
+        values_1, values_2 = rng.uniform(1, 100, 1000), rng.uniform(50, 500, 1000)
+        merged = DDSketch()
+        merged.add(values_1)
+        other = DDSketch()
+        other.add(values_2)
+        merged.merge(other)
+        single = DDSketch()
+        single.add(np.concatenate([values_1, values_2]))
+
+        #assert
+        assert merged.to_dict() == single.to_dict()
+
+    def test_merge_different_accuracy(self):
+        #assert
+        with pytest.raises(ValueError):
+            DDSketch(0.01).merge(DDSketch(0.02))
+
+    def test_bucket_count_does_not_grow_with_values(self):
+        #setup
+        sketch = DDSketch(0.01)
+        for _ in range(10):
+            sketch.add(np.random.default_rng(2).uniform(1, 1000, 10000))
+
+        #assert
+        assert sketch.count == 100000
+        assert len(sketch.positive) <= 700 # log(1000) / log(1.01 / 0.99)
+
+    def test_single_value(self):
+        #setup
+        sketch = DDSketch()
+        sketch.add([3.5])
+
+        #assert
+        assert sketch.quantile(0) == sketch.quantile(50) == sketch.quantile(100) == 3.5
+
+    def test_to_dict_from_dict(self):
+        #setup
+        sketch = DDSketch(0.02)
+        sketch.add([-3, 0, 1, 7, 7.5])
+        restored = DDSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+
+        #assert
+        assert restored.to_dict() == sketch.to_dict()
+        assert restored.quantile(50) == sketch.quantile(50)
+        assert DDSketch().quantile(50) is None
+
+class TestSketchStore(object):
+    def test_modes(self, tmp_path):
+        #setup
+        store = SketchStore(str(tmp_path))
+        store.set_mode(1369, 'both', [1, 2, 3])
+        store.set_mode(1370, 'sketch')
+
+        #assert
+        assert store.get_mode(1369) == 'both'
+        assert store.get_mode(1370) == 'sketch'
+        assert store.get_mode(1371) == 'exact'
+        assert store.get_mode(2000) == 'exact'
+        assert store.get_modes([1369, 1371, 2000]) == {1369: 'both', 1371: 'exact', 2000: 'exact'}
+        assert store.get_sketch(1369).count == 3
+        assert sorted(os.listdir(str(tmp_path / 'sketches'))) == ['1369.sketch', '1370.sketch'] # one file per pool
+        assert store.get_pool_ids() == [1369, 1370]
+
+    def test_add_pools(self, tmp_path):
+        #setup
+        store = SketchStore(str(tmp_path), relative_accuracy=0.05)
+        store.set_mode(1369, 'sketch')
+        store.set_mode(2369, 'sketch')
+        statuses = store.add_pools([{"poolId": 1369, "poolValues": [1, 2]},
+                                    {"poolId": 2369, "poolValues": [5]},
+                                    {"poolId": 1369, "poolValues": [3]}])
+
+        #assert
+        assert statuses == ["inserted", "inserted", "appended"]
+        assert store.get_sketch(1369).count == 3
+        assert store.get_sketch(1369).relative_accuracy == 0.05
+        assert store.get_sketch(2369).quantile(50) == 5
+
+    def test_split_shard_files(self, tmp_path):
+        #setup
+        store = SketchStore(str(tmp_path))
+        sketch = DDSketch()
+        sketch.add([1, 2, 3])
+        os.makedirs(str(tmp_path / 'sketches'))
+        with open(str(tmp_path / 'sketches' / '1.json'), 'w') as f: # one file per shard, as saved by earlier versions
+            json.dump({"1369": {"mode": "both", "sketch": sketch.to_dict()}, "1370": {"mode": "sketch", "sketch": DDSketch().to_dict()}}, f)
+
+        split_shards = store.split_shard_files()
+
+        #assert
+        assert split_shards == 1
+        assert sorted(os.listdir(str(tmp_path / 'sketches'))) == ['1369.sketch', '1370.sketch']
+        assert store.get_modes([1369, 1370, 1371]) == {1369: 'both', 1370: 'sketch', 1371: 'exact'}
+        assert store.get_sketch(1369).count == 3
+        assert store.split_shard_files() == 0
+
+    def test_back_to_exact_drops_sketch(self, tmp_path):
+        #setup
+        store = SketchStore(str(tmp_path))
+        store.set_mode(1369, 'both', [1])
+        store.set_mode(1369, 'exact')
+
+        #assert
+        assert store.get_mode(1369) == 'exact'
+        assert store.get_sketch(1369) is None
+        assert store.get_pool_ids() == []
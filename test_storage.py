@@ -0,0 +1,691 @@
+import pytest
+from storage import BinaryStorage, CsvStorage, MappedPoolValues, sync_files, get_storage, read_pool_file, merge_sorted_prefix, parse_pool_values
+from api import calculate_quantile
+import storage as storage_module
+from migrate import migrate_csv_to_binary
+import os
+import glob
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+class TestBinaryStorage(object):
+    def test_insert_then_append_pool(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        pool_1 = {"poolId": 1369, "poolValues": [1, 7, 2]}
+        pool_2 = {"poolId": 1369, "poolValues": [2.5]}
+
+        status_1 = storage.update_pool(pool_1)
+        status_2 = storage.update_pool(pool_2)
+        values, sorted_length = storage.read_pool_values(1369)
+
+        #assert
+        assert status_1 == "inserted"
+        assert status_2 == "appended"
+        assert values.dtype == np.float64
+        assert list(values) == [1, 7, 2, 2.5]
+        assert sorted_length == 0
+
+    def test_append_after_torn_write(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        storage.update_pool({"poolId": 1369, "poolValues": [1, 7, 2]})
+        with open(storage.get_pool_path(1369), 'ab') as f:
+            f.write(np.float64(9).tobytes()[:5]) # a crash in the middle of an append
+
+        storage.update_pool({"poolId": 1369, "poolValues": [2.5, -1]})
+        values, sorted_length = storage.read_pool_values(1369)
+
+        #assert
+        assert list(values) == [1, 7, 2, 2.5, -1] # the partial value is dropped, the new ones stay aligned
+        assert os.path.getsize(storage.get_pool_path(1369)) == 16 + 5 * 8
+
+    def test_insert_poolvalues_has_one_element(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        storage.update_pool({"poolId": -12, "poolValues": [3]})
+
+        values, sorted_length = storage.read_pool_values(-12)
+
+        #assert
+        assert list(values) == [3]
+        assert sorted_length == 1 # because poolValues has just 1 element
+
+    def test_pool_does_not_exist(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) is None
+        assert storage.read_pool_values(1369) == (None, None)
+
+    def test_get_sorted_pool_values_persists_sorted_length(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        storage.update_pool({"poolId": 4444, "poolValues": [1, 3, 5, 4]})
+
+        sorted_values = storage.get_sorted_pool_values(4444)
+        values, sorted_length = storage.read_pool_values(4444)
+
+        #assert
+        assert list(sorted_values) == [1, 3, 4, 5]
+        assert list(values) == [1, 3, 4, 5]
+        assert sorted_length == 4
+
+    def test_append_keeps_sorted_prefix(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        storage.update_pool({"poolId": 4444, "poolValues": [5, 1, 3]})
+        storage.get_sorted_pool_values(4444)
+        storage.update_pool({"poolId": 4444, "poolValues": [4, 0, 3]})
+
+        _, sorted_length_before_query = storage.read_pool_values(4444)
+        sorted_values = storage.get_sorted_pool_values(4444)
+        values, sorted_length = storage.read_pool_values(4444)
+
+        #assert
+        assert sorted_length_before_query == 3
+        assert list(sorted_values) == [0, 1, 3, 3, 4, 5]
+        assert list(values) == [0, 1, 3, 3, 4, 5]
+        assert sorted_length == 6
+
+    def test_sort_of_a_pool_created_meanwhile_is_not_saved(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        stamp = storage.get_file_stamp(1369) # the query starts before the first update
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+        sorted_values, is_dirty, _ = storage.read_sorted_pool_values(1369)
+        storage.update_pool({"poolId": 1369, "poolValues": [2]})
+
+        saved = storage.save_sorted_pool_values(1369, sorted_values, stamp)
+        values, sorted_length = storage.read_pool_values(1369)
+
+        #assert
+        assert saved is None
+        assert list(values) == [3, 1, 2] # the value appended after the read is kept
+        assert sorted_length == 0
+
+    def test_pools_of_the_same_shard_are_separate_files(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        storage.update_pool({"poolId": 2222, "poolValues": [1, 3]})
+        storage.update_pool({"poolId": 2244, "poolValues": [3, 1]})
+
+        values, _ = read_pool_file(storage.get_pool_path(2244))
+
+        #assert
+        assert storage.get_path_by_id(2222) == storage.get_path_by_id(2244)
+        assert isinstance(values, np.memmap)
+        assert list(values) == [3, 1]
+
+    def test_save_then_load_data(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        df = pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 3]", "sorted_length": 2},
+                           {"poolId": 2244, "poolValues": [5.5, 2], "sorted_length": 0}]).set_index('poolId')
+        path = storage.get_path_by_id(2222)
+
+        storage.save_data(path, df)
+        loaded_df = storage.load_data(path)
+
+        #assert
+        assert list(loaded_df.index) == [2222, 2244]
+        assert list(loaded_df.loc[2222]["poolValues"]) == [1, 3]
+        assert list(loaded_df.loc[2244]["poolValues"]) == [5.5, 2]
+        assert list(loaded_df["sorted_length"]) == [2, 0]
+
+class TestVectorizedPath(object):
+    @pytest.mark.parametrize("sorted_length", [0, 1000, 3000])
+    def test_merge_sorted_prefix_matches_sorted(self, sorted_length):
+        #setup
+        rng = random.Random(1369)
+        values_list = [rng.choice([rng.randint(-50, 50), float(rng.randint(-50, 50)), rng.uniform(-50, 50), -0.0]) for _ in range(5000)]
+        values_list = sorted(values_list[:sorted_length]) + values_list[sorted_length:]
+        merged = merge_sorted_prefix(values_list, sorted_length)
+        expected = sorted(values_list)
+
+        #assert
+        assert merged == expected
+        assert [type(value) for value in merged] == [type(value) for value in expected] # ties between 1 and 1.0 keep their order
+        assert [str(value) for value in merged] == [str(value) for value in expected]
+
+    def test_merge_sorted_prefix_falls_back_to_sorted(self):
+        #setup
+        values_list = [2**60 + 1, 2**60, 2.0**60] + list(range(2000))
+
+        #assert
+        assert [str(value) for value in merge_sorted_prefix(values_list, 0)] == [str(value) for value in sorted(values_list)]
+
+    def test_parse_pool_values(self):
+        #setup
+        values_list = [1, -2.5, 1e-05, 12345678901234567890, -0.0]
+
+        #assert
+        assert [(value, type(value)) for value in parse_pool_values(str(values_list))] == [(value, type(value)) for value in values_list]
+
+    def test_large_pool_through_shard_index(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path))
+        values_list = [i * 1.5 for i in range(50000, 0, -1)] # the CSV cell is longer than the csv module default field limit
+        storage.update_pool({"poolId": 1369, "poolValues": values_list.copy()})
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) == sorted(values_list)
+
+class TestGetStorage(object):
+    def test_get_known_storage(self):
+        #assert
+        assert isinstance(get_storage('csv'), CsvStorage)
+        assert isinstance(get_storage('binary'), BinaryStorage)
+
+    def test_get_unknown_storage(self):
+        #assert
+        with pytest.raises(ValueError):
+            get_storage('parquet')
+
+class TestMigrate(object):
+    def test_migrate_csv_to_binary(self, tmp_path):
+        #setup
+        source_dir = tmp_path / "csv"
+        source_dir.mkdir()
+        pd.DataFrame([{"poolId": 2222, "poolValues": "[1, 7, 2]", "sorted": 0},
+                      {"poolId": 2266, "poolValues": "[-1, 2.5]", "sorted": 1}]).set_index('poolId').to_csv(source_dir / "2.csv")
+        target = BinaryStorage(str(tmp_path / "binary"))
+
+        total_pools = migrate_csv_to_binary(str(source_dir), target.root)
+        values_1, sorted_length_1 = target.read_pool_values(2222)
+        values_2, sorted_length_2 = target.read_pool_values(2266)
+
+        #assert
+        assert total_pools == 2
+        assert list(values_1) == [1, 7, 2]
+        assert sorted_length_1 == 0
+        assert list(values_2) == [-1, 2.5]
+        assert sorted_length_2 == 2 # converted from the former 'sorted' label
+
+    def test_migrate_pending_log(self, tmp_path):
+        #setup
+        source = CsvStorage(write_mode='log', root=str(tmp_path / "csv"))
+        os.mkdir(source.root)
+        source.update_pool({"poolId": 2222, "poolValues": [1, 7]})
+        source.update_pool({"poolId": 2222, "poolValues": [2]})
+        source.update_pool({"poolId": 3333, "poolValues": [4.5]}) # its shard only exists as a log
+        target = BinaryStorage(str(tmp_path / "binary"))
+
+        total_pools = migrate_csv_to_binary(source.root, target.root)
+
+        #assert
+        assert total_pools == 2
+        assert list(target.read_pool_values(2222)[0]) == [1, 7, 2]
+        assert list(target.read_pool_values(3333)[0]) == [4.5]
+
+    def test_migrate_in_place_skips_mapped_copies(self, tmp_path):
+        #setup
+        source = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        source.update_pool({"poolId": 1369, "poolValues": [2.5] + [float(i) for i in range(20)]})
+        source.get_sorted_pool_values(1369)
+        source.get_sorted_pool_values(1369) # copied to 1.sorted/
+        target = BinaryStorage(str(tmp_path))
+
+        migrate_csv_to_binary(source.root, target.root)
+
+        #assert
+        assert os.path.isdir(tmp_path / "1.sorted")
+        assert target.get_shard_paths() == [str(tmp_path / "1")]
+        assert [id for path in target.get_shard_paths() for id in target.get_stored_pool_ids(path)] == [1369]
+
+def crash(*args):
+    raise RuntimeError("crash")
+
+class TestCsvLogMode(object):
+    @pytest.fixture(autouse=True)
+    def data_dir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('data')
+
+    def test_update_writes_only_to_log(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        pool_1 = {"poolId": 1369, "poolValues": [1, 7, 2]}
+        pool_2 = {"poolId": 1369, "poolValues": [2.5]}
+
+        status_1 = storage.update_pool(dict(pool_1))
+        status_2 = storage.update_pool(dict(pool_2))
+
+        #assert
+        assert status_1 == "inserted"
+        assert status_2 == "appended"
+        assert not os.path.exists(storage.get_path_by_id(1369))
+        with open(storage.get_log_path(storage.get_path_by_id(1369))) as f:
+            assert len(f.readlines()) == 2
+
+    def test_append_to_pool_stored_in_csv(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        pd.DataFrame([{"poolId": 1369, "poolValues": "[1, 3]", "sorted_length": 0}]).set_index('poolId').to_csv(storage.get_path_by_id(1369))
+
+        status = storage.update_pool({"poolId": 1369, "poolValues": [2]})
+
+        #assert
+        assert status == "appended"
+
+    def test_compact_shard(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        file_path = storage.get_path_by_id(1369)
+        pd.DataFrame([{"poolId": 1369, "poolValues": "[1, 3]", "sorted_length": 2},
+                      {"poolId": 1444, "poolValues": "[5]", "sorted_length": 1}]).set_index('poolId').to_csv(file_path)
+        storage.update_pool({"poolId": 1369, "poolValues": [2]})
+        storage.update_pool({"poolId": 1555, "poolValues": [9, 8]})
+        storage.update_pool({"poolId": 1369, "poolValues": [0.5]})
+
+        has_compacted = storage.compact_shard(file_path)
+        df = pd.read_csv(file_path, index_col="poolId")
+
+        #assert
+        assert has_compacted is True
+        assert not os.path.exists(storage.get_log_path(file_path))
+        assert df.loc[1369]["poolValues"] == "[1, 3, 2, 0.5]"
+        assert df.loc[1369]["sorted_length"] == 2
+        assert df.loc[1444]["poolValues"] == "[5]"
+        assert df.loc[1555]["poolValues"] == "[9, 8]"
+        assert storage.compact_shard(file_path) is False # nothing left to merge
+
+    def test_query_sees_logged_values(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+        storage.update_pool({"poolId": 1369, "poolValues": [2]})
+
+        sorted_pool_values_list = storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert sorted_pool_values_list == [1, 2, 3]
+        assert storage.get_sorted_pool_values(9999) is None
+
+    def test_compact_all(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+        storage.update_pool({"poolId": 2369, "poolValues": [2]})
+
+        total_shards = storage.compact_all()
+
+        #assert
+        assert total_shards == 2
+        assert sorted(os.listdir('data')) == ['1.csv', '1.idx', '2.csv', '2.idx'] # logs merged, shard indexes written
+
+    def test_unknown_write_mode(self):
+        #assert
+        with pytest.raises(ValueError):
+            CsvStorage(write_mode='async')
+        with pytest.raises(ValueError):
+            CsvStorage(write_mode='log', log_sync='sometimes')
+
+    def test_group_commit(self, monkeypatch):
+        #setup
+        storage = CsvStorage(write_mode='log', commit_delay=0.05)
+        batches = []
+        monkeypatch.setattr(storage_module, 'sync_files', lambda files: batches.append(len(files)) or sync_files(files))
+        with ThreadPoolExecutor(8) as executor:
+            statuses = list(executor.map(lambda i: storage.update_pool({"poolId": 1000 * (i % 2) + i, "poolValues": [i]}), range(8)))
+
+        #assert
+        assert statuses == ["inserted"] * 8
+        assert sum(batches) == 8
+        assert len(batches) < 8 # the appends waiting together share their fsyncs
+        assert sorted(storage.get_sorted_pools_values([1000 * (i % 2) + i for i in range(8)]).values()) == [[i] for i in range(8)]
+
+    def test_failed_sync_is_not_acknowledged(self, monkeypatch):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        def failing_fsync(fd):
+            raise OSError("disk full")
+        monkeypatch.setattr(os, 'fsync', failing_fsync)
+
+        #assert
+        with pytest.raises(OSError):
+            storage.update_pool({"poolId": 1369, "poolValues": [1]})
+
+    def test_failed_batch_keeps_its_error(self, monkeypatch):
+        #setup
+        group_commit = storage_module.GroupCommit(delay=0.05)
+        batches = []
+        def sync_batch(files):
+            for fd, new_file_directory in files:
+                os.close(fd)
+            batches.append(len(files))
+            return OSError("disk full") if len(batches) % 2 else None # every other batch fails
+        monkeypatch.setattr(storage_module, 'sync_files', sync_batch)
+        def wait(i):
+            try:
+                group_commit.wait_durable(os.open(os.devnull, os.O_RDONLY))
+                return "durable"
+            except OSError:
+                return "failed"
+
+        with ThreadPoolExecutor(4) as executor:
+            first_results = list(executor.map(wait, range(4)))
+        second_result = wait(4)
+        with ThreadPoolExecutor(4) as executor:
+            third_results = list(executor.map(wait, range(4)))
+
+        #assert
+        assert (len(batches), batches[0]) == (3, 4)
+        assert first_results == ["failed"] * 4 # every waiter of the failed batch, not only the last one woken
+        assert second_result == "durable"
+        assert third_results == ["failed"] * 4
+
+    def test_no_sync(self, monkeypatch):
+        #setup
+        storage = CsvStorage(write_mode='log', log_sync='none')
+        monkeypatch.setattr(os, 'fsync', lambda fd: pytest.fail("fsync"))
+
+        #assert
+        assert storage.update_pool({"poolId": 1369, "poolValues": [1]}) == "inserted"
+
+    def test_log_written_by_another_process(self):
+        #setup
+        storage_1 = CsvStorage(write_mode='log')
+        storage_2 = CsvStorage(write_mode='log')
+
+        #assert
+        assert storage_1.update_pool({"poolId": 1369, "poolValues": [1]}) == "inserted"
+        assert storage_2.update_pool({"poolId": 1369, "poolValues": [2]}) == "appended"
+        assert storage_1.update_pool({"poolId": 1444, "poolValues": [3]}) == "inserted"
+        assert storage_1.update_pool({"poolId": 1369, "poolValues": [4]}) == "appended"
+
+    def test_crash_after_shard_replaced(self, monkeypatch):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        file_path = storage.get_path_by_id(1369)
+        storage.update_pool({"poolId": 1369, "poolValues": [1, 2]})
+        with monkeypatch.context() as patch:
+            patch.setattr(CsvStorage, 'remove_segment', crash) # before the segment is removed
+            with pytest.raises(RuntimeError):
+                storage.compact_shard(file_path)
+        storage.update_pool({"poolId": 1369, "poolValues": [3]})
+
+        #assert
+        assert os.path.exists(storage.get_log_path(file_path) + '.compacting.applied')
+        assert CsvStorage(write_mode='log').recover() == 1
+        assert sorted(os.listdir('data')) == ['1.csv', '1.idx']
+        assert storage.get_sorted_pool_values(1369) == [1, 2, 3] # not [1, 1, 2, 2, 3]
+
+    def test_crash_before_shard_replaced(self, monkeypatch):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        file_path = storage.get_path_by_id(1369)
+        storage.update_pool({"poolId": 1369, "poolValues": [2, 1]})
+        storage.compact_shard(file_path)
+        storage.update_pool({"poolId": 1369, "poolValues": [3]})
+        with monkeypatch.context() as patch:
+            patch.setattr(CsvStorage, 'save_csv_bytes', crash) # before the shard is replaced
+            with pytest.raises(RuntimeError):
+                storage.compact_shard(file_path)
+
+        #assert
+        assert CsvStorage(write_mode='log').recover() == 1
+        assert storage.get_sorted_pool_values(1369) == [1, 2, 3]
+
+    def test_recover_cuts_torn_record(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        storage.update_pool({"poolId": 1369, "poolValues": [1]})
+        with open(storage.get_log_path(storage.get_path_by_id(1369)), 'a') as f:
+            f.write('{"poolId": 1369, "poolVal') # the server crashed while appending
+        CsvStorage(write_mode='log').recover()
+        storage.update_pool({"poolId": 1369, "poolValues": [2]})
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) == [1, 2]
+
+class TestGetSortedPoolsValues(object):
+    @pytest.fixture(autouse=True)
+    def data_dir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('data')
+
+    def test_each_shard_is_loaded_and_saved_once(self, monkeypatch):
+        #setup
+        storage = CsvStorage()
+        for pool in ({"poolId": 1369, "poolValues": [3, 1]}, {"poolId": 1370, "poolValues": [2, 9, 4]}, {"poolId": 2369, "poolValues": [5]}):
+            storage.update_pool(pool)
+        calls = []
+        monkeypatch.setattr(CsvStorage, 'load_data', lambda self, path: calls.append(('load', path)) or pd.read_csv(path, index_col="poolId"))
+        monkeypatch.setattr(CsvStorage, 'save_data', lambda self, path, df: calls.append(('save', path)) or df.to_csv(path))
+
+        sorted_pools_values = storage.get_sorted_pools_values([1369, 1370, 2369, 1369, 9999])
+
+        #assert
+        assert sorted_pools_values == {1369: [1, 3], 1370: [2, 4, 9], 2369: [5]}
+        assert calls == [('load', 'data/1.csv'), ('save', 'data/1.csv')] # shard 2 is already sorted, read through its index
+
+    def test_binary_storage(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+
+        sorted_pools_values = storage.get_sorted_pools_values([1369, 9999])
+
+        #assert
+        assert list(sorted_pools_values) == [1369]
+        assert list(sorted_pools_values[1369]) == [1, 3]
+
+class TestUpdatePools(object):
+    @pytest.fixture(autouse=True)
+    def data_dir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('data')
+
+    def test_each_shard_is_loaded_and_saved_once(self, monkeypatch):
+        #setup
+        storage = CsvStorage()
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+        calls = []
+        monkeypatch.setattr(CsvStorage, 'load_data', lambda self, path: calls.append(('load', path)) or pd.read_csv(path, index_col="poolId"))
+        monkeypatch.setattr(CsvStorage, 'save_data', lambda self, path, df: calls.append(('save', path)) or df.to_csv(path))
+        pools = [{"poolId": 1369, "poolValues": [2]},
+                 {"poolId": 2369, "poolValues": [5]},
+                 {"poolId": 1370, "poolValues": [9, 8]},
+                 {"poolId": 1370, "poolValues": [7]}]
+
+        statuses = storage.update_pools(pools)
+        df = pd.read_csv('data/1.csv', index_col="poolId")
+
+        #assert
+        assert statuses == ["appended", "inserted", "inserted", "appended"]
+        assert calls == [('load', 'data/1.csv'), ('save', 'data/1.csv'), ('save', 'data/2.csv')]
+        assert df.loc[1369]["poolValues"] == "[3, 1, 2]"
+        assert df.loc[1370]["poolValues"] == "[9, 8, 7]"
+
+    def test_log_mode(self):
+        #setup
+        storage = CsvStorage(write_mode='log')
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+
+        statuses = storage.update_pools([{"poolId": 1369, "poolValues": [2]}, {"poolId": 1370, "poolValues": [9]}])
+
+        #assert
+        assert statuses == ["appended", "inserted"]
+        assert storage.get_sorted_pool_values(1369) == [1, 2, 3]
+
+    def test_binary_storage(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+
+        statuses = storage.update_pools([{"poolId": 1369, "poolValues": [2]}, {"poolId": 1369, "poolValues": [1]}])
+
+        #assert
+        assert statuses == ["inserted", "appended"]
+        assert list(storage.get_sorted_pool_values(1369)) == [1, 2]
+
+class TestShardIndex(object):
+    @pytest.fixture(autouse=True)
+    def data_dir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.mkdir('data')
+
+    def test_index_is_written_with_the_shard(self):
+        #setup
+        storage = CsvStorage()
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1, 2]})
+        storage.update_pool({"poolId": 1370, "poolValues": [4.5]})
+        file_path = storage.get_path_by_id(1369)
+        storage.indexes.clear() # read the index file back
+        shard_index = storage.get_index(file_path)
+        with open(file_path, 'rb') as f:
+            csv_bytes = f.read()
+
+        #assert
+        assert os.path.exists('data/1.idx')
+        assert shard_index["pools"][1369][2:] == [3, 0] # value count, sorted_length
+        assert shard_index["pools"][1370][2:] == [1, 1]
+        offset, length = shard_index["pools"][1370][:2]
+        assert csv_bytes[offset:offset + length].startswith(b'1370,')
+
+    def test_lookups_do_not_load_the_shard(self, monkeypatch):
+        #setup
+        storage = CsvStorage()
+        storage.update_pool({"poolId": 1369, "poolValues": [1, 2]})
+        storage.get_sorted_pool_values(1369)
+        monkeypatch.setattr(CsvStorage, 'load_data', lambda self, path: pytest.fail("shard loaded"))
+
+        #assert
+        assert storage.get_sorted_pool_values(1999) is None
+        assert storage.get_pool_values(1999) == (None, None)
+        assert storage.get_sorted_pool_values(1369) == [1, 2]
+        assert storage.get_pool_values(1369) == ([1, 2], 2)
+
+    def test_stale_index_is_rebuilt(self):
+        #setup
+        storage = CsvStorage()
+        storage.update_pool({"poolId": 1369, "poolValues": [1]})
+        pd.DataFrame([{"poolId": 1369, "poolValues": "[1, 3]", "sorted": 1},
+                      {"poolId": 1444, "poolValues": "[5, 4]", "sorted": 0}]).set_index('poolId').to_csv('data/1.csv') # written behind the storage's back
+
+        #assert
+        assert storage.get_pool_values(1369) == ([1, 3], 2) # converted from the former 'sorted' label
+        assert storage.get_pool_values(1444) == ([5, 4], 0)
+
+    def test_torn_index_file_is_rebuilt(self):
+        #setup
+        storage = CsvStorage()
+        storage.update_pool({"poolId": 1369, "poolValues": [2, 1]})
+        with open('data/1.idx', 'w') as f:
+            f.write('{"stamp": [1')
+        storage.indexes.clear()
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) == [1, 2]
+
+class TestMappedSortedPools(object):
+    def test_float_pool(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        values = [random.uniform(-100, 100) for _ in range(50)]
+        storage.update_pool({"poolId": 1369, "poolValues": list(values)})
+        unmapped = storage.get_sorted_pool_values(1369) # sorts and saves the shard
+        first_read = storage.get_sorted_pool_values(1369) # parses the row and copies it
+        mapped = storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert unmapped == first_read == sorted(values)
+        assert len(glob.glob(str(tmp_path / "1.sorted" / "1369.*.f64"))) == 1
+        assert isinstance(mapped, MappedPoolValues)
+        assert list(mapped) == sorted(values)
+        assert storage.get_pool_values(1369)[1] == 50
+        assert calculate_quantile(mapped, 37.5) == calculate_quantile(sorted(values), 37.5)
+
+    def test_int_pool_keeps_ints(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        storage.update_pool({"poolId": 1369, "poolValues": [2**62] + list(range(20))})
+        storage.get_sorted_pool_values(1369)
+        storage.get_sorted_pool_values(1369)
+        mapped, sorted_length = storage.get_pool_values(1369)
+
+        #assert
+        assert len(glob.glob(str(tmp_path / "1.sorted" / "1369.*.i64"))) == 1
+        assert isinstance(mapped, MappedPoolValues)
+        assert type(mapped[0]) is int and mapped[-1] == 2**62 # exact, a float64 would round it
+        assert calculate_quantile(mapped, 100) == (2**62, 21)
+        assert calculate_quantile(mapped, 50) == (10.0, 21)
+
+    def test_mixed_pool_is_not_mapped(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        storage.update_pool({"poolId": 1369, "poolValues": [1.5] + list(range(20))})
+        storage.get_sorted_pool_values(1369)
+        storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) == [0, 1, 1.5] + list(range(2, 20))
+        assert not os.path.exists(tmp_path / "1.sorted")
+        assert storage.unmapped_pools == {(str(tmp_path / "1.csv"), 1369): 21}
+
+    def test_appended_pool_is_copied_again(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        storage.update_pool({"poolId": 1369, "poolValues": list(range(20))})
+        storage.get_sorted_pool_values(1369)
+        storage.get_sorted_pool_values(1369)
+        storage.update_pool({"poolId": 1369, "poolValues": [-1.5]}) # now a mixed pool
+        appended = storage.get_sorted_pool_values(1369)
+        storage.update_pool({"poolId": 1369, "poolValues": [-2]})
+        storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert appended == [-1.5] + list(range(20)) # the copy of 20 values is stale
+        assert not glob.glob(str(tmp_path / "1.sorted" / "1369.*.f64"))
+        assert list(storage.get_sorted_pool_values(1369)) == [-2, -1.5] + list(range(20))
+
+    def test_recreated_pool_is_copied_again(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        storage.update_pool({"poolId": 1369, "poolValues": list(range(20))})
+        storage.get_sorted_pool_values(1369)
+        storage.get_sorted_pool_values(1369)
+        os.remove(tmp_path / "1.csv") # the shard is recreated, the pool gets as many values
+        storage.update_pool({"poolId": 1369, "poolValues": list(range(100, 120))})
+        storage.get_sorted_pool_values(1369)
+        recreated = storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert list(recreated) == list(range(100, 120))
+        assert len(os.listdir(tmp_path / "1.sorted")) == 1
+
+    @pytest.mark.parametrize("damaged_copy", [b"", b"POOL", b"NOTAPOOL" + bytes(8 + 20 * 8), None], ids=['empty', 'short_header', 'bad_magic', 'cut_values'])
+    def test_damaged_copy_is_copied_again(self, tmp_path, damaged_copy):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=10)
+        storage.update_pool({"poolId": 1369, "poolValues": list(range(20))})
+        storage.get_sorted_pool_values(1369)
+        storage.get_sorted_pool_values(1369)
+        mapped_path = glob.glob(str(tmp_path / "1.sorted" / "1369.*.i64"))[0]
+        with open(mapped_path, 'rb') as f:
+            copy = f.read()
+        with open(mapped_path, 'wb') as f: # as a crash can leave a copy that was not fsynced
+            f.write(damaged_copy if damaged_copy is not None else copy[:-12])
+
+        first_read = storage.get_sorted_pool_values(1369)
+        mapped = storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert list(first_read) == list(range(20))
+        assert isinstance(mapped, MappedPoolValues)
+        assert list(mapped) == list(range(20))
+        with open(mapped_path, 'rb') as f:
+            assert f.read() == copy
+
+    def test_disabled(self, tmp_path):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), mmap_min_length=None)
+        storage.update_pool({"poolId": 1369, "poolValues": list(range(20, 0, -1))})
+        storage.get_sorted_pool_values(1369)
+
+        #assert
+        assert storage.get_sorted_pool_values(1369) == list(range(1, 21))
+        assert not os.path.exists(tmp_path / "1.sorted")
@@ -0,0 +1,128 @@
+import pytest
+from transfer import export_pools, import_pools, open_storage, get_shard_name
+from storage import CsvStorage, BinaryStorage, iter_row_values, parse_pool_values
+import io
+import os
+import json
+import random
+import tracemalloc
+
+class NullOutput(object):
+    # counts the bytes written and keeps nothing
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def fill_storage(storage):
+    rng = random.Random(0)
+    pools = {1369: [rng.randint(-100, 100) for _ in range(25)] + [0.5, 2**70],
+             1370: [rng.uniform(-1, 1) for _ in range(10)],
+             2369: [7],
+             -5: [3, 1, 2]}
+    for id, values in pools.items():
+        storage.update_pool({"poolId": id, "poolValues": values})
+    storage.update_pool({"poolId": 1370, "poolValues": [1e-300, -2.5]})
+    pools[1370] += [1e-300, -2.5]
+    return pools
+
+class TestTransfer(object):
+    def test_export_then_import(self, tmp_path):
+        #setup
+        source = open_storage('csv', str(tmp_path / 'source'), lock_dir=str(tmp_path / 'locks'))
+        pools = fill_storage(source)
+        output = io.BytesIO()
+
+        total_pools, total_records = export_pools(source, output, chunk_values=10)
+        lines = output.getvalue().splitlines(keepends=True)
+        csv_target = open_storage('csv', str(tmp_path / 'csv'), lock_dir=str(tmp_path / 'locks'))
+        binary_target = open_storage('binary', str(tmp_path / 'binary'), lock_dir=str(tmp_path / 'locks'))
+        csv_records = import_pools(csv_target, lines, chunk_values=7)
+        binary_records = import_pools(binary_target, [line for line in lines if json.loads(line)["poolId"] != 1369], chunk_values=7) # 2**70 does not fit in float64
+
+        #assert
+        assert (total_pools, total_records) == (4, 3 + 2 + 1 + 1)
+        assert all(len(json.loads(line)["poolValues"]) <= 10 for line in lines)
+        assert csv_records == 7 and binary_records == 4
+        assert not [name for name in os.listdir(tmp_path / 'csv') if name.endswith('.log')] # merged into the shards
+        for id, values in pools.items():
+            imported = CsvStorage(root=str(tmp_path / 'csv')).get_pool_values(id)[0]
+            assert imported == values
+            assert [type(value) for value in imported] == [type(value) for value in values] # ints stay ints
+        assert list(binary_target.get_pool_values(1370)[0]) == pools[1370]
+
+    def test_export_filters(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        fill_storage(storage)
+
+        def exported_ids(**filters):
+            output = io.BytesIO()
+            export_pools(storage, output, **filters)
+            return [json.loads(line)["poolId"] for line in output.getvalue().splitlines()]
+
+        #assert
+        assert exported_ids() == [-5, 1369, 1370, 2369]
+        assert exported_ids(min_id=0, max_id=1369) == [1369]
+        assert exported_ids(min_id=1370) == [1370, 2369]
+        assert exported_ids(shards=['2']) == [2369]
+        assert exported_ids(shards=['0', '2'], max_id=0) == [-5]
+        assert get_shard_name(os.path.join('data', '12.csv')) == get_shard_name(os.path.join('data', '12', '')) == '12'
+
+    def test_export_log_mode(self, tmp_path):
+        #setup
+        storage = CsvStorage(write_mode='log', root=str(tmp_path))
+        storage.update_pool({"poolId": 1369, "poolValues": [3, 1]})
+        storage.update_pool({"poolId": 1369, "poolValues": [2.5]}) # still in the shard log
+        output = io.BytesIO()
+
+        export_pools(storage, output)
+
+        #assert
+        assert json.loads(output.getvalue()) == {"poolId": 1369, "poolValues": [3, 1, 2.5]}
+
+    def test_invalid_record(self, tmp_path):
+        #setup
+        storage = BinaryStorage(str(tmp_path))
+        lines = [b'{"poolId": 1, "poolValues": [1]}\n', b'\n', b'{"poolId": 2, "poolValues": [true]}\n']
+
+        #assert
+        with pytest.raises(ValueError, match="Line 3"):
+            import_pools(storage, lines)
+        with pytest.raises(ValueError, match="Line 1 is not valid JSON"):
+            import_pools(storage, [b'{"poolId": 1,'])
+
+    def test_iter_row_values(self, tmp_path):
+        #setup
+        values = [1, -2.5, 3e-5, 10**20, 7, 0.1] * 50
+        path = tmp_path / 'row.csv'
+        row = ('1369,"%s",0\n' % values).encode()
+        path.write_bytes(b'poolId,poolValues,sorted_length\n' + row)
+
+        #assert
+        for block_size in (1, 7, 64, 10**6):
+            with open(path, 'rb') as f:
+                f.seek(len('poolId,poolValues,sorted_length\n'))
+                chunks = list(iter_row_values(f, len(row), 40, block_size))
+            assert [value for chunk in chunks for value in chunk] == values
+            assert [len(chunk) for chunk in chunks] == [40] * 7 + [20]
+        with open(path, 'rb') as f:
+            f.seek(len('poolId,poolValues,sorted_length\n'))
+            assert list(iter_row_values(f, len(row), 1000)) == [parse_pool_values(str(values))]
+
+    @pytest.mark.parametrize("storage_class", [CsvStorage, BinaryStorage])
+    def test_export_bounded_memory(self, tmp_path, storage_class):
+        #setup
+        storage = storage_class(root=str(tmp_path))
+        storage.update_pool({"poolId": 1369, "poolValues": [random.random() for _ in range(200000)]})
+        output = NullOutput()
+
+        tracemalloc.start()
+        export_pools(storage, output, chunk_values=5000)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        #assert
+        assert output.size > 3 * 10**6
+        assert peak < 3 * 10**6 # the pool is 200000 Python floats, about 6.4 MB as a list
@@ -0,0 +1,224 @@
+import pytest
+import numpy as np
+import windows
+from windows import WindowStore, SortedRuns, calculate_window_quantile, calculate_window_quantiles, read_segment, write_segment
+from quantiles import calculate_quantile, calculate_quantiles
+from locks import ShardLocks
+from metrics import BYTES_READ, EXPIRED_WINDOW_VALUES
+import os
+import random
+
+class FakeClock(object):
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def make_store(tmp_path, clock, **policy):
+    store = WindowStore(str(tmp_path / 'data'), locks=ShardLocks(str(tmp_path / 'locks')), clock=clock, archive_dir=policy.pop('archive_dir', None))
+    store.set_config(1369, **policy)
+    return store
+
+def fill(store, clock, updates=40, step=7.5, seed=0):
+    # [(ingest time, value)] in ingest order
+    rng = random.Random(seed)
+    ingested = []
+    for _ in range(updates):
+        values = [rng.randint(-50, 50) / rng.choice((1, 4)) for _ in range(rng.randint(1, 30))]
+        store.add_pools([{"poolId": 1369, "poolValues": values}])
+        ingested += [(clock.now, value) for value in values]
+        clock.now += step
+    return ingested
+
+class TestWindowStore(object):
+    def test_time_and_count_windows(self, tmp_path):
+        #setup
+        clock = FakeClock()
+        store = make_store(tmp_path, clock, bucket_seconds=60, retention_seconds=0)
+        ingested = fill(store, clock)
+        now = clock.now
+
+        #assert
+        for seconds in (1, 10, 59.5, 60, 61, 100, 175, 299.9, 10**6):
+            expected = sorted(value for time, value in ingested if time >= now - seconds)
+            runs = store.get_window_values(1369, seconds=seconds)
+            if not expected:
+                assert runs == []
+                continue
+            for percentile in (0, 25, 50, 90, 100):
+                assert calculate_window_quantile(runs, percentile) == calculate_quantile(expected, percentile)
+        for values in (1, 5, 29, 30, 31, 200, len(ingested), 10**6):
+            expected = sorted(value for time, value in ingested[-values:])
+            runs = store.get_window_values(1369, values=values)
+            assert sum(len(run) for run in runs) == len(expected)
+            assert calculate_window_quantiles(runs, [0, 10, 50, 99, 100]) == calculate_quantiles(expected, [0, 10, 50, 99, 100])
+        assert store.get_window_values(1370) is None
+
+    def test_segments_are_sorted_buckets(self, tmp_path):
+        #setup
+        clock = FakeClock(600.0)
+        store = make_store(tmp_path, clock, bucket_seconds=60, retention_seconds=0)
+        store.add_pools([{"poolId": 1369, "poolValues": [3, 1, 2]}])
+        clock.now = 630.0
+        store.add_pools([{"poolId": 1369, "poolValues": [2, 0]}])
+        appended = sorted(os.listdir(store.get_pool_dir(1369)))
+        clock.now = 640.0
+        store.add_pools([{"poolId": 1369, "poolValues": [4, 2]}])
+        clock.now = 660.0
+        store.add_pools([{"poolId": 1369, "poolValues": [5]}])
+        values, times, seqs = read_segment(os.path.join(store.get_pool_dir(1369), '600.0.7.seg'))
+
+        #assert
+        assert appended == ['600.0.3.seg', '600.3.5.seg', 'window.json'] # a smaller run is appended
+        assert sorted(os.listdir(store.get_pool_dir(1369))) == ['600.0.7.seg', '660.7.8.seg', 'window.json'] # runs of equal size are merged
+        assert values.tolist() == [0, 1, 2, 2, 2, 3, 4]
+        assert times.tolist() == [630, 600, 600, 630, 640, 600, 640]
+        assert seqs.tolist() == [4, 1, 2, 3, 6, 0, 5] # ingest order, the equal 2s keep it
+        assert store.get_window_values(1369, values=2)[1].tolist() == [2] # newest segment first
+
+    def test_update_leaves_big_runs(self, tmp_path):
+        #setup
+        clock = FakeClock()
+        store = make_store(tmp_path, clock, bucket_seconds=3600, retention_seconds=0)
+        store.add_pools([{"poolId": 1369, "poolValues": list(range(1000))}])
+        directory = store.get_pool_dir(1369)
+        inodes = {name: os.stat(os.path.join(directory, name)).st_ino for name in os.listdir(directory)}
+        bytes_read = BYTES_READ.labels('.seg').value
+
+        for i in range(10):
+            clock.now += 1
+            store.add_pools([{"poolId": 1369, "poolValues": [i, 0.5]}])
+
+        #assert
+        assert BYTES_READ.labels('.seg').value - bytes_read <= 20 * 4 * 24 # only the small runs are merged, a few times each
+        assert all(os.stat(os.path.join(directory, name)).st_ino == inode for name, inode in inodes.items()) # the big run and window.json are not rewritten
+        assert len([name for name in os.listdir(directory) if name.endswith('.seg')]) <= 4
+        assert calculate_window_quantiles(store.get_window_values(1369), [0, 50, 100]) == calculate_quantiles(sorted(list(range(1000)) + [i for i in range(10)] + [0.5] * 10), [0, 50, 100])
+        assert sum(len(run) for run in store.get_window_values(1369, values=5)) == 5
+        clock.now += 3600
+        store.add_pools([{"poolId": 1369, "poolValues": [7]}])
+        assert len([name for name in os.listdir(directory) if name.endswith('.seg')]) == 2 # the runs of a past bucket are merged
+        assert store.get_window_values(1369)[1].tolist() == sorted(list(range(1000)) + [i for i in range(10)] + [0.5] * 10)
+
+    def test_interrupted_merge(self, tmp_path):
+        #setup
+        clock = FakeClock(600.0)
+        store = make_store(tmp_path, clock, bucket_seconds=60, retention_seconds=60)
+        store.add_pools([{"poolId": 1369, "poolValues": [3, 1]}])
+        store.add_pools([{"poolId": 1369, "poolValues": [2, 0]}])
+        directory = store.get_pool_dir(1369)
+        write_segment(os.path.join(directory, '600.2.4.seg'), np.array([0.0, 2.0]), np.full(2, 600.0), np.array([3, 2])) # merged into 600.0.4.seg before a crash
+
+        #assert
+        assert [run.tolist() for run in store.get_window_values(1369)] == [[0, 1, 2, 3]]
+        clock.now = 800.0
+        assert store.expire_all() == 1
+        assert os.listdir(directory) == ['window.json'] # expiry removes the leftover too
+
+    def test_short_window_reads_newest_segments(self, tmp_path):
+        #setup
+        clock = FakeClock()
+        store = make_store(tmp_path, clock, bucket_seconds=10, retention_seconds=0)
+        fill(store, clock, updates=200, step=1)
+        bytes_read = BYTES_READ.labels('.seg').value
+
+        store.get_window_values(1369, seconds=5)
+
+        #assert
+        assert BYTES_READ.labels('.seg').value - bytes_read <= 2 * 10 * 30 * 24 # 2 of the 20 segments at most
+
+    def test_retention_seconds(self, tmp_path):
+        #setup
+        clock = FakeClock()
+        store = make_store(tmp_path, clock, bucket_seconds=60, retention_seconds=120)
+        dropped = EXPIRED_WINDOW_VALUES.labels('dropped').value
+        ingested = fill(store, clock)
+        now = clock.now
+        segments = set(name.split('.')[0] for name in os.listdir(store.get_pool_dir(1369)) if name.endswith('.seg'))
+
+        #assert
+        assert len(segments) <= 4 # 120 seconds of 60 second buckets, and the bucket being filled
+        assert EXPIRED_WINDOW_VALUES.labels('dropped').value > dropped
+        expected = sorted(value for time, value in ingested if time >= now - 120)
+        assert calculate_window_quantile(store.get_window_values(1369), 50) == calculate_quantile(expected, 50)
+        assert calculate_window_quantile(store.get_window_values(1369, seconds=10**6), 50) == calculate_quantile(expected, 50) # capped by the retention
+
+    def test_retention_values_and_archive(self, tmp_path):
+        #setup
+        clock = FakeClock()
+        archive_dir = tmp_path / 'archive'
+        store = make_store(tmp_path, clock, bucket_seconds=30, retention_seconds=0, retention_values=50, archive_dir=str(archive_dir))
+        archived = EXPIRED_WINDOW_VALUES.labels('archived').value
+        ingested = fill(store, clock)
+        kept = sum(len(read_segment(os.path.join(store.get_pool_dir(1369), name))[0]) for name in os.listdir(store.get_pool_dir(1369)) if name.endswith('.seg'))
+        archived_values = sum(len(read_segment(os.path.join(archive_dir, '1369', name))[0]) for name in os.listdir(archive_dir / '1369'))
+
+        #assert
+        assert kept >= 50
+        assert kept + archived_values == len(ingested)
+        assert EXPIRED_WINDOW_VALUES.labels('archived').value - archived == archived_values
+        assert sum(len(run) for run in store.get_window_values(1369)) == 50
+        assert calculate_window_quantile(store.get_window_values(1369), 50) == calculate_quantile(sorted(value for time, value in ingested[-50:]), 50)
+
+    def test_expire_all(self, tmp_path):
+        #setup
+        clock = FakeClock()
+        store = make_store(tmp_path, clock, bucket_seconds=60, retention_seconds=300)
+        ingested = fill(store, clock, updates=10)
+
+        clock.now += 3600 # no update since
+        expired = store.expire_all()
+
+        #assert
+        assert expired >= 1
+        assert [name for name in os.listdir(store.get_pool_dir(1369)) if name.endswith('.seg')] == []
+        assert store.get_window_values(1369) == []
+        assert store.get_config(1369)["next_seq"] == len(ingested)
+        assert store.add_pools([{"poolId": 1369, "poolValues": [1.5]}]) == ["appended"] # the pool outlives its values
+        segment_name = [name for name in os.listdir(store.get_pool_dir(1369)) if name.endswith('.seg')][0]
+        assert read_segment(os.path.join(store.get_pool_dir(1369), segment_name))[2].tolist() == [len(ingested)] # numbering goes on
+
+    def test_set_config(self, tmp_path):
+        #setup
+        store = WindowStore(str(tmp_path), locks=ShardLocks(str(tmp_path / 'locks')), bucket_seconds=30, retention_seconds=600)
+
+        first_config = store.set_config(1369)
+        second_config = store.set_config(1369, retention_values=100)
+
+        #assert
+        assert first_config == {"bucket_seconds": 30, "retention_seconds": 600, "retention_values": 0}
+        assert second_config == {"bucket_seconds": 30, "retention_seconds": 600, "retention_values": 100}
+        assert store.get_config(1369) == second_config
+        assert store.get_windowed([1369, 1370]) == {1369}
+        assert store.get_pool_ids() == [1369]
+
+class TestSortedRuns(object):
+    @pytest.mark.parametrize("seed", range(5))
+    def test_elements_of_the_sorted_concatenation(self, seed):
+        #setup
+        rng = random.Random(seed)
+        runs = [np.array(sorted(rng.randint(-20, 20) / rng.choice((1, 4)) for _ in range(rng.randint(1, 200)))) for _ in range(rng.randint(2, 8))]
+        expected = sorted(np.concatenate(runs).tolist())
+
+        sorted_runs = SortedRuns(runs)
+
+        #assert
+        assert len(sorted_runs) == len(expected)
+        assert [sorted_runs[i] for i in range(len(expected))] == expected
+        assert sorted_runs[-1] == expected[-1]
+
+    def test_big_runs_are_searched(self, monkeypatch):
+        #setup
+        rng = random.Random(0)
+        runs = [np.sort(np.array([rng.random() for _ in range(length)])) for length in (1000, 300, 7)]
+        expected = sorted(np.concatenate(runs).tolist())
+        percentiles = [0, 1, 33.3, 50, 99, 100]
+
+        merged = [calculate_window_quantile(runs, percentile) for percentile in percentiles], calculate_window_quantiles(runs, percentiles)
+        monkeypatch.setattr(windows, 'SEARCHED_RUN_LENGTH', 1)
+        searched = [calculate_window_quantile(runs, percentile) for percentile in percentiles], calculate_window_quantiles(runs, percentiles)
+
+        #assert
+        assert searched == merged
+        assert searched[1] == calculate_quantiles(expected, percentiles)
@@ -0,0 +1,141 @@
+import pytest
+from workers import WorkerPool, WorkerPoolBusy, init_worker, query_quantile
+from storage import CsvStorage, BinaryStorage
+from locks import ShardLocks
+from cache import QueryCounter
+from sketch import SketchStore
+from metrics import WORKER_TASKS
+from quantiles import calculate_quantile, select_quantile
+import api
+import time
+import random
+import threading
+
+def make_values(count, seed):
+    rng = random.Random(seed)
+    return [rng.randint(-50, 50) if rng.random() < 0.5 else rng.randint(-50, 50) / 4 for _ in range(count)] # ints, floats and ties
+
+def make_worker_pool(tmp_path, storage_name, max_pending=4):
+    storage_options = {"root": str(tmp_path)}
+    sharding_options = {"name": 'legacy', "root": str(tmp_path)}
+    return WorkerPool(1, max_pending, initializer=init_worker, initargs=(storage_name, storage_options, sharding_options, str(tmp_path / 'locks')))
+
+class TestWorkerPool(object):
+    @pytest.mark.parametrize("storage_class", [CsvStorage, BinaryStorage])
+    def test_same_results_as_inline(self, tmp_path, storage_class):
+        #setup
+        storage = storage_class(root=str(tmp_path), locks=ShardLocks(str(tmp_path / 'locks')))
+        values = make_values(3000, 0)
+        storage.update_pool({"poolId": 1369, "poolValues": values})
+        values = storage.get_pool_values(1369)[0][:] # what an inline query reads, a float64 array from binary storage
+        worker_pool = make_worker_pool(tmp_path, storage_class.name)
+
+        selected = [worker_pool.run(query_quantile, 1369, percentile, False) for percentile in (0, 12.5, 50, 99.9, 100)]
+        sorted_results = [worker_pool.run(query_quantile, 1369, percentile, True, [50, 90]) for percentile in (0, 12.5, 50, 99.9, 100)]
+        missing = worker_pool.run(query_quantile, 1370, 50, True)
+        worker_pool.shutdown()
+
+        #assert
+        for (quantile, total_elements, summary), percentile in zip(selected, (0, 12.5, 50, 99.9, 100)):
+            assert (quantile, total_elements) == select_quantile(values, percentile)
+            assert type(quantile) is type(select_quantile(values, percentile)[0])
+            assert summary is None
+        for (quantile, total_elements, summary), percentile in zip(sorted_results, (0, 12.5, 50, 99.9, 100)):
+            assert (quantile, total_elements) == calculate_quantile(sorted(values), percentile)
+            assert type(quantile) is type(calculate_quantile(sorted(values), percentile)[0])
+            assert summary["count"] == 3000
+        assert storage.get_pool_counts(1369) == (3000, 3000) # the sort was saved by the worker
+        assert missing == (None, None, None)
+
+    def test_backpressure(self, tmp_path):
+        #setup
+        worker_pool = make_worker_pool(tmp_path, 'csv', max_pending=1)
+        worker_pool.run(time.sleep, 0) # starts the process
+        rejected = WORKER_TASKS.labels('rejected').value
+        thread = threading.Thread(target=worker_pool.run, args=(time.sleep, 1))
+        thread.start()
+        while worker_pool.pending == 0:
+            time.sleep(0.01)
+
+        #assert
+        with pytest.raises(WorkerPoolBusy):
+            worker_pool.run(time.sleep, 0)
+        assert WORKER_TASKS.labels('rejected').value == rejected + 1
+        thread.join()
+        assert worker_pool.pending == 0
+        assert worker_pool.run(abs, -3) == 3
+
+        #teardown
+        worker_pool.shutdown()
+
+    def test_failed_task(self, tmp_path):
+        #setup
+        worker_pool = make_worker_pool(tmp_path, 'csv')
+        failed = WORKER_TASKS.labels('failed').value
+
+        #assert
+        with pytest.raises(ValueError):
+            worker_pool.run(int, 'not a number')
+        assert WORKER_TASKS.labels('failed').value == failed + 1
+        assert worker_pool.pending == 0
+
+        #teardown
+        worker_pool.shutdown()
+
+class TestWorkerQueries(object):
+    def query_all(self, data_list):
+        return [api.query_response(data) for data in data_list]
+
+    def test_query_response_from_worker(self, tmp_path, monkeypatch):
+        #setup
+        storage = CsvStorage(root=str(tmp_path), locks=ShardLocks(str(tmp_path / 'locks')))
+        for id in (1369, 1370, 2369):
+            storage.update_pool({"poolId": id, "poolValues": make_values(2000, id)})
+        storage.update_pool({"poolId": 1371, "poolValues": [3, 1, 2]}) # small, stays inline
+        queries = [{"poolId": id, "percentile": percentile} for id in (1369, 1370, 2369, 1371, 1372) for percentile in (0, 37.5, 90, 100)]
+        queries += [{"poolId": 1369, "percentile": 90}] * 12 # sorted once queried often
+        monkeypatch.setattr(api, 'sketch_store', SketchStore(str(tmp_path)))
+        monkeypatch.setattr(api, 'summary_cache', None)
+        monkeypatch.setattr(api, 'POOL_WORKER_MIN_VALUES', 1000)
+
+        monkeypatch.setattr(api, 'storage', storage)
+        monkeypatch.setattr(api, 'query_counter', QueryCounter())
+        inline_responses = self.query_all(queries)
+
+        worker_root = tmp_path / 'worker'
+        worker_storage = CsvStorage(root=str(worker_root), locks=ShardLocks(str(worker_root / 'locks')))
+        for id in (1369, 1370, 2369):
+            worker_storage.update_pool({"poolId": id, "poolValues": make_values(2000, id)})
+        worker_storage.update_pool({"poolId": 1371, "poolValues": [3, 1, 2]})
+        worker_pool = make_worker_pool(worker_root, 'csv')
+        done = WORKER_TASKS.labels('done').value
+        monkeypatch.setattr(api, 'storage', worker_storage)
+        monkeypatch.setattr(api, 'query_counter', QueryCounter())
+        monkeypatch.setattr(api, 'worker_pool', worker_pool)
+        worker_responses = self.query_all(queries)
+        sorted_counts = worker_storage.get_pool_counts(1369)
+        worker_pool.shutdown()
+
+        #assert
+        assert worker_responses == inline_responses
+        assert [type(response[0].get("calculated_quantile")) for response in worker_responses] == [type(response[0].get("calculated_quantile")) for response in inline_responses]
+        assert WORKER_TASKS.labels('done').value - done >= 3 * 4 # every query of a large pool until it is sorted
+        assert sorted_counts == (2000, 2000)
+
+    def test_worker_pool_full(self, tmp_path, monkeypatch):
+        #setup
+        storage = BinaryStorage(root=str(tmp_path))
+        storage.update_pool({"poolId": 1369, "poolValues": make_values(2000, 0)})
+        monkeypatch.setattr(api, 'storage', storage)
+        monkeypatch.setattr(api, 'sketch_store', SketchStore(str(tmp_path)))
+        monkeypatch.setattr(api, 'query_counter', QueryCounter())
+        monkeypatch.setattr(api, 'summary_cache', None)
+        monkeypatch.setattr(api, 'POOL_WORKER_MIN_VALUES', 1000)
+        monkeypatch.setattr(api, 'worker_pool', WorkerPool(1, 0)) # never started, every query is rejected
+
+        response, status = api.query_response({"poolId": 1369, "percentile": 50})
+
+        #assert
+        assert status == 503
+        assert "retry later" in response["error"]
+        assert 'pool_worker_queue_depth 0' in api.REGISTRY.render()
@@ -0,0 +1,117 @@
+import os
+import sys
+import argparse
+import logging
+from storage import get_storage
+from sharding import get_sharding
+from locks import ShardLocks, LOCK_DIR
+from codec import get_json_codec
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Streaming backup and migration of pools as NDJSON, one {"poolId", "poolValues"} record per line with
+# at most --chunk-values values, so a large pool is written as several records and no pool is held
+# whole in memory. The records are the input of /update/bulk, an export can be sent to a running server:
+#   python transfer.py export --data-dir data --min-id 1000 --max-id 1999 > pools.ndjson
+#   python transfer.py import --data-dir new_data --storage binary pools.ndjson
+#   curl --data-binary @pools.ndjson -H 'Content-Type: application/x-ndjson' http://127.0.0.1:1234/update/bulk
+# Both commands take the shard locks, they can run next to a server using the same --lock-dir
+
+CHUNK_VALUES = 100000
+VALUE_TYPES = frozenset((int, float))
+
+
+def get_shard_name(path):
+    # '12' for data/12.csv or data/12/
+    return os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+
+def open_storage(name, data_dir, sharding='legacy', range_size=1000, hash_shards=256, lock_dir=LOCK_DIR):
+    os.makedirs(data_dir, exist_ok=True)
+    options = {}
+    if name == 'csv':
+        options = {"write_mode": 'log', "log_sync": 'none'} # an import appends to the shard logs, merged once at the end
+    return get_storage(name, locks=ShardLocks(lock_dir), root=data_dir, sharding=get_sharding(sharding, data_dir, range_size=range_size, total_shards=hash_shards), **options)
+
+def export_pools(storage, output, min_id=None, max_id=None, shards=None, chunk_values=CHUNK_VALUES, codec=None):
+    # writes the pools of the selected shards and poolId range, inclusive, to the binary stream output.
+    # Returns the number of pools and of records written
+    codec = codec if codec is not None else get_json_codec('auto')
+    total_pools, total_records = 0, 0
+    if storage.name == 'csv':
+        storage.compact_all() # a pool only in a shard log has no shard file yet
+    for path in storage.get_shard_paths():
+        if shards and get_shard_name(path) not in shards:
+            continue
+        for id in storage.get_stored_pool_ids(path):
+            if (min_id is not None and id < min_id) or (max_id is not None and id > max_id):
+                continue
+            for values in storage.iter_pool_values(id, chunk_values):
+                output.write(codec.dumps({"poolId": id, "poolValues": values}) + b'\n')
+                total_records += 1
+            total_pools += 1
+        logger.info(f"Exported shard {path}")
+    return total_pools, total_records
+
+def parse_record(codec, line, line_number):
+    # the rules of validate_pool for a record of /update/bulk
+    try:
+        pool = codec.loads(line)
+    except ValueError:
+        raise ValueError(f"Line {line_number} is not valid JSON")
+    if type(pool) is not dict or set(pool) != {"poolId", "poolValues"}:
+        raise ValueError(f"Line {line_number} must contain both 'poolId' and 'poolValues' and only contain this values")
+    if type(pool["poolId"]) is not int or type(pool["poolValues"]) is not list or not pool["poolValues"] or not VALUE_TYPES.issuperset(map(type, pool["poolValues"])):
+        raise ValueError(f"Line {line_number} must have an integer 'poolId' and a non-empty list of real numbers as 'poolValues'")
+    return pool
+
+def import_pools(storage, lines, chunk_values=CHUNK_VALUES, codec=None):
+    # inserts or appends the records of lines in order, about chunk_values values at a time.
+    # Records of a pool already stored are appended to it. Returns the number of records applied.
+    # json by default, orjson would parse the ints beyond 64 bits as floats
+    codec = codec if codec is not None else get_json_codec('json')
+    total_records = 0
+    chunk, chunk_size = [], 0
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        pool = parse_record(codec, line, line_number)
+        chunk.append(pool)
+        chunk_size += len(pool["poolValues"])
+        if chunk_size >= chunk_values:
+            storage.update_pools(chunk)
+            total_records += len(chunk)
+            chunk, chunk_size = [], 0
+    if chunk:
+        storage.update_pools(chunk)
+        total_records += len(chunk)
+    if storage.name == 'csv':
+        storage.compact_all() # the server may run the 'rewrite' write mode, which never reads the logs
+    return total_records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export pools to NDJSON or import them, streaming")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', nargs='?', default='-', help="NDJSON file written by export or read by import, - for stdout / stdin")
+    parser.add_argument('--data-dir', default='data', help="data directory of the storage")
+    parser.add_argument('--storage', default='csv', choices=['csv', 'binary'])
+    parser.add_argument('--sharding', default='legacy', choices=['legacy', 'range', 'hash', 'size'])
+    parser.add_argument('--range-size', type=int, default=1000, help="poolIds per shard of the 'range' sharding")
+    parser.add_argument('--hash-shards', type=int, default=256, help="number of shards of the 'hash' sharding")
+    parser.add_argument('--lock-dir', default=LOCK_DIR, help="POOL_LOCK_DIR of the servers using the data directory")
+    parser.add_argument('--chunk-values', type=int, default=CHUNK_VALUES, help="values per exported record, per applied chunk on import")
+    parser.add_argument('--min-id', type=int, help="export the poolIds from this one")
+    parser.add_argument('--max-id', type=int, help="export the poolIds up to this one")
+    parser.add_argument('--shard', action='append', help="export this shard only, e.g. '12' for data/12.csv, can be repeated")
+    args = parser.parse_intermixed_args() # the path may follow the options
+    storage = open_storage(args.storage, args.data_dir, args.sharding, args.range_size, args.hash_shards, args.lock_dir)
+    if args.command == 'export':
+        output = sys.stdout.buffer if args.path == '-' else open(args.path, 'wb')
+        with output:
+            total_pools, total_records = export_pools(storage, output, args.min_id, args.max_id, args.shard, args.chunk_values)
+        print(f"Exported {total_pools} pools in {total_records} records", file=sys.stderr)
+    else:
+        lines = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+        with lines:
+            total_records = import_pools(storage, lines, args.chunk_values)
+        print(f"Imported {total_records} records", file=sys.stderr)
@@ -0,0 +1,320 @@
+import os
+import json
+import math
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+from locks import ShardLocks, replace_file
+from quantiles import calculate_quantile, calculate_quantiles, select_quantile
+from metrics import count_bytes_read, EXPIRED_WINDOW_VALUES
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = 'data'
+WINDOW_DIR = 'windows'
+WINDOW_MODE = 'window'
+CONFIG_FILE = 'window.json'
+SEGMENT_SUFFIX = '.seg'
+RECORD_BYTES = 24 # value, ingest time and sequence number, 8 bytes each
+SEARCHED_RUN_LENGTH = 8192 # runs of this many values on average are searched in place, smaller ones are merged by selection
+
+
+class WindowStore(object):
+    # Values of the pools in 'window' mode, tagged with their ingest time and a sequence number.
+    # One directory per pool in data/windows/, holding its retention policy in window.json and one
+    # segment per time bucket. A segment is a few sorted runs, <bucket start>.<first seq>.<end seq>.seg,
+    # each holding its values sorted, then their ingest times and sequence numbers in the same order.
+    # An update writes its values as a new run, and merges the newest runs while the older one is not
+    # bigger, so a segment keeps few runs and a value is rewritten a logarithmic number of times.
+    # The runs of a bucket are merged into one once the next bucket starts.
+    # A window only reads the runs of its buckets, the oldest bucket is cut with a mask, which keeps
+    # the values sorted. Expired segments are deleted, or moved to archive_dir when it is set
+    def __init__(self, root=DATA_DIR, locks=None, bucket_seconds=60, retention_seconds=86400, retention_values=0, archive_dir=None, clock=time.time):
+        self.root = root
+        self.locks = locks if locks is not None else ShardLocks()
+        self.defaults = {"bucket_seconds": bucket_seconds, "retention_seconds": retention_seconds, "retention_values": retention_values}
+        self.archive_dir = archive_dir or None
+        self.clock = clock
+
+    def get_pool_dir(self, id):
+        return os.path.join(self.root, WINDOW_DIR, str(id))
+
+    def get_config(self, id):
+        # None for a pool not in 'window' mode, a single failed open
+        try:
+            with open(os.path.join(self.get_pool_dir(id), CONFIG_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def get_windowed(self, ids):
+        return set(id for id in ids if os.path.exists(os.path.join(self.get_pool_dir(id), CONFIG_FILE)))
+
+    def get_pool_ids(self):
+        directory = os.path.join(self.root, WINDOW_DIR)
+        return sorted(int(name) for name in os.listdir(directory) if os.path.exists(os.path.join(directory, name, CONFIG_FILE))) if os.path.isdir(directory) else []
+
+    def set_config(self, id, bucket_seconds=None, retention_seconds=None, retention_values=None):
+        logger.info("Set the window and retention policy of the pool")
+        directory = self.get_pool_dir(id)
+        os.makedirs(directory, exist_ok=True)
+        with self.locks.writing(directory):
+            config = self.get_config(id) or dict(self.defaults)
+            for key, value in (("bucket_seconds", bucket_seconds), ("retention_seconds", retention_seconds), ("retention_values", retention_values)):
+                if value is not None:
+                    config[key] = value
+            replace_file(os.path.join(directory, CONFIG_FILE), lambda f: json.dump(config, f), mode='w')
+        return config
+
+    def get_segments(self, directory, config):
+        # [(start, end, run names)] oldest first, a segment holds the values ingested from its start to
+        # its end. Only the runs of the segments used are parsed, by get_runs
+        run_names = {}
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                start, _, run_name = name.partition('.')
+                run_names.setdefault(int(start), []).append(run_name)
+        starts = sorted(run_names)
+        ends = starts[1:] + [starts[-1] + config["bucket_seconds"]] if starts else []
+        return [(start, end, run_names[start]) for start, end in zip(starts, ends)]
+
+    def add_pools(self, pools):
+        logger.info("Add pool values to the windows, tagged with their ingest time")
+        return [self.add_pool(pool["poolId"], pool["poolValues"]) for pool in pools]
+
+    def add_pool(self, id, pool_values):
+        directory = self.get_pool_dir(id)
+        with self.locks.writing(directory):
+            config = self.get_config(id)
+            now = self.clock()
+            segments = self.get_segments(directory, config)
+            # the newest run ends at the next sequence number, window.json keeps it once every segment expired
+            next_seq = max(config.get("next_seq", 0), get_runs(segments[-1][2])[-1][1] if segments else 0)
+            status = "appended" if next_seq else "inserted"
+            values = np.asarray(pool_values, dtype=np.float64)
+            order = np.argsort(values, kind='stable')
+            start = math.floor(now / config["bucket_seconds"]) * config["bucket_seconds"]
+            if segments and start <= segments[-1][0]: # same bucket, or the clock went back
+                start, end, run_names = segments.pop()
+                runs = get_runs(run_names)
+            else:
+                end, runs = start + config["bucket_seconds"], []
+                if segments:
+                    previous_start, _, run_names = segments.pop()
+                    if len(run_names) > 1:
+                        run_names = [get_run_name(merge_runs(directory, previous_start, get_runs(run_names))[0])]
+                    segments.append((previous_start, start, run_names))
+            run = (next_seq, next_seq + len(values))
+            write_segment(get_segment_path(directory, start, run), values[order], np.full(len(values), now), next_seq + order.astype(np.int64))
+            runs = runs + [run]
+            while len(runs) > 1 and get_segment_length(get_segment_path(directory, start, runs[-2])) <= len(values):
+                run, values = merge_runs(directory, start, runs[-2:])
+                runs[-2:] = [run]
+            segments.append((start, end, [get_run_name(run) for run in runs]))
+            self.expire_segments(id, directory, config, now, segments)
+        return status
+
+    def expire_segments(self, id, directory, config, now, segments):
+        # a segment expires once it ends before now - retention_seconds, or once the newer segments
+        # hold retention_values values. Queries apply the same policy to the values not expired yet
+        cutoff = now - config["retention_seconds"] if config["retention_seconds"] else -math.inf
+        expired = [segment for segment in segments if segment[1] <= cutoff]
+        kept = segments[len(expired):]
+        if config["retention_values"]:
+            counts = [sum(get_segment_length(get_segment_path(directory, start, run)) for run in get_runs(run_names)) for start, _, run_names in kept]
+            while len(kept) > 1 and sum(counts[1:]) >= config["retention_values"]:
+                expired.append(kept.pop(0))
+                counts.pop(0)
+        if expired and not kept: # keep numbering the values once every segment is gone
+            config["next_seq"] = max(config.get("next_seq", 0), get_runs(expired[-1][2])[-1][1])
+            replace_file(os.path.join(directory, CONFIG_FILE), lambda f: json.dump(config, f), mode='w')
+        for start, _, run_names in expired:
+            for run in get_runs(run_names):
+                path = get_segment_path(directory, start, run)
+                length = get_segment_length(path)
+                if self.archive_dir is not None:
+                    archive_directory = os.path.join(self.archive_dir, str(id))
+                    os.makedirs(archive_directory, exist_ok=True)
+                    shutil.move(path, os.path.join(archive_directory, os.path.basename(path)))
+                    EXPIRED_WINDOW_VALUES.labels('archived').inc(length)
+                else:
+                    os.remove(path)
+                    EXPIRED_WINDOW_VALUES.labels('dropped').inc(length)
+            for name in os.listdir(directory): # runs left over by an interrupted merge
+                if name.startswith(f"{start}.") and name.endswith(SEGMENT_SUFFIX):
+                    os.remove(os.path.join(directory, name))
+        return len(expired)
+
+    def iterate_runs(self, directory, config, cutoff):
+        # (start, run) of the segments ending after cutoff, newest first. Runs of newer segments, and
+        # newer runs of a segment, hold newer sequence numbers
+        for start, end, run_names in reversed(self.get_segments(directory, config)):
+            if end <= cutoff:
+                break
+            for run in reversed(get_runs(run_names)):
+                yield start, run
+
+    def expire_all(self):
+        expired = 0
+        for id in self.get_pool_ids():
+            directory = self.get_pool_dir(id)
+            with self.locks.writing(directory):
+                config = self.get_config(id)
+                expired += self.expire_segments(id, directory, config, self.clock(), self.get_segments(directory, config))
+        return expired
+
+    def get_window_values(self, id, seconds=None, values=None):
+        # the sorted values of each segment in the window, newest first, None for a pool not in
+        # 'window' mode. The window is the last seconds seconds or the last values values, whichever
+        # is given, within the retention policy
+        directory = self.get_pool_dir(id)
+        with self.locks.reading(directory):
+            config = self.get_config(id)
+            if config is None:
+                return None
+            now = self.clock()
+            cutoffs = [now - limit for limit in (seconds, config["retention_seconds"]) if limit]
+            cutoff = max(cutoffs) if cutoffs else -math.inf
+            limits = [limit for limit in (values, config["retention_values"]) if limit]
+            remaining = min(limits) if limits else None
+            runs = []
+            for start, segment_run in self.iterate_runs(directory, config, cutoff):
+                path = get_segment_path(directory, start, segment_run)
+                if start >= cutoff and remaining is None:
+                    run = read_segment_values(path) # whole bucket in the window, its times are not read
+                else:
+                    run, times, seqs = read_segment(path)
+                    if start < cutoff:
+                        in_window = times >= cutoff
+                        run, seqs = run[in_window], seqs[in_window]
+                    if remaining is not None and len(run) > remaining:
+                        first_seq = np.partition(seqs, len(seqs) - remaining)[len(seqs) - remaining] # the newest remaining values of the run
+                        run = run[seqs >= first_seq]
+                if len(run):
+                    runs.append(run)
+                if remaining is not None:
+                    remaining -= len(run)
+                    if remaining == 0:
+                        break
+            return runs
+
+def get_run_name(run):
+    return f"{run[0]}.{run[1]}{SEGMENT_SUFFIX}"
+
+def get_segment_path(directory, start, run):
+    return os.path.join(directory, f"{start}.{get_run_name(run)}")
+
+def get_runs(run_names):
+    # [(first seq, end seq)] oldest first. A merge writes the merged run before removing its runs,
+    # a crash in between leaves runs within the range of the merged one, which are skipped
+    if len(run_names) == 1: # a past bucket
+        first_seq, end_seq, _ = run_names[0].split('.')
+        return [(int(first_seq), int(end_seq))]
+    runs = sorted(((int(first_seq), int(end_seq)) for first_seq, end_seq, _ in (name.split('.') for name in run_names)), key=lambda run: (run[0], -run[1]))
+    live = []
+    for run in runs:
+        if not live or run[1] > live[-1][1]:
+            live.append(run)
+    return live
+
+def merge_runs(directory, start, runs):
+    # (merged run, its values), the stable sort of the runs oldest first keeps the equal values in ingest order
+    columns = [read_segment(get_segment_path(directory, start, run)) for run in runs]
+    values, times, seqs = (np.concatenate([column[i] for column in columns]) for i in range(3))
+    order = np.argsort(values, kind='stable')
+    run, values = (runs[0][0], runs[-1][1]), values[order]
+    write_segment(get_segment_path(directory, start, run), values, times[order], seqs[order])
+    for merged_run in runs:
+        os.remove(get_segment_path(directory, start, merged_run))
+    return run, values
+
+def read_segment_values(path):
+    length = get_segment_length(path)
+    count_bytes_read(path, length * 8)
+    return np.fromfile(path, dtype='<f8', count=length)
+
+def read_segment(path):
+    columns = np.fromfile(path, dtype='<f8')
+    count_bytes_read(path, columns.nbytes)
+    length = len(columns) // 3
+    return columns[:length], columns[length:2*length], columns[2*length:].view('<i8')
+
+def write_segment(path, values, times, seqs):
+    def write(f):
+        for column, dtype in ((values, '<f8'), (times, '<f8'), (seqs, '<i8')):
+            f.write(column.astype(dtype).tobytes())
+    replace_file(path, write)
+
+def get_segment_length(path):
+    return os.path.getsize(path) // RECORD_BYTES
+
+class SortedRuns(object):
+    # the sorted concatenation of sorted runs, without merging them. An element is found by binary
+    # search: the weighted median of the middle elements of the runs splits the ranks left in two
+    # until it is the element of the rank, so a few elements cost a few searches per run
+    def __init__(self, runs):
+        self.runs = runs
+        self.length = sum(len(run) for run in runs)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        rank = index + self.length if index < 0 else index
+        if rank == 0:
+            return min(run[0] for run in self.runs)
+        if rank == self.length - 1:
+            return max(run[-1] for run in self.runs)
+        lows, highs = [0] * len(self.runs), [len(run) for run in self.runs]
+        while True:
+            middles = sorted((run[(low + high) // 2], high - low) for run, low, high in zip(self.runs, lows, highs) if low < high)
+            weight = sum(length for _, length in middles) / 2
+            for pivot, length in middles:
+                weight -= length
+                if weight <= 0:
+                    break
+            below = [int(np.searchsorted(run, pivot, side='left')) for run in self.runs]
+            above = [int(np.searchsorted(run, pivot, side='right')) for run in self.runs]
+            if rank < sum(below):
+                highs = [min(high, position) for high, position in zip(highs, below)]
+            elif rank >= sum(above):
+                lows = [max(low, position) for low, position in zip(lows, above)]
+            else:
+                return pivot
+
+def get_sorted_values(runs):
+    # a single run is already sorted, big runs are searched in place, None for small ones to merge
+    if len(runs) == 1:
+        return runs[0]
+    if sum(len(run) for run in runs) >= SEARCHED_RUN_LENGTH * len(runs):
+        return SortedRuns(runs)
+    return None
+
+def calculate_window_quantile(runs, percentile):
+    # several small runs are merged by selection
+    sorted_values = get_sorted_values(runs)
+    if sorted_values is not None:
+        return calculate_quantile(sorted_values, percentile)
+    return select_quantile(np.concatenate(runs), percentile)
+
+def calculate_window_quantiles(runs, percentiles):
+    sorted_values = get_sorted_values(runs)
+    return calculate_quantiles(sorted_values if sorted_values is not None else np.sort(np.concatenate(runs)), percentiles)
+
+def start_expirer(window_store, interval):
+    # drops the expired segments of the pools no longer updated, updates expire their own pool
+    logger.info(f"Start window expiry every {interval} seconds")
+
+    def expire_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                window_store.expire_all()
+            except Exception:
+                logger.exception("Window expiry failed")
+
+    expirer = threading.Thread(target=expire_forever, name='expirer', daemon=True)
+    expirer.start()
+    return expirer
@@ -0,0 +1,108 @@
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from locks import ShardLocks
+from sharding import get_sharding
+from storage import get_storage
+from quantiles import calculate_quantile, select_quantile, build_summary
+from metrics import WORKER_TASKS, WORKER_TASK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Sorting or selecting the quantile of a huge unsorted pool holds the GIL for seconds, stalling every
+# other request of the process. Those queries run in a pool of worker processes instead, each one with
+# its own storage on the same data directory, shards being shared through file locks like between the
+# processes of a multi-worker server. Small queries stay on the request thread.
+# Worker processes are spawned, so they start clean whatever threads the server runs
+
+worker_storage = None # storage of this worker process, built by init_worker
+
+
+class WorkerPoolBusy(Exception):
+    # every slot of the worker pool is taken, the caller should answer 503
+    pass
+
+
+class WorkerPool(object):
+    # Process pool with a bound on the tasks waiting or running, further tasks are rejected
+    # instead of queueing without limit. The processes are started by the first task
+    def __init__(self, processes, max_pending, initializer=None, initargs=()):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.initargs = initargs
+        self.executor = None
+        self.pending = 0 # tasks submitted and not finished yet, the queue depth
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                logger.info(f"Start {self.processes} worker processes")
+                self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=self.initializer, initargs=self.initargs)
+            return self.executor
+
+    def run(self, function, *args):
+        # function(*args) in a worker process, function and arguments must be picklable
+        with self.lock:
+            if self.pending >= self.max_pending:
+                WORKER_TASKS.labels('rejected').inc()
+                raise WorkerPoolBusy(f"{self.pending} tasks are already pending")
+            self.pending += 1
+        start = time.perf_counter()
+        try:
+            result = self.get_executor().submit(function, *args).result()
+        except BrokenProcessPool:
+            WORKER_TASKS.labels('failed').inc()
+            logger.exception("A worker process died, restart the worker pool")
+            self.reset()
+            raise
+        except Exception:
+            WORKER_TASKS.labels('failed').inc()
+            raise
+        finally:
+            WORKER_TASK_SECONDS.observe(time.perf_counter() - start)
+            with self.lock:
+                self.pending -= 1
+        WORKER_TASKS.labels('done').inc()
+        return result
+
+    def reset(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def init_worker(storage_name, storage_options, sharding_options, lock_dir):
+    # built from plain options, locks and sharding objects are not picklable
+    global worker_storage
+    sharding = get_sharding(**sharding_options)
+    worker_storage = get_storage(storage_name, locks=ShardLocks(lock_dir), sharding=sharding, **storage_options)
+
+def query_quantile(id, percentile, sort, summary_grid=None):
+    # runs in a worker process: the storage calls and quantile functions of an inline query.
+    # Returns (quantile, total_elements, summary), the summary only for a sorted pool and a grid
+    if not sort:
+        pool_values_list, sorted_length = worker_storage.get_pool_values(id)
+        if pool_values_list is None:
+            return None, None, None
+        if sorted_length < len(pool_values_list):
+            return select_quantile(pool_values_list, percentile) + (None,)
+        sorted_pool_values_list = pool_values_list # sorted by another query meanwhile
+    else:
+        sorted_pool_values_list = worker_storage.get_sorted_pool_values(id)
+        if sorted_pool_values_list is None:
+            return None, None, None
+    summary = build_summary(sorted_pool_values_list, summary_grid) if summary_grid else None
+    return calculate_quantile(sorted_pool_values_list, percentile) + (summary,)